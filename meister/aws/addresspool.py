@@ -0,0 +1,94 @@
+'''
+A pool of free elastic IP addresses.
+'''
+import threading
+from waiter import Waiter
+
+class AddressPool:
+    """
+    Hands out elastic IP addresses to nodes.
+    The addresses that a run needs are worked out first, the shortfall is
+    allocated up front, and all associations are then confirmed together
+    with a single describe call per round.
+    """
+
+    def __init__(self, connection, logger, journal = None, reserve = 0):
+        """
+        @param journal: A StateStore where the picked addresses are written,
+            so that an interrupted run reuses them.
+        @param reserve: The number of free addresses to keep allocated
+            for nodes that are added later.
+        """
+        self.connection = connection
+        self.logger = logger
+        self.journal = journal
+        self.reserve = reserve
+        self.lock = threading.Lock()
+        # The instance each address is associated with, keyed by address.
+        self.addresses = None
+
+    def prepare(self, ids):
+        """
+        Allocate the addresses that nodes will need, up front.
+        @param ids: A dict of instance ids, keyed by node name. Nodes that
+            haven't been launched yet have None as id.
+        """
+        with self.lock:
+            self.addresses = self.connection.describeAddresses()
+            associated = set(instance for instance in self.addresses.values() if instance)
+            needed = len([name for name, id in ids.items() if not id in associated])
+            free = [ip for ip, instance in self.addresses.items() if not instance]
+            shortfall = needed + self.reserve - len(free)
+            if shortfall > 0:
+                self.logger.log("Allocating {0} new IP addresses".format(shortfall))
+                for i in range(shortfall):
+                    self.addresses[self.connection.allocateElasticIP()] = None
+
+    def assign(self, ids, wait = 2):
+        """
+        Make sure that nodes have elastic IP addresses.
+        Several threads can assign addresses from the same pool.
+        @param ids: A dict of instance ids, keyed by node name.
+        @return: A dict of addresses, keyed by node name.
+        """
+        if self.addresses is None:
+            self.prepare(ids)
+        with self.lock:
+            byInstance = dict((instance, ip) for ip, instance in self.addresses.items() if instance)
+            assigned = {}
+            needed = []
+            for name, id in sorted(ids.items()):
+                if id in byInstance:
+                    assigned[name] = byInstance[id]
+                else:
+                    needed.append(name)
+            if not needed:
+                return assigned
+            free = sorted(ip for ip, instance in self.addresses.items() if not instance)
+
+            # Addresses that an earlier run picked for a node are used again.
+            journaled = {}
+            if self.journal:
+                for operation in self.journal.getOperations("eip", True):
+                    journaled[operation["name"]] = operation["data"]["ip"]
+            picked = {}
+            for name in needed:
+                if journaled.get(name) in free:
+                    picked[name] = journaled[name]
+                    free.remove(picked[name])
+            for name in needed:
+                if not name in picked:
+                    picked[name] = free.pop(0) if free else self.connection.allocateElasticIP()
+                if self.journal:
+                    self.journal.completeOperation(self.journal.beginOperation("eip", name), {"ip": picked[name]})
+                self.logger.log("Using IP {0} for {1}".format(picked[name], name))
+                self.connection.associateAddress(ids[name], picked[name])
+                self.addresses[picked[name]] = ids[name]
+
+        names = dict((ip, name) for name, ip in picked.items())
+        def check(pending):
+            associated = self.connection.describeAddresses(pending)
+            return [ip for ip in pending if associated.get(ip) == ids[names[ip]]]
+        Waiter(check, delay=wait).wait(sorted(names.keys()))
+        assigned.update(picked)
+        return assigned
@@ -6,9 +6,15 @@ Created on Jan 10, 2013
 
 import ec2
 import route53
+import limiter
 
+import threading
+from functools import partial
 from provisioner import Provisioner
 from libcloud.compute.types import Provider
+from meister.plan import Plan, Snapshot, Change
+from meister.scheduler import TaskScheduler
+from meister.tracing import tracer
 
 class EC2Driver:
     REGIONS = {
@@ -28,7 +34,11 @@ class EC2Driver:
         self.defaultZone = settings["driver"]["defaultZone"]
         self.defaultSecurityGroup = settings['driver']['defaultSecurityGroup']
         self.defaultKeyName = settings['driver']['defaultKeyName']
-        config.getSecurityGroups = self.getSecurityGroups
+        self.stack = settings['driver'].get('stack', 'meister')
+        self.eipReserve = settings['driver'].get('eipReserve', 0)
+        self.endpoint = settings['driver'].get('endpoint')
+        if 'requestRate' in settings['driver']:
+            limiter.setRate("ec2", settings['driver']['requestRate'])
         self.config = config
         self.con = None
         if 'securityGroups' in settings.keys():
@@ -36,7 +46,7 @@ class EC2Driver:
     
     def getConnection(self):
         if not self.con:
-            self.con = ec2.EC2Connection(self.aws_region, self.aws_id, self.aws_key)
+            self.con = ec2.EC2Connection(self.aws_region, self.aws_id, self.aws_key, self.stack, self.endpoint)
         return self.con
 
     def getSecurityGroups(self):
@@ -49,10 +59,34 @@ class EC2Driver:
             if not prop in definition and getattr(self, defaultProp, None):
                 definition[prop] = getattr(self, defaultProp)
         if name in nodes:
+            definition["id"] = nodes[name].id
             definition["internalIp"] = nodes[name].private_ip[0] if len(nodes[name].private_ip) else None 
             definition["externalIp"] = nodes[name].public_ip[0] if len(nodes[name].public_ip) else None
         return AWSNode(name, definition)
     
+    def findHost(self, name, id = None):
+        """
+        Look up the addresses of a single node.
+        @param id: The instance id the node had last time, if it is known.
+        @return: A dict with the instance id and the external and internal
+            IP, or None if the node isn't running.
+        """
+        con = self.getConnection()
+        node = None
+        if id:
+            # Filtering by id doesn't fail if the instance is long gone.
+            nodes = con.describeNodes(filters={"instance-id": [id], "instance-state-name": ec2.ACTIVE_STATES})
+            node = nodes[0] if nodes else None
+        if not node:
+            node = con.findNode(name)
+        if not node:
+            return None
+        return {
+            "id": node.id,
+            "externalIp": node.public_ip[0] if node.public_ip else None,
+            "internalIp": node.private_ip[0] if node.private_ip else None,
+        }
+
     def info(self, logger):
         con = self.getConnection()
         savedNodes = con.getNodes()
@@ -64,24 +98,188 @@ class EC2Driver:
                 status = "not started"
             logger.log("\n" + str(node), status)
         
-    def provision(self, logger):
+    def getSnapshot(self):
+        """
+        Collect the live state of the stack with one call for each kind of resource.
+        """
+        con = self.getConnection()
+        snapshot = Snapshot()
+        snapshot.nodes = con.getNodes()
+        snapshot.groups = con.getSecurityGroups(True, self.getSecurityGroups().keys())
+        snapshot.addresses = con.getElasticIPs(False)
+        return snapshot
+
+    def adoptNodes(self, logger):
+        """
+        Add the nodes that were launched before instances were tagged with
+        the stack to the stack, so that they are found instead of launched again.
+        """
+        existing = self.getConnection().getNodes()
+        keyNames = {}
+        for name, definition in self.config.definitions.items():
+            if not name in existing:
+                keyNames[name] = definition.get("keyName", self.defaultKeyName)
+        if keyNames:
+            Provisioner(self.getConnection(), logger).adoptNodes(keyNames)
+
+    def plan(self, plan, snapshot):
+        """
+        Add the changes needed for the nodes, security groups and elastic IPs to a plan.
+        """
+        nodes = self.config.getNodes()
+        rules = self.getRules(snapshot.nodes)
+        for name, group in sorted(self.getSecurityGroups().items()):
+            existingGroup = snapshot.groups.get(name)
+            if not existingGroup:
+                plan.add("group", Change.CREATE, name, group["description"])
+            existingRules = existingGroup.rules if existingGroup else set()
+            desired, pending = rules[name]
+            for rule in sorted(desired - existingRules):
+                plan.add("rule", Change.CREATE, name, str(rule))
+            for ip in pending:
+                plan.add("rule", Change.CREATE, name, ip, True)
+            if not pending:
+                for rule in sorted(existingRules - desired):
+                    plan.add("rule", Change.DELETE, name, str(rule))
+        for name, node in sorted(nodes.items()):
+            existingNode = snapshot.nodes.get(name)
+            if not existingNode:
+                plan.add("node", Change.CREATE, name, "{0} {1}".format(getattr(node, "size", ""), getattr(node, "image", "")))
+            elif existingNode.extra["status"] != "running":
+                plan.add("node", Change.UPDATE, name, "wait for {0} node".format(existingNode.extra["status"]))
+            if getattr(node, "elasticIP", False):
+                if not existingNode:
+                    plan.add("eip", Change.CREATE, name, pending=True)
+                elif not existingNode.public_ip or existingNode.public_ip[0] not in snapshot.addresses:
+                    plan.add("eip", Change.CREATE, name)
+
+    def getRules(self, nodes):
+        """
+        Get the rules that each security group should have.
+        Rules for nodes, like ^mgmt, can only be made once the node exists.
+        @param nodes: The existing nodes.
+        @return: A dict keyed by group name with a set of rules and a list
+            of the rules that are still pending.
+        """
+        rules = {}
+        for name, group in self.getSecurityGroups().items():
+            desired = set()
+            pending = []
+            for rule in group["rules"]:
+                ip = self.getRuleIp(rule["ip"], nodes)
+                if ip is None:
+                    pending.append("{0}:{1}-{2}".format(rule["ip"], rule["fromPort"], rule["toPort"]))
+                else:
+                    desired.add(ec2.Rule(rule["fromPort"], rule["toPort"], ip, rule.get("protocol", "tcp")))
+            rules[name] = (desired, pending)
+        return rules
+
+    def getRuleIp(self, ip, nodes):
+        """
+        Get the address of a rule. Rules for nodes, like ^mgmt or
+        ^mgmt:internal, get the address of the node.
+        @param nodes: The existing nodes.
+        @return: The address, or None if the node doesn't exist yet.
+        """
+        if ip[0] != "^":
+            return ip
+        name = ip[1:].partition(":")
+        if not name[0] in nodes:
+            return None
+        existingNode = nodes[name[0]]
+        ips = existingNode.private_ip if name[2] == "internal" else existingNode.public_ip
+        return ips[0] + "/32" if ips else None
+
+    def provision(self, logger, plan = None, snapshot = None, scheduler = None):
         """
         Provision configuration.
+        Only the steps that the plan needs are taken. Security groups are set
+        up and all new nodes are launched right away. After that every node
+        moves through its own jobs on the scheduler: it is waited for, then it
+        gets its elastic IP, and the rules that refer to it are added once
+        the nodes they refer to have their addresses.
+        @param scheduler: The scheduler to add the jobs to, so that later
+            stages can be added to each node. The jobs are run right away if
+            there isn't one.
+        @return: A dict with the key of the last job of each node that has jobs.
         """
-        provisioner = Provisioner(self.getConnection(), logger)
-        provisioner.provisionSecurityGroups(self.getSecurityGroups())
-        provisioner.provisionNodes(self.config.getNodes())
-        provisioner.verify(self.config.getNodes())
-        provisioner.provisionSecurityGroups(self.getSecurityGroups(), self.config.getNodes())
-        provisioner.createElasticIps(self.config.getNodes())
-        
+        if plan is None:
+            self.adoptNodes(logger)
+            snapshot = self.getSnapshot()
+            plan = Plan()
+            self.plan(plan, snapshot)
+        run = scheduler is None
+        if run:
+            scheduler = TaskScheduler()
+        provisioner = Provisioner(self.getConnection(), logger, self.config.state)
+        nodes = self.config.getNodes()
+        stages = {}
+        if plan.has("group") or plan.has("rule"):
+            with tracer.span("groups"):
+                provisioner.provisionSecurityGroups(self.getSecurityGroups(), self.getRules(snapshot.nodes), snapshot.groups)
+        if plan.has("node") or self.config.state.getOperations("launch", False):
+            with tracer.span("launch"):
+                launched = provisioner.provisionNodes(nodes)
+            waitFor = sorted(set(change.name for change in plan.getChanges("node")) | set(name for name in launched if name in nodes))
+            self.scheduleReady(scheduler, provisioner, nodes, waitFor, stages)
+        eips = [change.name for change in plan.getChanges("eip")]
+        if eips:
+            with tracer.span("eip", nodes=len(eips)):
+                pool = provisioner.prepareElasticIps(nodes, eips, self.eipReserve)
+            for name in eips:
+                key = ("eip", name)
+                scheduler.add(key, tracer.wrap("eip", partial(provisioner.createElasticIp, pool, nodes[name]), node=name), [stages[name]] if name in stages else [])
+                stages[name] = key
+        # Rules for new nodes are added once the nodes have their final addresses.
+        if [change for change in plan.getChanges("rule") if change.pending]:
+            referenced = set()
+            for group in self.getSecurityGroups().values():
+                for rule in group["rules"]:
+                    if self.getRuleIp(rule["ip"], snapshot.nodes) is None:
+                        referenced.add(rule["ip"][1:].partition(":")[0])
+            key = ("rules", ",".join(sorted(referenced)))
+            def provisionRules():
+                provisioner.provisionSecurityGroups(self.getSecurityGroups(), self.getRules(self.getConnection().getNodes(True)), snapshot.groups)
+            scheduler.add(key, tracer.wrap("groups", provisionRules), [stages[name] for name in sorted(referenced) if name in stages])
+            for name in referenced:
+                stages[name] = key
+        if run:
+            scheduler.run()
+        return stages
+
+    def scheduleReady(self, scheduler, provisioner, nodes, names, stages):
+        """
+        Add a job for each node that is done when the node is ready.
+        All the nodes are waited for by a single job, which checks all of
+        them at once and finishes the job of each node as soon as it is ready.
+        """
+        keys = {}
+        for name in names:
+            keys[name] = stages[name] = ("ready", name)
+            scheduler.addExternal(keys[name])
+        def verify():
+            finished = set()
+            def onReady(name):
+                finished.add(name)
+                scheduler.finish(keys[name])
+            try:
+                provisioner.verify(nodes, names=names, onReady=onReady)
+            except Exception as e:
+                for name in names:
+                    if not name in finished:
+                        scheduler.finish(keys[name], error=e)
+                raise
+            for name in names:
+                if not name in finished:
+                    scheduler.finish(keys[name], error=Exception("Node {0} was not launched".format(name)))
+        scheduler.add(("ready", None), tracer.wrap("verify", verify, nodes=len(names)))
+
     def terminate(self, logger):
         """
         Terminate all nodes in this configuration.
         """
         provisioner = Provisioner(self.getConnection(), logger)
-        provisioner.deleteNodes(self.config.getNodes())
-        provisioner.deleteSecurityGroups(self.getSecurityGroups())
+        provisioner.deleteNodes(self.config.getNodes(), self.getSecurityGroups())
 
 
 class Route53Driver:
@@ -89,45 +287,194 @@ class Route53Driver:
         self.aws_id = settings['DNS']['id']
         self.aws_key = settings['DNS']['key']
         self.defaultZone = settings['DNS']['defaultZone']
+        self.wait = settings['DNS'].get('wait', False)
+        self.zoneCacheTime = settings['DNS'].get('zoneCacheTime', 86400)
+        self.endpoint = settings['DNS'].get('endpoint')
+        self.batchDelay = settings['DNS'].get('batchDelay', 1)
+        if 'requestRate' in settings['DNS']:
+            limiter.setRate("route53", settings['DNS']['requestRate'])
         self.config = config
+        self.con = None
+        # Nodes can be provisioned from several threads, but the zone is shared.
+        self.lock = threading.RLock()
+        self.resumed = False
+        # The nodes whose records wait for the flusher, by name.
+        self.queued = {}
+        self.flusher = None
+        self.queueLock = threading.Lock()
     
     def getConnection(self):
-        return route53.Route53Connection(self.aws_id, self.aws_key)
+        if not self.con:
+            self.con = route53.Route53Connection(self.aws_id, self.aws_key, self.endpoint)
+        return self.con
     
-    def provision(self, nodes, logger):
+    def getZone(self, logger, create = False):
+        """
+        Get the default zone and its records.
+        The id of the zone is looked up by name, and is then kept in
+        the zone directory of the local state.
+        @param create: Create the zone if it doesn't exist.
+        @return: The zone, or None if it doesn't exist.
+        """
         con = self.getConnection()
-        zones = con.getZones()
-        if not self.defaultZone in zones:
+        state = self.config.state
+        zone = None
+        id = state.getZoneId(self.defaultZone)
+        if id:
+            try:
+                zone = con.getZone(id)
+            except route53.Route53Exception as e:
+                if e.code != 404:
+                    raise
+                state.removeZoneId(self.defaultZone)
+        if not zone:
+            found = con.findZone(self.defaultZone)
+            if found:
+                zone = con.getZone(found.id)
+        if zone:
+            logger.log("Using zone {0}".format(self.defaultZone))
+        elif create:
             logger.log("Creating Zone {0}".format(self.defaultZone))
             zone = con.saveZone(route53.Zone(self.defaultZone))
-        else:
-            logger.log("Using zone {0}".format(self.defaultZone))
-            zone = con.getZone(zones[self.defaultZone].id)
+        if zone:
+            state.setZoneId(self.defaultZone, zone.id, self.zoneCacheTime)
+        return zone
+
+    def updateZone(self, zone, nodes):
+        """
+        Add the records of the nodes to a zone.
+        Nodes without addresses are left out.
+        """
         for node in nodes.values():
             for ipProp,nameProp in [("internalIp", "internalDNS"), ("externalIp", "externalDNS")]:
-                if hasattr(node, ipProp) and hasattr(node, nameProp):
-                    ip =  getattr(node, ipProp)
-                    name = getattr(node, nameProp)
+                ip = getattr(node, ipProp, None)
+                name = getattr(node, nameProp, None)
+                if ip and name:
                     record = zone.getRecord(name)
-                    if not record:
-                        logger.log("Creating record {0}".format(name))
+                    if not record or ip not in record.values:
                         zone.addRecord("A", name, ip)
-                    elif ip not in record["value"]:
-                        record["value"] = [ip]
-                        zone.updateRecord(name, record)
-        con.saveZone(zone)
+
+    def plan(self, plan, snapshot, nodes):
+        """
+        Add the changes needed for the DNS records to a plan.
+        The zone of the snapshot is left as it is, so that the records of
+        each node are only saved when the node is provisioned.
+        """
+        if not snapshot.zone:
+            plan.add("zone", Change.CREATE, self.defaultZone)
+            snapshot.zone = route53.Zone(self.defaultZone)
+        zone = snapshot.zone.copy()
+        self.updateZone(zone, nodes)
+        for changes in zone.getChanges().getBatches():
+            for action, record in changes:
+                plan.add("record", Change.CREATE if action == "CREATE" else Change.DELETE, record.name, ", ".join(record.values))
+        for name, node in sorted(nodes.items()):
+            for ipProp,nameProp in [("internalIp", "internalDNS"), ("externalIp", "externalDNS")]:
+                if getattr(node, nameProp, None) and not getattr(node, ipProp, None):
+                    plan.add("record", Change.CREATE, getattr(node, nameProp), pending=True)
+
+    def provision(self, nodes, logger, zone = None):
+        """
+        Create and update the records of the nodes.
+        This can be called from several threads, to provision one node at a time.
+        @param zone: The default zone, if it has been loaded already.
+        @return: The zone.
+        """
+        con = self.getConnection()
+        state = self.config.state
+        with self.lock:
+            if not zone or not zone.id:
+                zone = self.getZone(logger, True)
+            self.updateZone(zone, nodes)
+            batch = zone.getChanges()
+            for changes in batch.getBatches():
+                for action, record in changes:
+                    logger.log("{0} record {1}".format("Creating" if action == "CREATE" else "Deleting", record.name))
+            submitted = []
+            if not self.resumed:
+                # Changes that were submitted by an interrupted run may still be propagating.
+                submitted = [id for operation in state.getOperations("dns", True) for id in operation["data"]["changes"]]
+                self.resumed = True
+            entry = state.beginOperation("dns", zone.name)
+            zone, = con.saveZones([zone])
+            changes = list(zone.changes)
+            state.completeOperation(entry, {"changes": changes})
+        if self.wait:
+            con.waitForChanges(submitted + changes)
+        return zone
+
+    def scheduleProvision(self, scheduler, nodes, logger, zone, stages):
+        """
+        Add a job for each node that is done when the records of the node
+        are saved. A node whose records are saved already is done right away.
+        The others are handed to a flusher, which waits batchDelay seconds for
+        more nodes and then saves the records of all of them in one change,
+        so that no worker waits for other nodes.
+        @param zone: The default zone, which must exist.
+        @param stages: The key of the job that each node must wait for. It
+            is replaced with the key of the DNS job of the node.
+        """
+        for name, node in sorted(nodes.items()):
+            key = ("dns", name)
+            scheduler.addExternal(key, [stages[name]] if name in stages else [], partial(self.queue, scheduler, key, node, logger, zone))
+            stages[name] = key
+
+    def isSaved(self, zone, node):
+        """
+        Check if the records of a node are saved in a zone already.
+        """
+        remote = zone.remote or route53.RecordStore()
+        for ipProp,nameProp in [("internalIp", "internalDNS"), ("externalIp", "externalDNS")]:
+            ip = getattr(node, ipProp, None)
+            name = getattr(node, nameProp, None)
+            if ip and name:
+                record = remote.get(name, "A")
+                if not record or ip not in record.values:
+                    return False
+        return True
+
+    def queue(self, scheduler, key, node, logger, zone):
+        """
+        Hand the records of a node to the flusher, starting it if it isn't waiting already.
+        """
+        if self.isSaved(zone, node):
+            scheduler.finish(key)
+            return
+        with self.queueLock:
+            self.queued[node.name] = (key, node)
+            if self.flusher is None:
+                self.flusher = threading.Timer(self.batchDelay, self.flush, [scheduler, logger, zone])
+                self.flusher.daemon = True
+                self.flusher.start()
+
+    def flush(self, scheduler, logger, zone):
+        """
+        Save the records of the queued nodes, and finish their jobs.
+        """
+        with self.queueLock:
+            queued = self.queued
+            self.queued = {}
+            self.flusher = None
+        try:
+            with tracer.span("dns", nodes=len(queued)):
+                self.provision(dict((name, node) for name, (key, node) in queued.items()), logger, zone)
+        except Exception as e:
+            for key, node in queued.values():
+                scheduler.finish(key, error=e)
+            return
+        for key, node in queued.values():
+            scheduler.finish(key)
 
     def terminate(self, nodes, logger):
         con = self.getConnection()
-        zones = con.getZones()
-        if self.defaultZone:
-            defaultZone = con.getZone(zones[self.defaultZone].id)
+        defaultZone = self.getZone(logger) if self.defaultZone else None
+        if defaultZone:
             for name, node in nodes.items():
-                if node.externalDNS and defaultZone.getRecord(node.externalDNS):
-                    defaultZone.deleteRecord(node.externalDNS)
-                if node.internalDNS and defaultZone.getRecord(node.internalDNS):
-                    defaultZone.deleteRecord(node.internalDNS)
-            con.saveZone(defaultZone)
+                for nameProp in ["externalDNS", "internalDNS"]:
+                    dnsName = getattr(node, nameProp, None)
+                    if dnsName and defaultZone.getRecord(dnsName):
+                        defaultZone.deleteRecord(dnsName)
+            con.saveZones([defaultZone], self.wait)
 
 class AWSNode():
     def __init__(self, name, definition):
@@ -136,14 +483,14 @@ class AWSNode():
             "elasticIP": False
         }
         self.name = name
-        for prop in ['image', 'securityGroup', 'size', 'diskSize', 'zone', "externalDNS", "internalDNS", "internalIp", "externalIp", "keyName", "elasticIP"]:
+        for prop in ['id', 'image', 'securityGroup', 'size', 'diskSize', 'zone', "externalDNS", "internalDNS", "internalIp", "externalIp", "keyName", "elasticIP"]:
             if prop in definition:
                 setattr(self, prop, definition[prop])
             elif prop in defaults:
                 setattr(self, prop, defaults[prop])
     def __str__(self):
         info = ""
-        for prop in ['name', 'hostname', 'image', 'securityGroup', 'size', 'diskSize', 'zone', "externalDNS", "internalDNS", "internalIp", "externalIp", "keyName"]:
+        for prop in ['name', 'id', 'hostname', 'image', 'securityGroup', 'size', 'diskSize', 'zone', "externalDNS", "internalDNS", "internalIp", "externalIp", "keyName"]:
             if hasattr(self, prop):
                 info += prop + ": " + str(getattr(self, prop)) + "\n"
         return info
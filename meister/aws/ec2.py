@@ -6,8 +6,37 @@ Created on Nov 22, 2012
 from libcloud.compute.providers import get_driver
 from libcloud.utils.xml import fixxpath, findtext, findattr, findall
 from libcloud.compute.drivers.ec2 import NAMESPACE
+from libcloud.common.types import MalformedResponseError
 from libcloud.compute.deployment import ScriptDeployment
-from libcloud.compute.drivers import ec2
+from time import sleep
+import httplib
+import socket
+import threading
+import uuid
+from urlparse import urlparse
+from functools import partial
+from limiter import getLimiter
+from meister.tracing import tracer
+
+STATUS_API_VERSION = "2012-12-01"
+STATUS_NAMESPACE = "http://ec2.amazonaws.com/doc/{0}/".format(STATUS_API_VERSION)
+# The tag that scopes instances to a meister stack.
+STACK_TAG = "meister:stack"
+# Every instance state except terminated.
+ACTIVE_STATES = ["pending", "running", "stopping", "stopped", "shutting-down"]
+
+def isRejected(error):
+    """
+    Check if an error from libcloud means that EC2 answered and turned the
+    request down, rather than that the request or its response was lost.
+    """
+    return not isinstance(error, (socket.error, httplib.HTTPException, MalformedResponseError))
+
+def isThrottled(error):
+    """
+    Check if an error from libcloud means that EC2 throttled the request.
+    """
+    return "RequestLimitExceeded" in str(error)
 
 class EC2Connection:
     """
@@ -15,12 +44,51 @@ class EC2Connection:
     which only exposes the parts of the API that we are interested in.
     """
    
-    def __init__(self, driver, ec2_id, ec2_key):
-        Driver = get_driver(driver)
-        self.conn = Driver(ec2_id, ec2_key)
+    def __init__(self, driver, ec2_id, ec2_key, stack=None, endpoint=None):
+        """
+        @param endpoint: The URL of the API, if it isn't the one of the region,
+            for instance http://127.0.0.1:8080
+        """
+        self.driver = get_driver(driver)
+        self.ec2_id = ec2_id
+        self.ec2_key = ec2_key
+        self.endpoint = endpoint
+        self.local = threading.local()
+        self.stack = stack
         self.securityGroups = None
         self.nodes = None
 
+    @property
+    def conn(self):
+        """
+        The libcloud driver of the current thread. libcloud replaces the HTTP
+        connection of a driver on every request, so threads can't share one.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            if self.endpoint:
+                url = urlparse(self.endpoint)
+                conn = self.driver(self.ec2_id, self.ec2_key, secure=url.scheme != "http", host=url.hostname, port=url.port)
+            else:
+                conn = self.driver(self.ec2_id, self.ec2_key)
+            # Every request is traced and rate limited, also the ones that libcloud makes for us.
+            conn.connection.request = partial(self.request, conn.connection.request)
+            self.local.conn = conn
+        return conn
+
+    def request(self, request, action, params=None, *args, **kwargs):
+        """
+        Make a request to the EC2 API with the libcloud connection.
+        Requests that are throttled are sent again.
+        @param request: The request method of the connection.
+        """
+        def send():
+            return request(action, params, *args, **kwargs)
+        with tracer.operation("ec2", (params or {}).get("Action", action)) as operation:
+            response = getLimiter("ec2").call(send, isThrottled, operation)
+            operation.bytes = len(response.body or "")
+            return response
+
     def getElasticIPs(self, associated=True):
         """
         Get elastic IP addresses.
@@ -34,6 +102,37 @@ class EC2Connection:
         """
         return self.conn.ex_associate_addresses(node, ip_address)
 
+    def associateAddress(self, id, ip_address):
+        """
+        Associate an elastic IP address with a node.
+        @param id: The instance id of the node.
+        """
+        params = {
+            "Action": "AssociateAddress",
+            "InstanceId": id,
+            "PublicIp": ip_address,
+        }
+        self.conn.connection.request(self.conn.path, params=params)
+
+    def describeAddresses(self, ips=None):
+        """
+        Describe elastic IP addresses.
+        @param ips: Only describe these addresses.
+        @return: A dict keyed by address, with the id of the instance the
+            address is associated with, or None if it is free.
+        """
+        params = {
+            "Action": "DescribeAddresses",
+        }
+        for i, ip in enumerate(ips or []):
+            params["PublicIp.{0}".format(i + 1)] = ip
+        object = self.conn.connection.request(self.conn.path, params=params).object
+        addresses = {}
+        for item in findall(element=object, xpath="addressesSet/item", namespace=NAMESPACE):
+            ip = findtext(element=item, xpath="publicIp", namespace=NAMESPACE)
+            addresses[ip] = findtext(element=item, xpath="instanceId", namespace=NAMESPACE) or None
+        return addresses
+
     def allocateElasticIP(self):
         """
         Allocate a new elastic IP address and return it.
@@ -48,27 +147,54 @@ class EC2Connection:
         """
         Check the status of a node.
         """
-        # We need to use a higher version of the api for this.
-        # This is a very ugly way to upgrade it, just for this method.
-        old_version = ec2.API_VERSION
-        ec2.API_VERSION = "2012-12-01"
         params = {
             "Action": "DescribeInstanceStatus",
             "InstanceId.0": node.id
         }
-        response = self.conn.connection.request(self.conn.path, params=params).object
-        def getTag(tag):
-            return "{http://ec2.amazonaws.com/doc/2012-12-01/}" + tag
-
-        systemStatus = response.find("./{0}/{1}/{2}/{3}".format(getTag("instanceStatusSet"), getTag("item"), getTag("systemStatus"), getTag("status"))).text
-
-        instanceStatus = response.find("./{0}/{1}/{2}/{3}".format(getTag("instanceStatusSet"), getTag("item"), getTag("instanceStatus"), getTag("status"))).text
-        ec2.API_VERSION = old_version
+        response = self._statusRequest(params)
+        item = findall(element=response, xpath="instanceStatusSet/item", namespace=STATUS_NAMESPACE)[0]
         return {
-            "systemStatus": systemStatus,
-            "instanceStatus": instanceStatus,
+            "systemStatus": findtext(element=item, xpath="systemStatus/status", namespace=STATUS_NAMESPACE),
+            "instanceStatus": findtext(element=item, xpath="instanceStatus/status", namespace=STATUS_NAMESPACE),
             }
-    
+
+    def getInstanceStatuses(self, ids):
+        """
+        Check the status of several instances with a single call.
+        Instances that aren't running yet are included as well.
+        @param ids: A list of instance ids.
+        @return: A dict keyed by instance id with the state, system status
+            and instance status of each instance.
+        """
+        params = {
+            "Action": "DescribeInstanceStatus",
+            "IncludeAllInstances": "true",
+        }
+        for i, id in enumerate(ids):
+            params["InstanceId.{0}".format(i + 1)] = id
+        response = self._statusRequest(params)
+        statuses = {}
+        for item in findall(element=response, xpath="instanceStatusSet/item", namespace=STATUS_NAMESPACE):
+            statuses[findtext(element=item, xpath="instanceId", namespace=STATUS_NAMESPACE)] = {
+                "state": findtext(element=item, xpath="instanceState/name", namespace=STATUS_NAMESPACE),
+                "systemStatus": findtext(element=item, xpath="systemStatus/status", namespace=STATUS_NAMESPACE),
+                "instanceStatus": findtext(element=item, xpath="instanceStatus/status", namespace=STATUS_NAMESPACE),
+            }
+        return statuses
+
+    def _statusRequest(self, params):
+        """
+        Make a request against the newer version of the API that
+        instance status checks require.
+        """
+        # The version is a setting of the connection, which only this thread uses.
+        connection = self.conn.connection
+        version = connection.version
+        connection.version = STATUS_API_VERSION
+        try:
+            return connection.request(self.conn.path, params=params).object
+        finally:
+            connection.version = version
 
     def deleteElasticIP(self, ip_address):
         """
@@ -83,31 +209,101 @@ class EC2Connection:
 
     def getNodes(self, reset = False):
         """
-        Get a list of nodes.
+        Get a dict of the nodes in this stack, keyed by name.
+        Terminated instances and instances from other stacks are
+        filtered out by AWS.
         """
-        if not self.nodes or reset:
-            # Exclude terminated instances.
-            def filterTerminated(item):
-                return item.extra["status"] != "terminated"
-            self.nodes = self.getDict(self.conn.list_nodes(), 'name', filterTerminated)
+        if self.nodes is None or reset:
+            filters = {"instance-state-name": ACTIVE_STATES}
+            if self.stack:
+                filters["tag:" + STACK_TAG] = [self.stack]
+            self.nodes = self.getDict(self.describeNodes(filters=filters), 'name')
         return self.nodes
 
+    def getNodesById(self, ids):
+        """
+        Look up nodes by their instance ids.
+        @return: A dict of nodes keyed by instance id.
+        """
+        if not ids:
+            return {}
+        return self.getDict(self.describeNodes(ids=ids))
+
+    def findNode(self, name):
+        """
+        Find a single node in this stack by name, without listing the others.
+        @return: The node, or None if it doesn't exist.
+        """
+        filters = {"instance-state-name": ACTIVE_STATES, "tag:Name": [name]}
+        if self.stack:
+            filters["tag:" + STACK_TAG] = [self.stack]
+        nodes = self.describeNodes(filters=filters)
+        return nodes[0] if nodes else None
+
+    def findUntaggedNodes(self, names):
+        """
+        Find running nodes with the given names that doesn't belong to any stack.
+        This is used to adopt nodes that were created before stack tagging.
+        """
+        if not self.stack or not names:
+            return {}
+        filters = {"instance-state-name": ACTIVE_STATES, "tag:Name": names}
+        def filterUntagged(item):
+            return not STACK_TAG in item.extra.get("tags", {})
+        return self.getDict(self.describeNodes(filters=filters), 'name', filterUntagged)
+
+    def adoptNodes(self, nodes):
+        """
+        Tag existing nodes as part of this stack.
+        """
+        self.createTags(nodes, {STACK_TAG: self.stack})
+        if self.nodes is not None:
+            for node in nodes:
+                self.nodes[node.name] = node
+
+    def describeNodes(self, ids=None, filters=None):
+        """
+        Describe instances, filtered by AWS.
+        @param ids: A list of instance ids.
+        @param filters: A dict of filter names and lists of values.
+        @return: A list of nodes.
+        """
+        params = {
+            'Action': 'DescribeInstances',
+        }
+        for i, id in enumerate(ids or []):
+            params['InstanceId.{0}'.format(i + 1)] = id
+        for i, (name, values) in enumerate(sorted((filters or {}).items())):
+            params['Filter.{0}.Name'.format(i + 1)] = name
+            for j, value in enumerate(values):
+                params['Filter.{0}.Value.{1}'.format(i + 1, j + 1)] = value
+        object = self.conn.connection.request(self.conn.path, params=params).object
+        nodes = []
+        for reservation in findall(element=object, xpath='reservationSet/item', namespace=NAMESPACE):
+            nodes += self.conn._to_nodes(reservation, 'instancesSet/item')
+        return nodes
+
     def createSecurityGroup(self, name, description):
         """
         Create a security groups
         """
         self.conn.ex_create_security_group(name, description)
-        group = EC2SecurityGroup(self.conn, name, description)
+        group = EC2SecurityGroup(self, name, description)
         return group
     
-    def getSecurityGroups(self, reset = False):
+    def getSecurityGroups(self, reset = False, names = None):
         """
         Get a list of all security groups.
+        @param names: Only get the groups with these names.
         """
         if not self.securityGroups or reset:
             params = {
                 'Action': 'DescribeSecurityGroups',
             }
+            if names is not None:
+                params['Filter.1.Name'] = 'group-name'
+                for i, name in enumerate(names):
+                    params['Filter.1.Value.{0}'.format(i + 1)] = name
             self.securityGroups = self._to_securityGroups(self.conn.connection.request(self.conn.path, params=params).object)
         return self.securityGroups
 
@@ -142,32 +338,51 @@ class EC2Connection:
         Convert a SecurityGroupInfo aws object to a python object.
         """
         group = EC2SecurityGroup(
-            self.conn,    
+            self,
             findtext(element=element, xpath='groupName',
                           namespace=NAMESPACE),
             findtext(element=element, xpath='groupDescription',
                           namespace=NAMESPACE),
         )
         for ipRule in element.findall(fixxpath(xpath='ipPermissions/item', namespace=NAMESPACE)):
-            group.addRule(
-                          findtext(element=ipRule, xpath="fromPort", namespace=NAMESPACE),
-                          findtext(element=ipRule, xpath="toPort", namespace=NAMESPACE) ,
-                          findtext(element=ipRule, xpath="ipRanges/item/cidrIp", namespace=NAMESPACE),
-                          findtext(element=ipRule, xpath="ipProtocol", namespace=NAMESPACE) ,
-                          False
-                          )
+            # A permission can have several address ranges, each one is a rule.
+            for ipRange in ipRule.findall(fixxpath(xpath="ipRanges/item", namespace=NAMESPACE)):
+                group.addRule(
+                              findtext(element=ipRule, xpath="fromPort", namespace=NAMESPACE),
+                              findtext(element=ipRule, xpath="toPort", namespace=NAMESPACE) ,
+                              findtext(element=ipRange, xpath="cidrIp", namespace=NAMESPACE),
+                              findtext(element=ipRule, xpath="ipProtocol", namespace=NAMESPACE) ,
+                              False
+                              )
         return group
 
     def createNode(self, image_id, size_id, name, size='8', securityGroup=None, zone=None, keyName=None):
         """
         Create a node on aws.
         """
+        nodes = self.createNodes(image_id, size_id, [name], size, securityGroup, zone, keyName)
+        if len(nodes) == 1:
+            return nodes[0]
+        else:
+            return nodes
+
+    def createNodes(self, image_id, size_id, names, size='8', securityGroup=None, zone=None, keyName=None, retries=2, clientToken=None):
+        """
+        Create several identical nodes on aws with a single RunInstances call.
+        A client token is sent along with the request so that retrying it
+        can never launch the nodes twice.
+        @param names: The names of the nodes, one instance is launched per name.
+        @param clientToken: The client token to use. Sending the token of an
+            earlier request returns the nodes that request launched.
+        @return: A list of nodes, in the same order as the names.
+        """
         params = {
          'Action': 'RunInstances',
          'ImageId': image_id,
-         'MinCount': '1',
-         'MaxCount': '1',
+         'MinCount': str(len(names)),
+         'MaxCount': str(len(names)),
          'InstanceType': size_id,
+         'ClientToken': clientToken or uuid.uuid4().hex,
          'BlockDeviceMapping.0.DeviceName': '/dev/sda1',
          'BlockDeviceMapping.0.Ebs.VolumeSize': str(size),
          
@@ -179,18 +394,76 @@ class EC2Connection:
         if keyName:
             params["KeyName"] = keyName
 
-        object = self.conn.connection.request(self.conn.path, params=params).object
+        tries = 0
+        while True:
+            try:
+                object = self.conn.connection.request(self.conn.path, params=params).object
+                break
+            except (socket.error, httplib.HTTPException):
+                # The client token makes it safe to send the request again.
+                if tries >= retries:
+                    raise
+                tries += 1
+                sleep(2)
         nodes = self.conn._to_nodes(object, 'instancesSet/item')
-        for node in nodes:
-            tags = {'Name': name}
+        # Match the instances to the names by their launch index.
+        launchIndexes = {}
+        for item in findall(element=object, xpath='instancesSet/item', namespace=NAMESPACE):
+            instanceId = findtext(element=item, xpath='instanceId', namespace=NAMESPACE)
+            launchIndexes[instanceId] = int(findtext(element=item, xpath='amiLaunchIndex', namespace=NAMESPACE) or 0)
+        nodes.sort(key=lambda node: launchIndexes.get(node.id, 0))
+        for name, node in zip(names, nodes):
+            node.name = name
             try:
-                self.conn.ex_create_tags(resource=node, tags=tags)
+                self.createTags([node], {'Name': name})
             except Exception:
                 continue
-        if len(nodes) == 1:
-            return nodes[0]
-        else:
-            return nodes
+        if self.stack and nodes:
+            self.createTags(nodes, {STACK_TAG: self.stack})
+        return nodes
+
+    def createTags(self, nodes, tags):
+        """
+        Add tags to several nodes with a single CreateTags call.
+        Every tag is applied to every node.
+        @param nodes: A list of nodes or instance ids.
+        @param tags: A dict of tags.
+        """
+        params = {
+            'Action': 'CreateTags',
+        }
+        for i, node in enumerate(nodes):
+            params['ResourceId.{0}'.format(i + 1)] = getattr(node, 'id', node)
+        for i, (key, value) in enumerate(tags.items()):
+            params['Tag.{0}.Key'.format(i + 1)] = key
+            params['Tag.{0}.Value'.format(i + 1)] = value
+        self.conn.connection.request(self.conn.path, params=params)
+
+    def terminateNodes(self, ids, chunkSize=500):
+        """
+        Terminate several nodes with one TerminateInstances call per chunk of ids.
+        @param ids: The instance ids of the nodes.
+        """
+        ids = list(ids)
+        for start in range(0, len(ids), chunkSize):
+            params = {
+                'Action': 'TerminateInstances',
+            }
+            for i, id in enumerate(ids[start:start + chunkSize]):
+                params['InstanceId.{0}'.format(i + 1)] = id
+            self.conn.connection.request(self.conn.path, params=params)
+        self.nodes = None
+
+    def getActiveNodeIds(self, ids):
+        """
+        Find out which of some nodes haven't been terminated yet.
+        The nodes are filtered by AWS, so ids that are gone are not an error.
+        @return: A set of instance ids.
+        """
+        if not ids:
+            return set()
+        nodes = self.describeNodes(filters={"instance-id": list(ids), "instance-state-name": ACTIVE_STATES})
+        return set(node.id for node in nodes)
 
     def destroyNode(self, node_id):
         """
@@ -210,35 +483,109 @@ class EC2Connection:
                 cloudDict[getattr(item, property)] = item
         return cloudDict
     
+class Rule(object):
+    """
+    An ingress rule of a security group.
+    Rules are normalized, so that rules from the configuration and
+    rules described by AWS compare equal and can be kept in sets.
+    """
+    __slots__ = ("fromPort", "toPort", "ip", "protocol")
+
+    def __init__(self, fromPort, toPort, ip, protocol = "tcp"):
+        self.fromPort = int(fromPort) if fromPort not in (None, "") else None
+        self.toPort = int(toPort) if toPort not in (None, "") else None
+        self.ip = ip
+        self.protocol = str(protocol or "tcp").lower()
+
+    def getKey(self):
+        return (self.protocol, self.fromPort, self.toPort, self.ip)
+
+    def __eq__(self, other):
+        return isinstance(other, Rule) and self.getKey() == other.getKey()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.getKey())
+
+    def __lt__(self, other):
+        return self.getKey() < other.getKey()
+
+    def __str__(self):
+        return "{0}:{1}-{2}".format(self.ip, self.fromPort, self.toPort)
+
+    def __repr__(self):
+        return "Rule({0!r}, {1!r}, {2!r}, {3!r})".format(self.fromPort, self.toPort, self.ip, self.protocol)
+
 class EC2SecurityGroup:
     """
     A security group
     """
     def __init__(self, con, name, description):
+        """
+        @param con: The EC2Connection to send the changes of the rules with.
+        """
         self.con = con
         self.name = name
         self.description = description
-        self.rules = []
+        self.rules = set()
     
     def addRule(self, fromPort, toPort, ip, protocol='tcp', commit=True):
         """
         Add a security rule to a group.
+        @param commit: Authorize the rule in AWS. Otherwise the rule is
+            only recorded as existing.
         """
-        rule = {
-            'fromPort': fromPort,
-            'toPort': toPort,
-            'ip': ip,
-            'protocol': protocol
-        }
-        if not rule in self.rules:
-            if commit:
-                self.con.ex_authorize_security_group(self.name, fromPort, toPort, ip, protocol)
-            self.rules.append(rule)
+        rule = Rule(fromPort, toPort, ip, protocol)
+        if commit:
+            self.authorize([rule])
+        else:
+            self.rules.add(rule)
         return self
-    
+
+    def authorize(self, rules):
+        """
+        Authorize all rules that the group doesn't have with a single call.
+        @return: The set of rules that were added.
+        """
+        missing = set(rules) - self.rules
+        if missing:
+            self.request("AuthorizeSecurityGroupIngress", missing)
+            self.rules |= missing
+        return missing
+
+    def revoke(self, rules):
+        """
+        Revoke all rules that the group has with a single call.
+        @return: The set of rules that were removed.
+        """
+        present = set(rules) & self.rules
+        if present:
+            self.request("RevokeSecurityGroupIngress", present)
+            self.rules -= present
+        return present
+
+    def request(self, action, rules):
+        """
+        Send several rules as the permissions of a single request.
+        """
+        params = {
+            "Action": action,
+            "GroupName": self.name,
+        }
+        for i, rule in enumerate(sorted(rules)):
+            prefix = "IpPermissions.{0}.".format(i + 1)
+            params[prefix + "IpProtocol"] = rule.protocol
+            if rule.fromPort is not None:
+                params[prefix + "FromPort"] = str(rule.fromPort)
+            if rule.toPort is not None:
+                params[prefix + "ToPort"] = str(rule.toPort)
+            params[prefix + "IpRanges.1.CidrIp"] = rule.ip
+        self.con.conn.connection.request(self.con.conn.path, params=params)
  
     def listRules(self):
         """
         List all available rules.
         """
-        return self.rules
+        return sorted(self.rules)
@@ -0,0 +1,663 @@
+'''
+A local fake of EC2 and Route 53, for tests and benchmarks.
+'''
+import collections
+import itertools
+import re
+import socket
+import threading
+import time
+import xml.etree.ElementTree as ET
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from email.utils import formatdate
+from urlparse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+EC2_NAMESPACE = "http://ec2.amazonaws.com/doc/{0}/"
+ROUTE53_NAMESPACE = "https://route53.amazonaws.com/doc/{0}/"
+STATE_CODES = {"pending": 0, "running": 16, "shutting-down": 32, "terminated": 48, "stopping": 64, "stopped": 80}
+
+class FakeError(Exception):
+    """
+    An error response from the fake API.
+    """
+    def __init__(self, code, message, status = 400):
+        Exception.__init__(self, message)
+        self.code = code
+        self.status = status
+
+def element(tag, *children, **text):
+    """
+    Build a piece of XML. Children are strings of XML, and the text
+    keyword is escaped.
+    """
+    body = escape(str(text["text"])) if text.get("text") is not None else "".join(children)
+    return "<{0}>{1}</{0}>".format(tag, body)
+
+def items(tag, values):
+    return element(tag, *[element("item", *value) for value in values])
+
+class FakeAWS:
+    """
+    The state of a fake AWS account, with the parts of the EC2 Query API
+    and the Route 53 REST API that meister uses.
+    Instances boot, status checks pass and DNS changes propagate after
+    configurable delays, and every call can be made to take some time.
+    All calls are counted by action.
+    """
+
+    def __init__(self, latency = 0, bootDelay = 0, statusDelay = 0, terminateDelay = 0, changeDelay = 0, maxRate = None, clock = time.time, sleep = time.sleep):
+        """
+        @param latency: The number of seconds every call takes.
+        @param bootDelay: The number of seconds before an instance is running.
+        @param statusDelay: The number of seconds after booting before the status checks pass.
+        @param terminateDelay: The number of seconds before an instance is terminated.
+        @param changeDelay: The number of seconds before a DNS change is in sync.
+        @param maxRate: The number of calls per second that each API allows.
+            Calls above the rate are throttled, like AWS does.
+        """
+        self.latency = latency
+        self.bootDelay = bootDelay
+        self.statusDelay = statusDelay
+        self.terminateDelay = terminateDelay
+        self.changeDelay = changeDelay
+        self.maxRate = maxRate
+        self.recent = {"ec2": collections.deque(), "route53": collections.deque()}
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.instances = collections.OrderedDict()
+        self.tokens = {}
+        self.groups = collections.OrderedDict()
+        self.addresses = collections.OrderedDict()
+        self.zones = collections.OrderedDict()
+        self.changes = {}
+        self.calls = collections.Counter()
+
+    def nextId(self):
+        return next(self.ids)
+
+    def getAddress(self, prefix, number):
+        return "{0}.{1}.{2}.{3}".format(prefix, number // 65536 % 256, number // 256 % 256, number % 256)
+
+    def call(self, service, action, fn, *args):
+        """
+        Count and delay a call, and run it with the state locked.
+        """
+        with self.lock:
+            self.calls[action] += 1
+            if self.maxRate:
+                now = self.clock()
+                recent = self.recent[service]
+                while recent and recent[0] <= now - 1:
+                    recent.popleft()
+                if len(recent) >= self.maxRate:
+                    self.calls["Throttled"] += 1
+                    if service == "ec2":
+                        raise FakeError("RequestLimitExceeded", "Request limit exceeded.", 503)
+                    raise FakeError("Throttling", "Rate exceeded")
+                recent.append(now)
+        if self.latency:
+            self.sleep(self.latency)
+        with self.lock:
+            return fn(*args)
+
+    # EC2
+
+    def ec2(self, params):
+        """
+        Handle an EC2 Query API request.
+        @return: The response body.
+        """
+        action = params.get("Action", "")
+        handler = getattr(self, "ec2" + action, None)
+        if not handler:
+            raise FakeError("InvalidAction", "The action {0} is not valid for this web service.".format(action))
+        body = self.call("ec2", action, handler, params)
+        namespace = EC2_NAMESPACE.format(params.get("Version", "2010-08-31"))
+        return '<?xml version="1.0" encoding="UTF-8"?><{0}Response xmlns="{1}"><requestId>{2}</requestId>{3}</{0}Response>'.format(
+            action, namespace, self.nextId(), body)
+
+    def getList(self, params, prefix):
+        """
+        Get the values of numbered parameters, like InstanceId.1 and InstanceId.2.
+        """
+        values = []
+        for i in itertools.count(1):
+            key = "{0}.{1}".format(prefix, i)
+            if not key in params:
+                # Some clients count from 0.
+                if i == 1 and "{0}.0".format(prefix) in params:
+                    values.append(params["{0}.0".format(prefix)])
+                    continue
+                return values
+            values.append(params[key])
+
+    def getFilters(self, params):
+        filters = {}
+        for i in itertools.count(1):
+            name = params.get("Filter.{0}.Name".format(i))
+            if name is None:
+                return filters
+            filters[name] = set(self.getList(params, "Filter.{0}.Value".format(i)))
+
+    def getState(self, instance):
+        """
+        Move an instance on to its next state once its delay has passed.
+        """
+        now = self.clock()
+        if instance["state"] == "pending" and now >= instance["launched"] + self.bootDelay:
+            instance["state"] = "running"
+        if instance["state"] == "shutting-down" and now >= instance["terminated"] + self.terminateDelay:
+            instance["state"] = "terminated"
+        return instance["state"]
+
+    def getInstances(self, ids):
+        instances = []
+        for id in ids:
+            if not id in self.instances:
+                raise FakeError("InvalidInstanceID.NotFound", "The instance ID '{0}' does not exist".format(id))
+            instances.append(self.instances[id])
+        return instances
+
+    def matches(self, instance, filters):
+        for name, values in filters.items():
+            if name == "instance-state-name":
+                value = self.getState(instance)
+            elif name == "instance-id":
+                value = instance["id"]
+            elif name == "client-token":
+                value = instance["clientToken"]
+            elif name == "group-name":
+                value = instance["group"]
+            elif name.startswith("tag:"):
+                value = instance["tags"].get(name[4:])
+            else:
+                raise FakeError("InvalidParameterValue", "The filter '{0}' is invalid".format(name))
+            if not value in values:
+                return False
+        return True
+
+    def instanceXML(self, instance):
+        state = self.getState(instance)
+        tags = [element("key", text=key) + element("value", text=value) for key, value in instance["tags"].items()]
+        return (element("instanceId", text=instance["id"]) +
+                element("imageId", text=instance["image"]) +
+                element("instanceState", element("code", text=STATE_CODES[state]), element("name", text=state)) +
+                element("privateDnsName", text="ip-" + instance["privateIp"].replace(".", "-") + ".internal") +
+                element("dnsName", text="ec2-" + instance["publicIp"].replace(".", "-") + ".compute.amazonaws.com") +
+                element("keyName", text=instance["keyName"]) +
+                element("amiLaunchIndex", text=instance["launchIndex"]) +
+                element("instanceType", text=instance["type"]) +
+                element("launchTime", text=time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(instance["launched"]))) +
+                element("placement", element("availabilityZone", text=instance["zone"])) +
+                element("privateIpAddress", text=instance["privateIp"]) +
+                element("ipAddress", text=instance["publicIp"]) +
+                items("groupSet", [[element("groupId", text=instance["group"]), element("groupName", text=instance["group"])]]) +
+                element("clientToken", text=instance["clientToken"]) +
+                items("tagSet", [[tag] for tag in tags]))
+
+    def reservationXML(self, reservation, instances):
+        return (element("reservationId", text=reservation) +
+                element("ownerId", text="123456789012") +
+                element("groupSet") +
+                items("instancesSet", [[self.instanceXML(instance)] for instance in instances]))
+
+    def ec2RunInstances(self, params):
+        token = params.get("ClientToken")
+        if token and token in self.tokens:
+            reservation = self.tokens[token]
+            return self.reservationXML(reservation, [instance for instance in self.instances.values() if instance["reservation"] == reservation])
+        count = int(params.get("MinCount", 1))
+        group = params.get("SecurityGroup.1", params.get("SecurityGroup.0", "default"))
+        reservation = "r-{0:08x}".format(self.nextId())
+        instances = []
+        for index in range(count):
+            number = self.nextId()
+            instance = {
+                "id": "i-{0:08x}".format(number),
+                "reservation": reservation,
+                "image": params.get("ImageId"),
+                "type": params.get("InstanceType", "m1.small"),
+                "keyName": params.get("KeyName"),
+                "zone": params.get("Placement.AvailabilityZone", "us-east-1a"),
+                "group": group,
+                "clientToken": token,
+                "launchIndex": index,
+                "launched": self.clock(),
+                "terminated": None,
+                "state": "pending",
+                "privateIp": self.getAddress("10", number),
+                "publicIp": self.getAddress("54", number),
+                "tags": collections.OrderedDict(),
+            }
+            self.instances[instance["id"]] = instance
+            instances.append(instance)
+        if token:
+            self.tokens[token] = reservation
+        return self.reservationXML(reservation, instances)
+
+    def ec2DescribeInstances(self, params):
+        ids = self.getList(params, "InstanceId")
+        instances = self.getInstances(ids) if ids else self.instances.values()
+        filters = self.getFilters(params)
+        reservations = collections.OrderedDict()
+        for instance in instances:
+            if self.matches(instance, filters):
+                reservations.setdefault(instance["reservation"], []).append(instance)
+        return items("reservationSet", [[self.reservationXML(reservation, instances)] for reservation, instances in reservations.items()])
+
+    def ec2DescribeInstanceStatus(self, params):
+        ids = self.getList(params, "InstanceId")
+        instances = self.getInstances(ids) if ids else self.instances.values()
+        statuses = []
+        for instance in instances:
+            state = self.getState(instance)
+            if state != "running" and params.get("IncludeAllInstances") != "true":
+                continue
+            if state == "running":
+                status = "ok" if self.clock() >= instance["launched"] + self.bootDelay + self.statusDelay else "initializing"
+            else:
+                status = "not-applicable"
+            statuses.append([
+                element("instanceId", text=instance["id"]),
+                element("availabilityZone", text=instance["zone"]),
+                element("instanceState", element("code", text=STATE_CODES[state]), element("name", text=state)),
+                element("systemStatus", element("status", text=status)),
+                element("instanceStatus", element("status", text=status)),
+            ])
+        return items("instanceStatusSet", statuses)
+
+    def ec2CreateTags(self, params):
+        ids = self.getList(params, "ResourceId")
+        for instance in self.getInstances(ids):
+            for i in itertools.count(1):
+                key = params.get("Tag.{0}.Key".format(i))
+                if key is None:
+                    break
+                instance["tags"][key] = params.get("Tag.{0}.Value".format(i), "")
+        return element("return", text="true")
+
+    def ec2TerminateInstances(self, params):
+        changes = []
+        for instance in self.getInstances(self.getList(params, "InstanceId")):
+            previous = self.getState(instance)
+            if previous != "terminated":
+                instance["state"] = "shutting-down"
+                instance["terminated"] = self.clock()
+                for ip, id in self.addresses.items():
+                    if id == instance["id"]:
+                        self.addresses[ip] = None
+            state = self.getState(instance)
+            changes.append([
+                element("instanceId", text=instance["id"]),
+                element("currentState", element("code", text=STATE_CODES[state]), element("name", text=state)),
+                element("previousState", element("code", text=STATE_CODES[previous]), element("name", text=previous)),
+            ])
+        return items("instancesSet", changes)
+
+    def getGroup(self, name):
+        if not name in self.groups:
+            raise FakeError("InvalidGroup.NotFound", "The security group '{0}' does not exist".format(name))
+        return self.groups[name]
+
+    def getPermissions(self, params):
+        rules = []
+        for i in itertools.count(1):
+            prefix = "IpPermissions.{0}.".format(i)
+            protocol = params.get(prefix + "IpProtocol")
+            if protocol is None:
+                break
+            ranges = []
+            for j in itertools.count(1):
+                cidr = params.get("{0}IpRanges.{1}.CidrIp".format(prefix, j))
+                if cidr is None:
+                    break
+                ranges.append(cidr)
+            for cidr in ranges:
+                rules.append((protocol, params.get(prefix + "FromPort"), params.get(prefix + "ToPort"), cidr))
+        # The older form with a single permission.
+        if not rules and "IpProtocol" in params:
+            rules.append((params["IpProtocol"], params.get("FromPort"), params.get("ToPort"), params.get("CidrIp", "0.0.0.0/0")))
+        return rules
+
+    def ec2DescribeSecurityGroups(self, params):
+        names = set(self.getList(params, "GroupName")) | self.getFilters(params).get("group-name", set())
+        groups = []
+        for name, group in self.groups.items():
+            if names and not name in names:
+                continue
+            permissions = collections.OrderedDict()
+            for protocol, fromPort, toPort, cidr in group["rules"]:
+                permissions.setdefault((protocol, fromPort, toPort), []).append(cidr)
+            groups.append([
+                element("ownerId", text="123456789012"),
+                element("groupId", text=group["id"]),
+                element("groupName", text=name),
+                element("groupDescription", text=group["description"]),
+                items("ipPermissions", [[
+                    element("ipProtocol", text=protocol),
+                    element("fromPort", text=fromPort),
+                    element("toPort", text=toPort),
+                    element("groups"),
+                    items("ipRanges", [[element("cidrIp", text=cidr)] for cidr in cidrs]),
+                ] for (protocol, fromPort, toPort), cidrs in permissions.items()]),
+            ])
+        return items("securityGroupInfo", groups)
+
+    def ec2CreateSecurityGroup(self, params):
+        name = params.get("GroupName")
+        if name in self.groups:
+            raise FakeError("InvalidGroup.Duplicate", "The security group '{0}' already exists".format(name))
+        self.groups[name] = {"id": "sg-{0:08x}".format(self.nextId()), "description": params.get("GroupDescription", ""), "rules": []}
+        return element("return", text="true") + element("groupId", text=self.groups[name]["id"])
+
+    def ec2DeleteSecurityGroup(self, params):
+        name = params.get("GroupName")
+        self.getGroup(name)
+        for instance in self.instances.values():
+            if instance["group"] == name and self.getState(instance) != "terminated":
+                raise FakeError("DependencyViolation", "resource {0} has a dependent object".format(self.groups[name]["id"]))
+        del self.groups[name]
+        return element("return", text="true")
+
+    def ec2AuthorizeSecurityGroupIngress(self, params):
+        group = self.getGroup(params.get("GroupName"))
+        for rule in self.getPermissions(params):
+            if rule in group["rules"]:
+                raise FakeError("InvalidPermission.Duplicate", "The permission '{0}' has already been authorized".format("-".join(str(part) for part in rule)))
+            group["rules"].append(rule)
+        return element("return", text="true")
+
+    def ec2RevokeSecurityGroupIngress(self, params):
+        group = self.getGroup(params.get("GroupName"))
+        for rule in self.getPermissions(params):
+            if rule in group["rules"]:
+                group["rules"].remove(rule)
+        return element("return", text="true")
+
+    def ec2AllocateAddress(self, params):
+        ip = self.getAddress("203", self.nextId())
+        self.addresses[ip] = None
+        return element("publicIp", text=ip) + element("domain", text="standard")
+
+    def ec2ReleaseAddress(self, params):
+        ip = params.get("PublicIp")
+        if not ip in self.addresses:
+            raise FakeError("InvalidAddress.NotFound", "Address '{0}' not found.".format(ip))
+        del self.addresses[ip]
+        return element("return", text="true")
+
+    def ec2AssociateAddress(self, params):
+        ip = params.get("PublicIp")
+        if not ip in self.addresses:
+            raise FakeError("InvalidAddress.NotFound", "Address '{0}' not found.".format(ip))
+        instance = self.getInstances([params.get("InstanceId")])[0]
+        if self.getState(instance) != "running":
+            raise FakeError("InvalidInstanceID", "The instance '{0}' is not in a valid state for this operation.".format(instance["id"]))
+        for other, id in self.addresses.items():
+            if id == instance["id"]:
+                self.addresses[other] = None
+        self.addresses[ip] = instance["id"]
+        instance["publicIp"] = ip
+        return element("return", text="true")
+
+    def ec2DescribeAddresses(self, params):
+        ips = set(self.getList(params, "PublicIp"))
+        return items("addressesSet", [[
+            element("publicIp", text=ip),
+            element("domain", text="standard"),
+            element("instanceId", text=id) if id else element("instanceId"),
+        ] for ip, id in self.addresses.items() if not ips or ip in ips])
+
+    # Route 53
+
+    def route53(self, method, path, body):
+        """
+        Handle a Route 53 REST API request.
+        @return: The response body.
+        """
+        url = urlparse(path)
+        parts = [part for part in url.path.split("/") if part]
+        version = parts.pop(0)
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        routes = [
+            ("POST", ["hostedzone"], "CreateHostedZone"),
+            ("GET", ["hostedzone"], "ListHostedZones"),
+            ("GET", ["hostedzonesbyname"], "ListHostedZonesByName"),
+            ("GET", ["hostedzone", None], "GetHostedZone"),
+            ("DELETE", ["hostedzone", None], "DeleteHostedZone"),
+            ("GET", ["hostedzone", None, "rrset"], "ListResourceRecordSets"),
+            ("POST", ["hostedzone", None, "rrset"], "ChangeResourceRecordSets"),
+            ("GET", ["change", None], "GetChange"),
+        ]
+        for routeMethod, pattern, action in routes:
+            if method == routeMethod and len(pattern) == len(parts) and all(part is None or part == parts[i] for i, part in enumerate(pattern)):
+                args = [part for i, part in enumerate(parts) if pattern[i] is None]
+                response = self.call("route53", action, getattr(self, "route53" + action), query, body, *args)
+                return '<?xml version="1.0" encoding="UTF-8"?><{0}Response xmlns="{1}">{2}</{0}Response>'.format(
+                    action, ROUTE53_NAMESPACE.format(version), response)
+        raise FakeError("InvalidInput", "No such resource: {0} {1}".format(method, path), 404)
+
+    def getZone(self, id):
+        if not id in self.zones:
+            raise FakeError("NoSuchHostedZone", "No hosted zone found with ID: {0}".format(id), 404)
+        return self.zones[id]
+
+    def zoneXML(self, id, zone):
+        return element("HostedZone",
+                       element("Id", text="/hostedzone/" + id),
+                       element("Name", text=zone["name"]),
+                       element("CallerReference", text=zone["callerReference"]),
+                       element("Config", element("Comment", text=zone["comment"])),
+                       element("ResourceRecordSetCount", text=len(zone["records"])))
+
+    def delegationXML(self, id):
+        return element("DelegationSet", element("NameServers", *[element("NameServer", text="ns-{0}.awsdns-{1}.com".format(i, id[-2:])) for i in range(4)]))
+
+    def changeXML(self, id):
+        status = "INSYNC" if self.clock() >= self.changes[id] + self.changeDelay else "PENDING"
+        return element("ChangeInfo",
+                       element("Id", text="/change/" + id),
+                       element("Status", text=status),
+                       element("SubmittedAt", text=time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(self.changes[id]))))
+
+    def addChange(self):
+        id = "C{0:012X}".format(self.nextId())
+        self.changes[id] = self.clock()
+        return id
+
+    def parseXML(self, body):
+        root = ET.fromstring(body)
+        # Namespaces are left out, any version of the API is accepted.
+        for node in root.iter():
+            node.tag = node.tag.rpartition("}")[2]
+        return root
+
+    def route53CreateHostedZone(self, query, body):
+        request = self.parseXML(body)
+        name = request.findtext("Name")
+        if not name.endswith("."):
+            name += "."
+        id = "Z{0:012X}".format(self.nextId())
+        zone = self.zones[id] = {
+            "name": name,
+            "callerReference": request.findtext("CallerReference"),
+            "comment": request.findtext("HostedZoneConfig/Comment") or "",
+            "records": {},
+        }
+        zone["records"][(name, "SOA")] = ("900", ("ns-0.awsdns-00.com. awsdns-hostmaster.amazon.com. 1 7200 900 1209600 86400",))
+        zone["records"][(name, "NS")] = ("172800", tuple("ns-{0}.awsdns-00.com.".format(i) for i in range(4)))
+        return self.zoneXML(id, zone) + self.changeXML(self.addChange()) + self.delegationXML(id)
+
+    def route53ListHostedZones(self, query, body):
+        ids = [id for id in self.zones.keys() if id >= query.get("marker", "")]
+        pageSize = int(query.get("maxitems", 100))
+        page, rest = ids[:pageSize], ids[pageSize:]
+        response = element("HostedZones", *[self.zoneXML(id, self.zones[id]) for id in page])
+        response += element("IsTruncated", text="true" if rest else "false")
+        if rest:
+            response += element("NextMarker", text=rest[0])
+        return response + element("MaxItems", text=pageSize)
+
+    def route53ListHostedZonesByName(self, query, body):
+        name = query.get("dnsname", "")
+        zones = sorted((zone["name"], id) for id, zone in self.zones.items() if zone["name"] >= name)
+        zones = zones[:int(query.get("maxitems", 100))]
+        return element("HostedZones", *[self.zoneXML(id, self.zones[id]) for name, id in zones])
+
+    def route53GetHostedZone(self, query, body, id):
+        return self.zoneXML(id, self.getZone(id)) + self.delegationXML(id)
+
+    def route53DeleteHostedZone(self, query, body, id):
+        zone = self.getZone(id)
+        if [key for key in zone["records"].keys() if not key[1] in ("SOA", "NS")]:
+            raise FakeError("HostedZoneNotEmpty", "The specified hosted zone contains non-required resource record sets")
+        del self.zones[id]
+        return self.changeXML(self.addChange())
+
+    def route53ListResourceRecordSets(self, query, body, id):
+        zone = self.getZone(id)
+        start = (query.get("name", ""), query.get("type", ""))
+        keys = [key for key in sorted(zone["records"].keys()) if key >= start]
+        pageSize = int(query.get("maxitems", 100))
+        page, rest = keys[:pageSize], keys[pageSize:]
+        response = element("ResourceRecordSets", *[element("ResourceRecordSet",
+            element("Name", text=name),
+            element("Type", text=type),
+            element("TTL", text=zone["records"][(name, type)][0]),
+            element("ResourceRecords", *[element("ResourceRecord", element("Value", text=value)) for value in zone["records"][(name, type)][1]]),
+        ) for name, type in page])
+        response += element("IsTruncated", text="true" if rest else "false")
+        if rest:
+            response += element("NextRecordName", text=rest[0][0]) + element("NextRecordType", text=rest[0][1])
+        return response + element("MaxItems", text=pageSize)
+
+    def route53ChangeResourceRecordSets(self, query, body, id):
+        zone = self.getZone(id)
+        records = dict(zone["records"])
+        for change in self.parseXML(body).iter("Change"):
+            recordSet = change.find("ResourceRecordSet")
+            key = (recordSet.findtext("Name"), recordSet.findtext("Type"))
+            value = (recordSet.findtext("TTL"), tuple(node.text for node in recordSet.iter("Value")))
+            # The whole batch fails if any change in it can't be made.
+            if change.findtext("Action") == "CREATE":
+                if key in records:
+                    raise FakeError("InvalidChangeBatch", "Tried to create resource record set {0} type {1} but it already exists".format(*key))
+                records[key] = value
+            else:
+                if records.get(key) != value:
+                    raise FakeError("InvalidChangeBatch", "Tried to delete resource record set {0} type {1} but it was not found".format(*key))
+                del records[key]
+        zone["records"] = records
+        return self.changeXML(self.addChange())
+
+    def route53GetChange(self, query, body, id):
+        if not id in self.changes:
+            raise FakeError("NoSuchChange", "A change with the specified change ID does not exist.", 404)
+        return self.changeXML(id)
+
+class FakeAWSHandler(BaseHTTPRequestHandler):
+    """
+    Sends requests to the EC2 or the Route 53 API of the server's FakeAWS,
+    depending on the path.
+    """
+    protocol_version = "HTTP/1.1"
+    ROUTE53_PATH = re.compile(r"^/+\d{4}-\d{2}-\d{2}/")
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_DELETE(self):
+        self.handle_request()
+
+    def handle_request(self):
+        length = int(self.headers.getheader("Content-Length") or 0)
+        body = self.rfile.read(length) if length else ""
+        aws = self.server.aws
+        try:
+            if self.ROUTE53_PATH.match(self.path):
+                response = aws.route53(self.command, self.path, body)
+            else:
+                params = dict((key, values[0]) for key, values in parse_qs(urlparse(self.path).query).items())
+                if self.command == "POST":
+                    params.update((key, values[0]) for key, values in parse_qs(body).items())
+                response = aws.ec2(params)
+            self.respond(200, response)
+        except FakeError as e:
+            if self.ROUTE53_PATH.match(self.path):
+                response = '<?xml version="1.0"?><ErrorResponse xmlns="{0}">{1}<RequestId>{2}</RequestId></ErrorResponse>'.format(
+                    ROUTE53_NAMESPACE.format("2012-02-29"),
+                    element("Error", element("Type", text="Sender"), element("Code", text=e.code), element("Message", text=str(e))),
+                    aws.nextId())
+            else:
+                response = '<?xml version="1.0"?><Response>{0}<RequestID>{1}</RequestID></Response>'.format(
+                    element("Errors", element("Error", element("Code", text=e.code), element("Message", text=str(e)))),
+                    aws.nextId())
+            self.respond(e.status, response)
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Date", formatdate(usegmt=True))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeAWSServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves a FakeAWS over plain HTTP on the local host.
+    Point the drivers at it with the endpoint setting, for instance
+    endpoint: http://127.0.0.1:8080
+    """
+    daemon_threads = True
+
+    def __init__(self, aws, port = 0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakeAWSHandler)
+        self.aws = aws
+        self.thread = None
+        # Open keep-alive connections, which are closed when the server stops.
+        self.connections = set()
+        self.connectionsLock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.connectionsLock:
+            self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.connectionsLock:
+            self.connections.discard(request)
+        HTTPServer.shutdown_request(self, request)
+
+    def getEndpoint(self):
+        return "http://{0}:{1}".format(*self.server_address)
+
+    def start(self):
+        """
+        Serve requests in a thread of its own.
+        """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+        with self.connectionsLock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
@@ -0,0 +1,121 @@
+'''
+Rate limiting of requests to AWS.
+'''
+import random
+import threading
+import time
+
+class RateLimiter:
+    """
+    A token bucket that all threads share, which keeps the requests to a
+    service within the rate that the service allows.
+    The rate adapts to the service: it grows a little while requests
+    succeed, and is halved every time the service throttles a request.
+    Throttled requests are sent again after a random delay.
+    """
+
+    def __init__(self, rate, burst, maxRate = None, minRate = 0.5, increase = 0.05, decrease = 0.5, retries = 8, delay = 0.5, maxDelay = 20, clock = time.time, sleep = time.sleep):
+        """
+        @param rate: The number of requests per second to start with.
+        @param burst: The number of requests that can be made at once.
+        @param maxRate: The highest rate to grow to. Defaults to twice the rate.
+        @param minRate: The lowest rate to back off to.
+        @param increase: How much the rate grows with every successful request.
+        @param decrease: The factor to multiply the rate with when a request is throttled.
+        @param retries: The number of times to send a throttled request again.
+        @param delay: The delay before the first retry, which doubles
+            for every retry. The actual delay is random, up to this delay.
+        @param maxDelay: The longest delay before a retry.
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self.maxRate = maxRate or self.rate * 2
+        self.minRate = minRate
+        self.increase = increase
+        self.decrease = decrease
+        self.retries = retries
+        self.delay = delay
+        self.maxDelay = maxDelay
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting until there is one.
+        Tokens are taken in the order they are asked for, a thread that
+        has to wait reserves its token before it sleeps.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + self.increase)
+
+    def throttled(self):
+        with self.lock:
+            self.rate = max(self.minRate, self.rate * self.decrease)
+            # Requests that are already waiting must not all go out at once.
+            self.tokens = min(self.tokens, 0)
+
+    def call(self, fn, isThrottled, operation = None):
+        """
+        Make a request within the rate.
+        @param fn: A function that makes the request.
+        @param isThrottled: A function that tells if an exception that fn
+            raised means that the request was throttled.
+        @param operation: The traced operation, which gets the number of retries.
+        @return: The return value of fn.
+        """
+        tries = 0
+        while True:
+            self.acquire()
+            try:
+                result = fn()
+            except Exception as e:
+                if tries >= self.retries or not isThrottled(e):
+                    raise
+                self.throttled()
+                tries += 1
+                if operation:
+                    operation.retries += 1
+                self.sleep(random.uniform(0, min(self.maxDelay, self.delay * 2 ** (tries - 1))))
+                continue
+            self.succeeded()
+            return result
+
+# Requests per second and burst sizes that the services allow.
+RATES = {
+    "ec2": (20, 50),
+    "route53": (5, 5),
+}
+
+limiters = {}
+limitersLock = threading.Lock()
+
+def getLimiter(service):
+    """
+    Get the limiter of a service, which is shared by the whole process.
+    """
+    with limitersLock:
+        if not service in limiters:
+            rate, burst = RATES[service]
+            limiters[service] = RateLimiter(rate, burst)
+        return limiters[service]
+
+def setRate(service, rate, burst = None):
+    """
+    Set the rate of a service, for instance from the configuration.
+    """
+    with limitersLock:
+        limiters[service] = RateLimiter(rate, burst or RATES[service][1])
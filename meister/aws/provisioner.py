@@ -5,127 +5,250 @@ Created on Jan 10, 2013
 '''
 import ec2
 from libcloud.compute.types import Provider
-import time
+import uuid
+from waiter import Waiter
+from addresspool import AddressPool
 
 class Provisioner:
     
     
-    def __init__(self, connection, logger):
+    def __init__(self, connection, logger, journal = None):
+        """
+        @param journal: A StateStore that operations are written to before
+            they are started, so that an interrupted run can be resumed.
+        """
         self.connection = connection
         self.logger = logger
+        self.journal = journal
     
-    def provisionSecurityGroups(self, groups, nodes = {}):
-        existingGroups = self.connection.getSecurityGroups(True)
-        for name, group in groups.items():
+    def provisionSecurityGroups(self, groups, rules, existingGroups = None):
+        """
+        Create security groups and reconcile their rules.
+        The missing rules of a group are authorized with a single call, and
+        stale rules are revoked with another one.
+        @param rules: The rules of each group, as returned by EC2Driver.getRules.
+            Stale rules are only revoked from groups without pending rules.
+        @param existingGroups: The groups that exist, if they are known already.
+        """
+        if existingGroups is None:
+            existingGroups = self.connection.getSecurityGroups(True, groups.keys())
+        for name, group in sorted(groups.items()):
             if not name in existingGroups:
                 self.logger.log("Creating security group {0}".format(name))
-                ec2Group = self.connection.createSecurityGroup(name, group["description"])
-            else:
-                ec2Group = existingGroups[name]
-            for rule in group["rules"]:
-                if rule["ip"][0] == "^":
-                    if len(nodes) == 0:
-                        continue
-                    name = rule["ip"][1:].partition(":")
-                    if nodes[name[0]]:
-                        rule["ip"] = nodes[name[0]].externalIp if len(name) < 2 or name[2] != "internal" else nodes[name[0]].internalIp
-                        rule["ip"] += "/32"
-                    else:
-                        continue
-                self.logger.log("Creating rule {0}:{1}-{2}".format(rule["ip"], rule["fromPort"], rule["toPort"]))
-                ec2Group.addRule(rule["fromPort"], rule["toPort"], rule["ip"])
+                existingGroups[name] = self.connection.createSecurityGroup(name, group["description"])
+            ec2Group = existingGroups[name]
+            desired, pending = rules.get(name, (set(), []))
+            for rule in sorted(ec2Group.authorize(desired)):
+                self.logger.log("Creating rule {0}".format(rule))
+            if not pending:
+                for rule in sorted(ec2Group.revoke(ec2Group.rules - desired)):
+                    self.logger.log("Revoking rule {0}".format(rule))
 
     def provisionNodes(self, nodes):
+        """
+        Launch the nodes that doesn't exist.
+        @return: The names of the nodes that were launched.
+        """
+        launched = []
+        # Finish launches that an earlier run requested but never saw the end of.
+        if self.journal:
+            for operation in self.journal.getOperations("launch", False):
+                data = operation["data"]
+                self.logger.log("Resuming launch of nodes {0}".format(", ".join(data["names"])))
+                self.launchNodes(nodes, data["names"], data["spec"], data["token"], operation["id"])
+                launched += data["names"]
         # Find existing nodes.
-        existingNodes = self.connection.getNodes()
-        elasticIps = self.connection.getElasticIPs(False)
+        existingNodes = self.connection.getNodes(len(launched) > 0)
+        # Group the nodes that should be created by their launch specification,
+        # so that identical nodes can be launched with a single request.
+        batches = {}
         for name, node in nodes.items():
-            # Create non-existing nodes.
             if not name in existingNodes:
-                self.logger.log("Creating node {0}".format(name))
-                createdNode = self.connection.createNode(node.image, node.size, name, node.diskSize, node.securityGroup, node.zone, node.keyName)
+                spec = tuple(getattr(node, prop, None) for prop in ["image", "size", "diskSize", "securityGroup", "zone", "keyName"])
+                batches.setdefault(spec, []).append(name)
             else:
                 self.logger.log("Node {0} already exists.".format(name))
+        for spec, names in batches.items():
+            names.sort()
+            self.logger.log("Creating nodes {0}".format(", ".join(names)))
+            self.launchNodes(nodes, names, spec)
+            launched += names
+        return launched
 
-    def deleteNodes(self, nodes):
+    def adoptNodes(self, keyNames):
         """
-        Terminate all nodes from a configuration.
+        Add nodes that were created before they were tagged with the stack,
+        so that they are not launched again.
+        Only nodes with the key pair of their definition are added. A node
+        with the same name and another key pair could belong to something
+        else, so nothing is launched until it has been renamed or tagged.
+        @param keyNames: The key pair of each node that isn't in the stack, by name.
+        @raise Exception: If an untagged node has another key pair.
+        @return: The nodes that were added.
+        """
+        untaggedNodes = self.connection.findUntaggedNodes(sorted(keyNames.keys()))
+        adopted = []
+        for name, node in sorted(untaggedNodes.items()):
+            keyName = keyNames[name]
+            if node.extra.get("keyname") != keyName:
+                raise Exception("Node {0} exists as instance {1} without the tag {2}, but it has the key pair {3} instead of {4}. Tag it with {2}={5} or rename it."
+                                .format(name, node.id, ec2.STACK_TAG, node.extra.get("keyname"), keyName, self.connection.stack))
+            self.logger.log("Adding untagged node {0} ({1}) to the stack".format(name, node.id), "warning")
+            adopted.append(node)
+        if adopted:
+            self.connection.adoptNodes(adopted)
+        return adopted
+
+    def launchNodes(self, nodes, names, spec, token = None, entry = None):
+        """
+        Launch identical nodes with a single request.
+        The request is written to the journal first. Sending it again with
+        the same client token returns the instances it launched, so a launch
+        that was interrupted can be finished without launching anything twice.
+        A request that EC2 turns down, for instance for a missing image, is
+        removed from the journal, so that the next run uses the configuration
+        it has then.
+        @param names: The names of the nodes to launch.
+        @param spec: The image, size, disk size, security group, zone and key name.
+        @param token: The client token of an earlier request.
+        @param entry: The journal entry of an earlier request.
+        @return: The launched nodes.
+        """
+        token = token or uuid.uuid4().hex
+        if self.journal and entry is None:
+            entry = self.journal.beginOperation("launch", ",".join(names), {"token": token, "names": names, "spec": list(spec)})
+        image, size, diskSize, securityGroup, zone, keyName = spec
+        try:
+            created = self.connection.createNodes(image, size, names, diskSize, securityGroup, zone, keyName, clientToken=token)
+        except Exception as e:
+            # Only a launch whose outcome is unknown is resumed.
+            if entry is not None and ec2.isRejected(e):
+                self.journal.removeOperation(entry)
+            raise
+        ids = {}
+        for node in created:
+            ids[node.name] = node.id
+            if node.name in nodes:
+                nodes[node.name].id = node.id
+        if entry is not None:
+            self.journal.completeOperation(entry, {"token": token, "names": names, "spec": list(spec), "ids": ids})
+        return created
+
+    def deleteNodes(self, nodes, groups = {}, wait = 2):
+        """
+        Terminate all nodes from a configuration, and delete its security groups.
+        The nodes are terminated with batched calls, and all of them are then
+        waited for at once. Each security group is deleted as soon as the
+        last of its nodes is gone.
+        @param groups: The security groups to delete.
         """
         existingNodes = self.connection.getNodes()
+        names = {}
         for name in nodes.keys():
             if name in existingNodes:
-                self.logger.log("Deleting node {0}".format(name))
-                existingNodes[name].destroy()
+                names[existingNodes[name].id] = name
+        existingGroups = self.connection.getSecurityGroups(True, groups.keys()) if groups else {}
+        members = {}
+        for id, name in names.items():
+            group = getattr(nodes[name], "securityGroup", None)
+            if group in existingGroups:
+                members.setdefault(group, set()).add(id)
+
+        def deleteGroup(name):
+            self.logger.log("Deleting security group {0}".format(name))
+            self.connection.deleteSecurityGroup(name)
+        for name in sorted(existingGroups.keys()):
+            if not name in members:
+                deleteGroup(name)
+        if not names:
+            return
+        self.logger.log("Deleting nodes {0}".format(", ".join(sorted(names.values()))))
+        self.connection.terminateNodes(names.keys())
         self.logger.log("Waiting for nodes to die...")
-        def waitForNodes():
-            existingNodes = self.connection.getNodes(True)
-            for name in nodes.keys():
-                if name in existingNodes:
-                    return waitForNodes()
-        waitForNodes()
+
+        def check(pending):
+            active = self.connection.getActiveNodeIds(pending)
+            return [id for id in pending if not id in active]
+
+        def onReady(id):
+            for group, ids in members.items():
+                ids.discard(id)
+                if not ids:
+                    del members[group]
+                    deleteGroup(group)
+        Waiter(check, delay=wait).wait(names.keys(), onReady)
 
     
-    def createElasticIps(self, nodes):
-        # Associate elastic IP addresses.
-        existingNodes = self.connection.getNodes(True)
-        elasticIps = self.connection.getElasticIPs(False)
-        for name, node in nodes.items():
-            if nodes[name].elasticIP and (not existingNodes[name].public_ip or existingNodes[name].public_ip[0] not in elasticIps):
-                self.logger.log("Setting up elastic IP for {0}".format(name))
-                if len(elasticIps):
-                    print "using existing ip"
-                    elasticIp = elasticIps.pop()
-                else:
-                    self.logger.log("Allocating new IP address")
-                    elasticIp = self.connection.allocateElasticIP()
-                
-                self.logger.log("Using IP {0}".format(elasticIp))
-                self.connection.associateIP(existingNodes[name], elasticIp)
-                while existingNodes[name].public_ip[0] != elasticIp:
-                    existingNodes = self.connection.getNodes(True)
-                    time.sleep(2)
-                node.externalIp = elasticIp
+    def prepareElasticIps(self, nodes, names, reserve = 0):
+        """
+        Allocate the elastic IP addresses that nodes will need, up front.
+        @param names: The names of the nodes that should get an address.
+        @param reserve: The number of free addresses to keep allocated.
+        @return: An AddressPool to pass to createElasticIp.
+        """
+        pool = AddressPool(self.connection, self.logger, self.journal, reserve)
+        pool.prepare(dict((name, getattr(nodes[name], "id", None)) for name in names))
+        return pool
 
-    def deleteSecurityGroups(self, groups):
-        existingGroups = self.connection.getSecurityGroups()
-        for name in groups.keys():
-            if name in existingGroups:
-                self.logger.log("Deleting security group {0}".format(name))
-                self.connection.deleteSecurityGroup(name)
+    def createElasticIp(self, pool, node, wait = 2):
+        """
+        Associate an elastic IP address with a running node.
+        """
+        self.logger.log("Setting up elastic IP for {0}".format(node.name))
+        node.externalIp = pool.assign({node.name: node.id}, wait)[node.name]
 
-    def verify(self, nodes, wait=10):
+    def verify(self, nodes, wait=2, names=None, onReady=None):
         """
-        Verify changes by waiting until the servers are done 
+        Verify changes by waiting until the servers are done.
+        All pending nodes are checked with a single status call per round.
+        @param names: Only wait for the nodes with these names.
+        @param onReady: Called with the name of each node as soon as it is ready.
         """
-        existingNodes = self.connection.getNodes(True)
-        for name, node in nodes.items():
-            self.verifyNode(name, node, wait)
+        waitFor = names if names is not None else nodes.keys()
+        names = {}
+        # Nodes that were just launched or found already know their ids.
+        for name in waitFor:
+            if getattr(nodes[name], "id", None):
+                names[nodes[name].id] = name
+        unknown = [name for name in waitFor if not getattr(nodes[name], "id", None)]
+        if unknown:
+            existingNodes = self.connection.getNodes(True)
+            for name in unknown:
+                if name in existingNodes:
+                    names[existingNodes[name].id] = name
+        if not names:
+            return
+        self.logger.log("Waiting for nodes {0} to be set up".format(", ".join(sorted(names.values()))))
 
-    def verifyNode(self, name, node, wait, step = None):
-        existingNodes = self.connection.getNodes(True)
-        if name in existingNodes:
-            existingNode = existingNodes[name]
-            if existingNode.extra["status"] == "running":
-                status = self.connection.checkNodeStatus(existingNode)
-                # We are good to go. Next please.
-                if status['systemStatus'] == "ok" and status['instanceStatus'] == "ok":
+        def check(pending):
+            statuses = self.connection.getInstanceStatuses(pending)
+            ready = []
+            for id in pending:
+                status = statuses.get(id)
+                # The machine is still being created in EC2.
+                if not status or status["state"] == "pending":
+                    continue
+                if status["state"] != "running":
+                    raise Exception("AWS could not start instance {0}".format(names[id]))
+                # We are good to go.
+                if status["systemStatus"] == "ok" and status["instanceStatus"] == "ok":
+                    ready.append(id)
+                # Something went horribly wrong, we can't recover from this.
+                elif status["systemStatus"] == "impaired" or status["instanceStatus"] == "impaired":
+                    raise Exception("AWS could not set up instance {0}".format(names[id]))
+            if ready:
+                existingNodes = self.connection.getNodesById(ready)
+                for id in ready:
+                    existingNode = existingNodes[id]
+                    node = nodes[names[id]]
+                    node.id = id
                     if existingNode.public_ip:
                         node.externalIp = existingNode.public_ip[0]
                         node.internalIp = existingNode.private_ip[0]
-                # The machine is booting up.
-                elif status['systemStatus'] == 'initializing' or status['instanceStatus'] == 'initializing':
-                    if step != "initializing":
-                        self.logger.log("Waiting for node {0} to be set up".format(name))
-                        step = "initializing"
-                    time.sleep(wait)
-                    return self.verifyNode(name, node, wait, step)
-                # Something went horribly wrong, we can't recover from this.
-                else:
-                    raise Exception("AWS could not set up instance {0}".format(name))
-            # The machine is being created in EC2.
-            else:
-                if step != "creating":
-                    self.logger.log("Waiting for node {0} to be started in EC2".format(name, wait))
-                    step = "creating"
-                time.sleep(wait)
-                return self.verifyNode(name, node, wait, step)
+            return ready
+
+        def ready(id):
+            self.logger.log("Node {0} is ready".format(names[id]))
+            if onReady:
+                onReady(names[id])
+        Waiter(check, delay=wait).wait(names.keys(), ready)
@@ -4,9 +4,21 @@ Created on Nov 22, 2012
 @author: fabsor
 '''
 import httplib
+import re
+import socket
+import threading
 from hashlib import sha1
 import hmac
 from base64 import b64encode
+from email.utils import formatdate, parsedate_tz, mktime_tz
+import time
+from urllib import urlencode
+from urlparse import urlparse
+from functools import partial
+from waiter import Waiter
+from limiter import getLimiter
+from meister.scheduler import TaskScheduler
+from meister.tracing import tracer
 import xml.etree.ElementTree as ET 
 
 class Route53Exception(Exception):
@@ -15,76 +27,302 @@ class Route53Exception(Exception):
     """
     def __init__(self, message, code = None):
         self.errors = []
+        # The error code of Route 53, for instance Throttling.
+        self.type = None
         self.root = ET.fromstring(message)
-        for error in self.root.iter(self.getTagName("Message")):
-            self.errors.append(error.text) 
+        # Match the messages in any version of the API.
+        for error in self.root.iter():
+            if error.tag.rpartition("}")[2] == "Message":
+                self.errors.append(error.text) 
+            elif error.tag.rpartition("}")[2] == "Code":
+                self.type = error.text
         self.code = code
 
+    def isThrottled(self):
+        return self.type in ("Throttling", "PriorRequestNotComplete")
+
+    def isExpired(self):
+        """
+        Check if the signature of the request was rejected, which happens when the local clock is off.
+        """
+        return self.type in ("SignatureDoesNotMatch", "RequestExpired") or "Signature expired" in " ".join(self.errors)
+
     def getTagName(self, name):
         return "{https://route53.amazonaws.com/doc/2012-02-29/}" + name
 
     def __str__(self):
         return "\n".join(self.errors)
 
+class HTTPSConnectionPool:
+    """
+    A thread safe pool of keep-alive HTTPS connections to a single host.
+    """
+    connectionClass = httplib.HTTPSConnection
+
+    def __init__(self, host, size = 4, timeout = 60, secure = True):
+        """
+        @param host: The host, optionally with a port, for instance route53.amazonaws.com
+        @param secure: False to use plain HTTP, for instance with a local fake of the API.
+        """
+        self.host = host
+        if not secure:
+            self.connectionClass = httplib.HTTPConnection
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Get an idle connection, or a new one if there are none.
+        @return: The connection and whether it has been used before.
+        """
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.connectionClass(self.host, timeout=self.timeout), False
+
+    def release(self, conn):
+        """
+        Put a connection back in the pool.
+        """
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def open(self, method, path, body = None, headers = {}):
+        """
+        Make a request without reading the response.
+        A connection that has been closed by the server while it was idle
+        is replaced with a new one. The request is only sent again if it
+        couldn't be sent on the old connection, or if it is a GET, since
+        other requests may already have been carried out. Pass the
+        connection and the response to finish() when the response has been read.
+        @return: The connection and the response.
+        """
+        while True:
+            conn, reused = self.acquire()
+            sent = False
+            try:
+                conn.request(method, path, body, headers)
+                sent = True
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if not reused or (sent and method != "GET"):
+                    raise
+
+    def finish(self, conn, response):
+        """
+        Put the connection back in the pool if the whole response was read,
+        and close it otherwise.
+        """
+        if response.isclosed() and not response.will_close:
+            self.release(conn)
+        else:
+            conn.close()
+
+    def request(self, method, path, body = None, headers = {}):
+        """
+        Make a request and read the whole response.
+        @return: The response and the response body.
+        """
+        conn, response = self.open(method, path, body, headers)
+        try:
+            data = response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            raise
+        self.finish(conn, response)
+        return response, data
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            conn.close()
+
+class RequestSigner:
+    """
+    Signs Route 53 requests with the local clock. If Route 53 rejects
+    a request, the clock is corrected with the time of the server.
+    """
+    # Smaller differences between the clocks are not worth a retry.
+    MAX_SKEW = 60
+
+    def __init__(self, id, key, clock = time.time):
+        self.id = id
+        self.key = key
+        self.clock = clock
+        self.skew = 0
+
+    def getHeaders(self):
+        """
+        Get the headers that sign a request made now.
+        """
+        date = formatdate(self.clock() + self.skew, usegmt=True)
+        signature = b64encode(hmac.new(self.key, date, sha1).digest())
+        return {
+            "Date": date,
+            'X-Amzn-Authorization': "AWS3-HTTPS AWSAccessKeyId={0},Algorithm=HmacSHA1,Signature={1}".format(self.id, signature)
+        }
+
+    def adjust(self, serverDate):
+        """
+        Correct the clock with the date of a rejected response.
+        @param serverDate: The Date header of the response.
+        @return: True if the clock was off, which means that the request should be sent again.
+        """
+        parsed = parsedate_tz(serverDate) if serverDate else None
+        if not parsed:
+            return False
+        skew = mktime_tz(parsed) - self.clock()
+        if abs(skew - self.skew) < self.MAX_SKEW:
+            return False
+        self.skew = skew
+        return True
+
 class Route53Connection:
     ROUTE53_ENDPOINT = "route53.amazonaws.com"
     ROUTE53_API = "2012-02-29"
+    # Lookup of zones by name requires a later version of the API.
+    ROUTE53_BY_NAME_API = "2013-04-01"
 
-    def __init__(self, id, key):
+    def __init__(self, id, key, endpoint = None):
+        """
+        @param endpoint: The URL of the API, if it isn't the default one,
+            for instance http://127.0.0.1:8080
+        """
         self.id = id
         self.key = key
         self.path = "/{0}/".format(self.ROUTE53_API);
-        conn = self.getConnection()
-        conn.request('get', "/date");
-        response = conn.getresponse()
-        self.date = response.getheader("Date", False)
-        auth = hmac.new(key, self.date, sha1)
-        self.token = b64encode(auth.digest())
-        self.headers = {
-            "Date": self.date,
-            'X-Amzn-Authorization': "AWS3-HTTPS AWSAccessKeyId={0},Algorithm=HmacSHA1,Signature={1}".format(id, self.token)
-        }
+        self.signer = RequestSigner(id, key)
+        # Connections are opened when the first request is made.
+        if endpoint:
+            url = urlparse(endpoint)
+            self.pool = HTTPSConnectionPool(url.netloc, secure=url.scheme != "http")
+        else:
+            self.pool = HTTPSConnectionPool(self.ROUTE53_ENDPOINT)
 
     def getZone(self, id):
-        conn = self.getConnection()
-        response = self.request("GET", id, conn = conn)
+        response = self.request("GET", id)
         zone = self.zoneFromResponse(response)
-        zone.records.update(self.getRecords(zone, conn))
-        conn.close()
+        zone.setRemoteRecords(self.getRecords(zone))
         return zone
 
-    def getConnection(self):
-        return httplib.HTTPSConnection(self.ROUTE53_ENDPOINT)
-
-    def request(self, method, path, body = None, conn = None, close = False):
-        if not conn:
-            conn = self.getConnection()
-            close = True
-        conn.request(method, self.path + path, body, self.headers)
-        response = conn.getresponse()
-        body = response.read()
-        if close:
-            conn.close()
-        # Something went wrong.
-        if response.status > 399:
-            raise Route53Exception(body, response.status)
+    def close(self):
+        """
+        Close all connections to Route 53.
+        """
+        self.pool.close()
+
+    def open(self, method, path, body = None):
+        """
+        Send a signed request without reading the response.
+        A request whose signature is rejected as expired while the local
+        clock is more than RequestSigner.MAX_SKEW seconds off is signed
+        with the clock of Route 53 and sent again, and so is a request that
+        is throttled, after a while. All requests in the process share one
+        rate limiter, which every request that is sent again goes through
+        as well. Pass the connection and the response to pool.finish() when
+        the response has been read.
+        @raise Route53Exception: If the request failed.
+        @return: The connection and the response.
+        """
+        with tracer.operation("route53", "{0} {1}".format(method, self.getResource(path))) as operation:
+            operation.bytes = len(body or "")
+            # The dates of the rejected responses.
+            dates = []
+            def send():
+                conn, response = self.pool.open(method, path, body, self.signer.getHeaders())
+                operation.bytes += int(response.getheader("Content-Length") or 0)
+                if response.status < 400:
+                    return conn, response
+                error = response.read()
+                self.pool.finish(conn, response)
+                dates.append(response.getheader("Date"))
+                raise Route53Exception(error, response.status)
+            limiter = getLimiter("route53")
+            isThrottled = lambda e: isinstance(e, Route53Exception) and e.isThrottled()
+            try:
+                return limiter.call(send, isThrottled, operation)
+            except Route53Exception as e:
+                if not e.isExpired() or not self.signer.adjust(dates[-1]):
+                    raise
+            operation.retries += 1
+            return limiter.call(send, isThrottled, operation)
 
+    def getResource(self, path):
+        """
+        Get the kind of resource of a request path, without ids and
+        parameters, for instance /hostedzone/{id}/rrset.
+        """
+        path = path.partition("?")[0].split("/", 2)[-1]
+        return "/" + re.sub(r"(hostedzone|change)/+[^/]+", r"\1/{id}", path.lstrip("/"))
+
+    def request(self, method, path, body = None, version = None):
+        """
+        Make a request and return the response body.
+        @param version: The API version to use, if it isn't the default one.
+        """
+        prefix = "/{0}/".format(version) if version else self.path
+        conn, response = self.open(method, prefix + path, body)
+        try:
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            raise
+        self.pool.finish(conn, response)
         return body
 
+    def iterparse(self, path, tag, page):
+        """
+        Make a GET request and parse the response incrementally.
+        Elements are thrown away once they have been handled, so that
+        memory use stays flat regardless of the size of the response.
+        @param tag: The name of the elements to yield.
+        @param page: A dict that is filled with the text of the other
+            top level elements of the response, like IsTruncated.
+        """
+        conn, response = self.open("GET", self.path + path)
+        try:
+            tagName = self.getTagName(tag)
+            stack = []
+            for event, element in ET.iterparse(response, events=("start", "end")):
+                if event == "start":
+                    stack.append(element)
+                    continue
+                stack.pop()
+                if element.tag == tagName:
+                    yield element
+                    stack[-1].remove(element)
+                elif len(stack) == 1:
+                    page[element.tag.partition("}")[2]] = element.text
+        finally:
+            self.pool.finish(conn, response)
+
 
-    def saveZone(self, zone):
+    def saveZone(self, zone, wait = False, refresh = False):
         """
         Save a zone to route 53.
-        @param name
-            The name of the domain, for example example.com.
-        @param comment
-            A comment about this zone.
-        """
-        conn = self.getConnection()
-        addChanges = []
-        deleteChanges = []
+        Only the differences between the records of the zone and the records
+        in Route 53 are sent, in as many batches as the API limits require.
+        The ids of the submitted changes are stored in zone.changes.
+        @param zone
+            The zone to save.
+        @param wait
+            Wait until the changes have propagated to all Route 53 servers.
+        @param refresh
+            Fetch the records from Route 53 even if the zone was loaded from there.
+        """
         if not zone.id:
-            identifier = "request-create-{0}-{1}".format(zone.name, self.date)
+            identifier = "request-create-{0}-{1}".format(zone.name, int(time.time()))
             request = '''<?xml version="1.0" encoding="UTF-8"?>
             <CreateHostedZoneRequest xmlns="https://route53.amazonaws.com/doc/2012-02-29/">
                <Name>{0}</Name>
@@ -93,117 +331,152 @@ class Route53Connection:
                   <Comment>{2}</Comment>
                </HostedZoneConfig>
                </CreateHostedZoneRequest>'''.format(zone.name, identifier, zone.comment)
-            zone = self.zoneFromResponse(self.request("POST", "/hostedzone", request, conn))
-            zone.records.update(self.getRecords(zone, conn))
-            records = zone.records.values()
-        else:
-            # Fetch actual records.
-            savedRecords = self.getRecords(zone, conn)
-            records = [record for name, record in zone.records.items()]
-            for name, record in savedRecords.items():
-                if not name in zone.records.keys():
-                    record["action"] = "DELETE"
-                    record["saved"] = False
-                    records.append(record)
-                # Add record for deletion if we updated.
-                if name in zone.records and not zone.records[name]["saved"]:
-                    record["action"] = "DELETE"
-                    record["saved"] = False
-                    records.append(record)
+            records = zone.records
+            zone = self.zoneFromResponse(self.request("POST", "/hostedzone", request))
+            zone.setRemoteRecords(self.getRecords(zone))
+            for record in records:
+                zone.records.add(record)
+        elif zone.remote is None or refresh:
+            zone.remote = self.getRecords(zone)
 
-        for record in records:
-            if not record["saved"] and (record["type"] == "A" or record["type"] == "CNAME"):
-                action = record["action"] if "action" in record.keys() else "CREATE"
-                resourceRecords = ''
-                for value in record["value"]:
-                    resourceRecords += "<ResourceRecord><Value>{0}</Value></ResourceRecord>".format(value)
-
-                change = """
-                    <Change>
-                        <Action>{0}</Action>
-                        <ResourceRecordSet>
-                            <Name>{1}</Name>
-                            <Type>{2}</Type>
-                            <TTL>{3}</TTL>
-                            <ResourceRecords>
-                            {4}
-                            </ResourceRecords>
-                        </ResourceRecordSet>
-                    </Change>
-                """.format(action, record["name"], record["type"], record["ttl"], resourceRecords)
-                deleteChanges.append(change) if action == "DELETE" else addChanges.append(change)
-        changes = deleteChanges + addChanges
-        if changes:
-            request = """<?xml version="1.0" encoding="UTF-8"?>
-                <ChangeResourceRecordSetsRequest xmlns="https://route53.amazonaws.com/doc/2012-02-29/">
-                <ChangeBatch>
-                  <Changes>
-                    {0}
-                  </Changes>
-                </ChangeBatch>
-                </ChangeResourceRecordSetsRequest>
-                """.format(''.join(changes))
-            self.request("POST", zone.id + "/rrset", request, conn=conn)
-            for name, record in zone.records.items():
-                record["saved"] = True
-                if "action" in record:
-                    del record["action"]
-        conn.close()
+        batch = zone.getChanges()
+        zone.changes = []
+        for changes in batch.getBatches():
+            response = self.request("POST", zone.id + "/rrset", batch.toXML(changes))
+            zone.changes.append(self.changeFromResponse(response)["id"])
+        zone.remote = zone.records.copy()
+        if wait:
+            self.waitForChanges(zone.changes)
         return zone
-    
-    def getRecords(self, zone, conn):
+
+    def saveZones(self, zones, wait = False, workers = 4):
+        """
+        Save several zones at the same time.
+        The batches for a single zone are always sent in order.
+        @return: The saved zones, in the same order.
+        """
+        scheduler = TaskScheduler(workers)
+        for i, zone in enumerate(zones):
+            scheduler.add(i, partial(self.saveZone, zone))
+        results = scheduler.run()
+        saved = [results[i] for i in range(len(zones))]
+        if wait:
+            self.waitForChanges([change for zone in saved for change in zone.changes])
+        return saved
+
+    def getChange(self, id):
+        """
+        Get the status of a change.
+        @param id: The id of the change, for instance /change/C2682N5HXP0BZ4
+        """
+        return self.changeFromResponse(self.request("GET", id))
+
+    def waitForChanges(self, ids, delay = 2):
+        """
+        Wait until changes have propagated to all Route 53 servers.
+        """
+        def check(pending):
+            return [id for id in pending if self.getChange(id)["status"] == "INSYNC"]
+        Waiter(check, delay=delay).wait(ids)
+
+    def changeFromResponse(self, response):
+        """
+        Get the id and status from a response with a ChangeInfo element.
+        """
+        changeInfo = ET.fromstring(response).find(self.getTagName("ChangeInfo"))
+        return {
+            "id": changeInfo.findtext(self.getTagName("Id")),
+            "status": changeInfo.findtext(self.getTagName("Status")),
+        }
+
+    def getRecords(self, zone):
         """
         Get records for a zone.
         @param zone: The zone to get the records for.
-        """            
-        return self.recordsFromResponse(self.request("GET", zone.id + "/rrset", conn=conn))
+        """
+        return RecordStore(self.iterRecords(zone))
+
+    def iterRecords(self, zone, pageSize = 100):
+        """
+        Iterate over all records in a zone, one page at a time.
+        @param zone: The zone to get the records for.
+        """
+        params = {"maxitems": pageSize}
+        while True:
+            page = {}
+            for recordSet in self.iterparse(zone.id + "/rrset?" + urlencode(params), "ResourceRecordSet", page):
+                yield self.recordFromResponse(recordSet)
+            if page.get("IsTruncated") != "true":
+                return
+            params["name"] = page["NextRecordName"]
+            params["type"] = page["NextRecordType"]
+            if page.get("NextRecordIdentifier"):
+                params["identifier"] = page["NextRecordIdentifier"]
+            elif "identifier" in params:
+                del params["identifier"]
 
-       
     def deleteZone(self, zone):
         # Purge all records.
-        zone.records = {}
+        zone.records = RecordStore()
         self.saveZone(zone)
         self.request("DELETE", zone.id)
         
-    def recordsFromResponse(self, response):
-        root = ET.fromstring(response).find(self.getTagName("ResourceRecordSets"))
-        records = {}
-        for recordSet in root.findall(self.getTagName("ResourceRecordSet")):
-            record = {}
-            record['name'] = recordSet.find(self.getTagName("Name")).text
-            record['type'] = recordSet.find(self.getTagName("Type")).text
-            record['ttl'] = recordSet.find(self.getTagName("TTL")).text
-            record['value'] = [value.text for value in recordSet.findall("./{0}/{1}/{2}".format(
+    def recordFromResponse(self, recordSet):
+        """
+        Convert a ResourceRecordSet element to a record.
+        """
+        return Record(
+            recordSet.findtext(self.getTagName("Name")),
+            recordSet.findtext(self.getTagName("Type")),
+            recordSet.findtext(self.getTagName("TTL")),
+            [value.text for value in recordSet.findall("./{0}/{1}/{2}".format(
                 self.getTagName("ResourceRecords"),
                 self.getTagName("ResourceRecord"),
-                self.getTagName("Value")))]
-            record['saved'] = True
-            records[record["name"]] = record
-        return records
+                self.getTagName("Value")))])
 
-    def getZones(self, limit=100):
+    def findZone(self, name):
+        """
+        Find a zone by name with a single request, without listing all zones.
+        @param name: The name of the zone, for instance example.com.
+        @return: A Zone without records, or None if there is no such zone.
         """
-        Get a list of zones.
-        @param limit
-            The limit of items to return
+        if not name.endswith("."):
+            name += "."
+        body = self.request("GET", "hostedzonesbyname?" + urlencode({"dnsname": name, "maxitems": 1}), version=self.ROUTE53_BY_NAME_API)
+        namespace = "{{https://route53.amazonaws.com/doc/{0}/}}".format(self.ROUTE53_BY_NAME_API)
+        for element in ET.fromstring(body).iter(namespace + "HostedZone"):
+            if element.findtext(namespace + "Name").lower() == name.lower():
+                return Zone(
+                    name=element.findtext(namespace + "Name"),
+                    callerReference=element.findtext(namespace + "CallerReference"),
+                    id=element.findtext(namespace + "Id"),
+                    comment=element.findtext("{0}Config/{0}Comment".format(namespace)) or '',
+                    )
+        return None
+
+    def getZones(self):
+        """
+        Get all zones.
         @return: 
-            Zone[] an array of Zone objects.
-        @todo Make sure we can support more domains than 100.
+            A dict of Zone objects, keyed by name.
         """
-        return self.zonesFromResponse(self.request("GET", "/hostedzone?maxitems={0}".format(limit)))
-        
-    def zonesFromResponse(self, result):
+        zones = {}
+        for zone in self.iterZones():
+            zones[zone.name] = zone
+        return zones
+
+    def iterZones(self, pageSize = 100):
         """
-        Convert a response from rotue 53 to a Zone object.
-        @param result
-        @return: Zone
+        Iterate over all zones, one page at a time.
         """
-        root = ET.fromstring(result) 
-        zoneObjects = {}
-        for zone in root.findall("./{0}/{1}".format(self.getTagName('HostedZones'), self.getTagName('HostedZone'))):
-            zone = self.zoneFromResponse(zone)
-            zoneObjects[zone.name] = zone
-        return zoneObjects
+        params = {"maxitems": pageSize}
+        while True:
+            page = {}
+            for zone in self.iterparse("/hostedzone?" + urlencode(params), "HostedZone", page):
+                yield self.zoneFromResponse(zone)
+            if page.get("IsTruncated") != "true":
+                return
+            params["marker"] = page["NextMarker"]
 
     def zoneFromResponse(self, result):
         """
@@ -230,6 +503,166 @@ class Route53Connection:
         return "{https://route53.amazonaws.com/doc/2012-02-29/}" + name
 
 
+class ChangeBatch:
+    """
+    Builds ChangeResourceRecordSets requests within the limits of the API.
+    Changes that are added together, like the deletion and creation that
+    replaces a record, always end up in the same request.
+    """
+    MAX_CHANGES = 100
+    MAX_RECORDS = 1000
+    MAX_VALUE_LENGTH = 32000
+
+    def __init__(self):
+        self.groups = []
+
+    def add(self, *changes):
+        """
+        Add changes that must be sent in the same request.
+        @param changes: Tuples of an action, CREATE or DELETE, and a record.
+        """
+        self.groups.append(list(changes))
+
+    def getSize(self, changes):
+        records = sum(len(record.values) for action, record in changes)
+        length = sum(len(value) for action, record in changes for value in record.values)
+        return len(changes), records, length
+
+    def getBatches(self):
+        """
+        Split the changes into batches.
+        Deletions go first, then replacements and then creations.
+        @return: A list of lists of changes.
+        """
+        def order(group):
+            if len(group) > 1:
+                return 1
+            return 0 if group[0][0] == "DELETE" else 2
+        batches = []
+        current = []
+        for group in sorted(self.groups, key=order):
+            size = self.getSize(group)
+            if size[0] > self.MAX_CHANGES or size[1] > self.MAX_RECORDS or size[2] > self.MAX_VALUE_LENGTH:
+                raise Exception("The change to {0} is too large for a single request".format(group[0][1].name))
+            total = self.getSize(current + group)
+            if current and (total[0] > self.MAX_CHANGES or total[1] > self.MAX_RECORDS or total[2] > self.MAX_VALUE_LENGTH):
+                batches.append(current)
+                current = []
+            current = current + group
+        if current:
+            batches.append(current)
+        return batches
+
+    def toXML(self, changes):
+        """
+        Create a ChangeResourceRecordSetsRequest for a batch of changes.
+        """
+        root = ET.Element("ChangeResourceRecordSetsRequest", xmlns="https://route53.amazonaws.com/doc/2012-02-29/")
+        changesElement = ET.SubElement(ET.SubElement(root, "ChangeBatch"), "Changes")
+        for action, record in changes:
+            change = ET.SubElement(changesElement, "Change")
+            ET.SubElement(change, "Action").text = action
+            recordSet = ET.SubElement(change, "ResourceRecordSet")
+            ET.SubElement(recordSet, "Name").text = record.name
+            ET.SubElement(recordSet, "Type").text = record.type
+            ET.SubElement(recordSet, "TTL").text = str(record.ttl)
+            resourceRecords = ET.SubElement(recordSet, "ResourceRecords")
+            for value in record.values:
+                ET.SubElement(ET.SubElement(resourceRecords, "ResourceRecord"), "Value").text = value
+        return '<?xml version="1.0" encoding="UTF-8"?>' + ET.tostring(root)
+
+
+class Record(object):
+    """
+    A resource record set.
+    """
+    __slots__ = ("name", "type", "ttl", "values")
+
+    def __init__(self, name, type, ttl = 120, values = ()):
+        self.name = name
+        self.type = type
+        self.ttl = int(ttl) if ttl is not None else None
+        self.values = tuple(values)
+
+    def getKey(self):
+        return (self.name, self.type)
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and self.getKey() == other.getKey() and self.ttl == other.ttl and sorted(self.values) == sorted(other.values)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "Record({0!r}, {1!r}, {2!r}, {3!r})".format(self.name, self.type, self.ttl, list(self.values))
+
+
+class RecordStore:
+    """
+    Records indexed by name and type.
+    """
+
+    def __init__(self, records = ()):
+        self.records = {}
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        """
+        Add a record, replacing any record with the same name and type.
+        """
+        self.records[record.getKey()] = record
+        return record
+
+    def get(self, name, type):
+        return self.records.get((name, type))
+
+    def remove(self, name, type):
+        del self.records[(name, type)]
+
+    def getByName(self, name):
+        return [record for key, record in self.records.items() if key[0] == name]
+
+    def copy(self):
+        store = RecordStore()
+        store.records = dict(self.records)
+        return store
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def __len__(self):
+        return len(self.records)
+
+
+def diffRecords(remote, desired, ignore = lambda record: False):
+    """
+    Compute the smallest set of changes that turns the remote records into
+    the desired records. Changed records are replaced with a deletion and a
+    creation that are sent together.
+    @param remote: A RecordStore with the records in Route 53.
+    @param desired: A RecordStore with the records we want.
+    @param ignore: A function that returns True for records that shouldn't be touched.
+    @return: A ChangeBatch.
+    """
+    batch = ChangeBatch()
+    for record in desired:
+        if ignore(record):
+            continue
+        old = remote.get(record.name, record.type)
+        if old is None:
+            batch.add(("CREATE", record))
+        elif old != record:
+            batch.add(("DELETE", old), ("CREATE", record))
+    for old in remote:
+        if not old.getKey() in desired and not ignore(old):
+            batch.add(("DELETE", old))
+    return batch
+
+
 class Zone:
     RECORDTYPE_A = "A"
     RECORDTYPE_CNAME = "CNAME"
@@ -243,30 +676,56 @@ class Zone:
         self.callerReference = callerReference
         self.comment = comment
         self.nameservers = []
-        self.records = {}
+        self.records = RecordStore()
+        # The records in Route 53, if they are known.
+        self.remote = None
+        self.changes = []
         
     def addNameServer(self, name):
         self.nameservers.append(name)
+
+    def setRemoteRecords(self, records):
+        """
+        Set the records that are stored in Route 53.
+        """
+        self.remote = records
+        self.records = records.copy()
+
+    def copy(self):
+        """
+        Copy the zone, so that records can be changed without changing this zone.
+        """
+        zone = Zone(self.name, self.comment, self.callerReference, self.id)
+        zone.nameservers = list(self.nameservers)
+        zone.records = self.records.copy()
+        zone.remote = self.remote
+        return zone
     
-    def getRecord(self, name):
-        return self.records[name] if name in self.records else None
+    def getRecord(self, name, type = RECORDTYPE_A):
+        return self.records.get(name, type)
 
-    def addRecord(self, type, name, value, ttl = 120, saved = False):
-        if not isinstance(value, list):
+    def addRecord(self, type, name, value, ttl = 120):
+        """
+        Add a record, or replace the record with the same name and type.
+        """
+        if not isinstance(value, (list, tuple)):
             value = [value]
-        record = {
-            "type": type,
-            "name": name,
-            "ttl": ttl,
-            "value": value,
-            "saved": saved
-        }
-        self.records[name] = record
-        return record
+        return self.records.add(Record(name, type, ttl, value))
 
-    def updateRecord(self, name, record):
-        record["saved"] = False
-        self.records[name] = record
+    def deleteRecord(self, name, type = RECORDTYPE_A):
+        self.records.remove(name, type)
 
-    def deleteRecord(self, name):
-        del self.records[name]
+    def isManaged(self, record):
+        """
+        Check if a record can be changed. The SOA and NS records of
+        the zone itself and alias records are left alone.
+        """
+        if record.type == "SOA" or (record.type == "NS" and record.name == self.name):
+            return False
+        return bool(record.values)
+
+    def getChanges(self):
+        """
+        Get the changes needed to save the zone.
+        """
+        return diffRecords(self.remote or RecordStore(), self.records, lambda record: not self.isManaged(record))
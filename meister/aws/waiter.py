@@ -0,0 +1,65 @@
+'''
+Polling until things are done, with backoff.
+'''
+import random
+import time
+
+class WaiterTimeout(Exception):
+    """
+    Raised when the things we are waiting for aren't ready in time.
+    """
+    def __init__(self, pending):
+        Exception.__init__(self, "Timed out waiting for {0}".format(", ".join(str(key) for key in pending)))
+        self.pending = pending
+
+class Waiter:
+    """
+    Polls for the readiness of many things at once.
+    Every round checks all pending keys with a single call, and the
+    delay between rounds backs off exponentially with some jitter.
+    """
+
+    def __init__(self, check, delay=2, maxDelay=30, timeout=1800, jitter=0.5, sleep=time.sleep, clock=time.time):
+        """
+        @param check: A function that takes a list of pending keys and
+            returns the keys that are ready. It may raise an exception
+            if something can never become ready.
+        @param delay: The initial delay between rounds, in seconds.
+        @param maxDelay: The maximum delay between rounds.
+        @param timeout: Give up after this many seconds.
+        @param jitter: The fraction of the delay to randomize.
+        """
+        self.check = check
+        self.delay = delay
+        self.maxDelay = maxDelay
+        self.timeout = timeout
+        self.jitter = jitter
+        self.sleep = sleep
+        self.clock = clock
+
+    def wait(self, keys, onReady=None):
+        """
+        Wait until all keys are ready.
+        @param keys: The keys to wait for.
+        @param onReady: Called with each key as soon as it is ready.
+        @return: The number of rounds that were needed.
+        """
+        pending = list(keys)
+        delay = self.delay
+        deadline = self.clock() + self.timeout
+        rounds = 0
+        while pending:
+            rounds += 1
+            ready = self.check(list(pending))
+            for key in ready:
+                if key in pending:
+                    pending.remove(key)
+                    if onReady:
+                        onReady(key)
+            if not pending:
+                break
+            if self.clock() >= deadline:
+                raise WaiterTimeout(pending)
+            self.sleep(delay * (1 + random.uniform(-self.jitter, self.jitter)))
+            delay = min(delay * 2, self.maxDelay)
+        return rounds
@@ -0,0 +1,126 @@
+'''
+Benchmark of the commands against the local fake of AWS.
+'''
+import os
+import shutil
+import sys
+import time
+import yaml
+from argparse import ArgumentParser
+from tempfile import mkdtemp
+from aws.fake import FakeAWS, FakeAWSServer
+
+class QuietLogger:
+    """
+    Swallows the output of the commands, so that only the results are shown.
+    """
+    def log(self, message, type = "notice"):
+        pass
+
+    def logMessage(self, message):
+        pass
+
+def writeConfig(directory, endpoint, size):
+    """
+    Write a configuration with size nodes that uses the fake API.
+    @return: The path of the meister.yml file.
+    """
+    data = {
+        "driver": {
+            "name": "aws",
+            "id": "benchmark",
+            "key": "benchmark",
+            "region": "eu-west-1",
+            "defaultZone": "eu-west-1a",
+            "defaultSecurityGroup": "benchmark",
+            "defaultKeyName": "benchmark",
+            "stack": "benchmark",
+            "endpoint": endpoint,
+        },
+        "DNS": {
+            "name": "route53",
+            "id": "benchmark",
+            "key": "benchmark",
+            "defaultZone": "benchmark.example.com.",
+            "wait": True,
+            "endpoint": endpoint,
+        },
+        "securityGroups": {
+            "benchmark": {
+                "description": "Benchmark group",
+                "rules": [
+                    {"ip": "0.0.0.0/0", "fromPort": 22, "toPort": 22},
+                    {"ip": "^node-1", "fromPort": 8080, "toPort": 8080},
+                ],
+            },
+        },
+        "nodes": {
+            "node": {
+                "count": size,
+                "size": "t1.micro",
+                "image": "ami-c1aaabb5",
+                "externalDNS": "node{index}.benchmark.example.com.",
+            },
+            "gateway": {
+                "size": "t1.micro",
+                "image": "ami-c1aaabb5",
+                "externalDNS": "gateway.benchmark.example.com.",
+                "elasticIP": True,
+            },
+        },
+    }
+    path = os.path.join(directory, "meister.yml")
+    with open(path, "w") as configFile:
+        yaml.dump(data, configFile, default_flow_style=False)
+    return path
+
+def run(size, commands, latency = 0.05, bootDelay = 5, changeDelay = 2, maxRate = None):
+    """
+    Run commands against a fresh fake of AWS.
+    Every command reads the configuration again, like a separate
+    invocation of meister would.
+    @return: A list of the command, the wall clock time and the calls
+        made to the API, for each command.
+    """
+    from config import YamlConfig
+    aws = FakeAWS(latency=latency, bootDelay=bootDelay, statusDelay=bootDelay, terminateDelay=bootDelay, changeDelay=changeDelay, maxRate=maxRate)
+    server = FakeAWSServer(aws).start()
+    directory = mkdtemp(prefix="meister-benchmark")
+    try:
+        path = writeConfig(directory, server.getEndpoint(), size)
+        results = []
+        for command in commands:
+            with aws.lock:
+                aws.calls.clear()
+            start = time.time()
+            getattr(YamlConfig(path), command)(QuietLogger())
+            elapsed = time.time() - start
+            with aws.lock:
+                results.append((command, elapsed, dict(aws.calls)))
+        return results
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+def report(size, results, out = sys.stdout):
+    out.write("{0} nodes\n".format(size))
+    out.write("{0:<12} {1:>10} {2:>8}  {3}\n".format("command", "seconds", "calls", "calls by action"))
+    for command, elapsed, calls in results:
+        actions = ", ".join("{0}={1}".format(action, count) for action, count in sorted(calls.items()))
+        out.write("{0:<12} {1:>10.2f} {2:>8}  {3}\n".format(command, elapsed, sum(calls.values()), actions))
+    out.write("\n")
+
+def main(argv = None):
+    parser = ArgumentParser(description="Time meister commands against a local fake of EC2 and Route 53.")
+    parser.add_argument("sizes", help="The numbers of nodes to benchmark with", type=int, nargs="*", default=[10, 100, 1000])
+    parser.add_argument("--latency", help="Seconds every API call takes", type=float, default=0.05)
+    parser.add_argument("--boot-delay", help="Seconds before instances are running and again before they pass the status checks", type=float, default=5)
+    parser.add_argument("--change-delay", help="Seconds before DNS changes are in sync", type=float, default=2)
+    parser.add_argument("--max-rate", help="Calls per second that each API allows before it throttles", type=int)
+    args = parser.parse_args(argv)
+    for size in args.sizes:
+        results = run(size, ["provision", "info", "terminate"], args.latency, args.boot_delay, args.change_delay, args.max_rate)
+        report(size, results)
+
+if __name__ == "__main__":
+    main()
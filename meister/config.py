@@ -3,155 +3,609 @@
 @author: fabsor
 '''
 import sys;
-from os.path import isfile, dirname, isdir
+from os.path import isfile, dirname, isdir, join, basename
 import os
+import cPickle
+import hashlib
 import yaml
-from aws.driver import EC2Driver
-from aws.driver import Route53Driver
-from deploy import Deployer
+from scheduler import TaskScheduler
+from state import StateStore
+from plan import Plan
+from tempfile import mkstemp
 import time
+import threading
+import Queue
+from fnmatch import fnmatch
+from functools import partial
+from tracing import tracer
+
+# The C loader is much faster on large configurations, if libyaml is available.
+YamlLoader = getattr(yaml, "CLoader", yaml.Loader)
 
 class Config:
+    # Drivers are only imported when a command needs them,
+    # since they pull in libcloud and the AWS clients.
     drivers = {
-        "aws": EC2Driver
+        "aws": "aws.driver.EC2Driver"
     }
     
     DNSDrivers = {
-        "route53": Route53Driver
+        "route53": "aws.driver.Route53Driver"
     }
 
     def getNodes(self):
+        """
+        Get the nodes, with the live state of the ones that exist.
+        The nodes are built the first time they are needed.
+        """
+        if not self.nodesBuilt:
+            for name in self.definitions.keys():
+                self.getNode(name)
+            self.nodesBuilt = True
         return self.nodes
 
+    def getNode(self, name):
+        """
+        Get a single node, building only that node if it hasn't been built.
+        """
+        if not name in self.nodes:
+            self.nodes[name] = self.buildNode(name, self.definitions[name])
+        return self.nodes[name]
+
     def getDriver(self):
+        if not self.driver:
+            self.driver = self.createDriver(self.drivers, self.data['driver']['name'])
         return self.driver
 
     def getDNSDriver(self):
+        if not self.DNSDriver and "DNS" in self.data:
+            self.DNSDriver = self.createDriver(self.DNSDrivers, self.data['DNS']['name'])
         return self.DNSDriver
 
+    def getSecurityGroups(self):
+        return self.getDriver().getSecurityGroups()
+
+    def createDriver(self, drivers, name):
+        """
+        Import a driver and create it.
+        @param drivers: A dict of drivers, as classes or as dotted class names.
+        """
+        driver = drivers[name]
+        if isinstance(driver, basestring):
+            module, className = driver.rsplit(".", 1)
+            driver = getattr(__import__(module, globals(), locals(), [className]), className)
+        return driver(self, self.data)
+
+    def getTasksModule(self):
+        """
+        Get the module with the tasks, importing it the first time.
+        """
+        if self.tasksModule is None and "tasksModule" in self.data:
+            self.tasksModule = __import__(self.data["tasksModule"])
+        return self.tasksModule
+
 class YamlConfig(Config):
     '''
     Parses and makes configuration accessible.
     '''
+    # The format of the compiled configuration cache.
+    COMPILED_VERSION = 1
+
     def __init__(self, configFile):
         self.configFile = configFile
         self.basedir = dirname(configFile)
         sys.path.append(self.basedir)
-        self.statusFile = "{0}/{1}".format(self.basedir, "meister")
+        self.state = StateStore(join(self.basedir, ".meister.db"))
+        self.driver = None
         self.DNSDriver = None
+        self.tasksModule = None
+        self.nodes = {}
+        self.nodesBuilt = False
         self.parse()
 
+    def getPlan(self, logger):
+        """
+        Compare the configuration with the live state.
+        @return: The plan and the snapshot of the live state it is based on.
+        """
+        with tracer.span("plan"):
+            driver = self.getDriver()
+            DNSDriver = self.getDNSDriver()
+            snapshot = driver.getSnapshot()
+            plan = Plan()
+            driver.plan(plan, snapshot)
+            if DNSDriver:
+                snapshot.zone = DNSDriver.getZone(logger)
+                DNSDriver.plan(plan, snapshot, self.getNodes())
+        return plan, snapshot
+
+    def plan(self, logger):
+        plan, snapshot = self.getPlan(logger)
+        logger.logMessage(str(plan))
+
     def provision(self, logger):
-        status = {}
-        if isfile(self.statusFile):
-            status = yaml.load(open(self.statusFile).read())
-        self.driver.provision(logger)
-        if self.DNSDriver:
-            self.DNSDriver.provision(self.getNodes(), logger)
+        """
+        Provision the configuration. Every node moves through its own
+        pipeline: it is launched, waited for, gets its elastic IP and DNS
+        records, and then runs its tasks, without waiting for other nodes
+        unless it depends on them. The DNS records of nodes that are ready
+        at about the same time are saved together.
+        Every operation is written to the journal in the local state, and
+        the journal is cleared once the whole run has succeeded. A run that
+        was interrupted is resumed from the journal, reusing the instances
+        and addresses it created.
+        """
+        if self.state.getOperations():
+            logger.log("Resuming an interrupted provisioning run.")
+        self.getDriver().adoptNodes(logger)
+        plan, snapshot = self.getPlan(logger)
+        scheduler = TaskScheduler(self.data.get("taskWorkers", 10))
+        stages = self.getDriver().provision(logger, plan, snapshot, scheduler)
+        DNSDriver = self.getDNSDriver()
+        if DNSDriver:
+            zone = snapshot.zone if snapshot.zone and snapshot.zone.id else DNSDriver.getZone(logger, True)
+            DNSDriver.scheduleProvision(scheduler, self.getNodes(), logger, zone, stages)
         # Run tasks
-        if self.tasksModule:
+        if self.getTasksModule():
             logger.log("Running tasks.")
-            nodes = self.getNodes().items()
-            # Create a host list that can be used by fabric scripts.
-            hostList = {}
-            for name, node in nodes:
-                hostList[name] = node.externalIp
+            self.runTasks(logger, scheduler, stages)
+        else:
+            scheduler.run()
+        self.updateInventory()
+        self.state.clearJournal()
+
+    def runTasks(self, logger, scheduler = None, stages = {}):
+        """
+        Run the tasks of all nodes on a pool of workers.
+        The tasks of a node run in order, and a task can also wait for tasks
+        on other nodes with the after property, for instance
+        after: mgmt:install_puppet_master. Nodes that doesn't declare any
+        dependencies wait for all tasks on the management server.
+        @param scheduler: A scheduler with other jobs to run along with the tasks.
+        @param stages: The key of the job that each node must wait for
+            before its tasks can start.
+        """
+        nodes = self.getNodes()
+        # Create a host list that can be used by fabric scripts.
+        # It is filled in as the nodes get their addresses.
+        hostList = {}
+        for name, node in nodes.items():
+            hostList[name] = getattr(node, "externalIp", None)
+
+        # Tasks that are known to be done locally doesn't need a connection to the node.
+        completed = {}
+        pending = {}
+        for name, node in nodes.items():
+            if node.user:
+                instance = getattr(node, "id", None)
+                completed[name] = set(self.state.taskKey(task) for task in self.state.getCompletedTasks(name, instance)) if instance else set()
+                pending[name] = [task for task in node.tasks if not self.state.taskKey(task) in completed[name]]
+
+        # The deployers start their processes right away, before any worker threads exist.
+        # Each of them runs the tasks of one node at a time, at the address the node has then.
+        from deploy import DeployerPool
+        pool = DeployerPool(min(self.data.get("taskWorkers", 10), len([name for name in pending if pending[name]])), hostList)
+        try:
+            if scheduler is None:
+                scheduler = TaskScheduler(self.data.get("taskWorkers", 10))
+            lastTasks = {}
+            taskKeys = {}
+            for name in sorted(completed.keys()):
+                lastTasks[name] = self.scheduleTasks(scheduler, logger, nodes[name], pool, completed[name], pending[name], taskKeys)
+                if lastTasks[name] and name in stages:
+                    key = ("connect", name)
+                    scheduler.add(key, tracer.wrap("connect", partial(self.connectNode, nodes, hostList), node=name), [stages[name]])
+                    scheduler.require(("task", name, 0), key)
+            # Tasks can wait for tasks on nodes that were added after them.
+            for name in sorted(lastTasks.keys()):
+                for index, task in enumerate(nodes[name].tasks):
+                    after = task.get("after", []) if isinstance(task, dict) else []
+                    for required in (after if isinstance(after, list) else [after]):
+                        scheduler.require(("task", name, index), taskKeys.get(required, required))
 
             # Always take the management server first, if it is available.
             # This is necessary since the other nodes could depend on the management server being in place.
-            if "managementServer" in self.data:
-                mgmt = self.data["managementServer"]
-                def sortNodes(item1, item2):
-                    if item1[0] == mgmt:
-                        return -1
-                    return 0
-                nodes = sorted(nodes, sortNodes)
-
-            for name, node in nodes:
-                if node.user:
-                    logger.log("Running tasks for {0}".format(name))
-                    deployer = Deployer(node.externalIp, username=node.user, keyFile=node.keyFile, hostList = hostList)
-                    meisterFile = "/home/{0}/.meister".format(node.user)
-                    status = self.getTaskStatus(deployer, logger, meisterFile)
-                    # Filter out tasks that has already been run.
-                    tasks = filter(lambda task: task not in status["tasks"], node.tasks)
-                    for task in tasks:
-                        if isinstance(task, dict):
-                            taskFnName = task["name"]
-                            args = task["arguments"]
-                        else:
-                            taskFnName = task
-                            args = []
-                        taskFn = getattr(self.tasksModule, taskFnName, None)
-                        if taskFn:
-                            deployer.runTask(taskFn, args)
-                            status["tasks"].append(task)
-                            self.putTaskStatus(status, deployer, logger, meisterFile)
-
-    def task(self, logger, nodeName, task):
-        nodes = self.getNodes()
-        if not nodeName in nodes:
-            logger.log("Node {0} does not exist.".format(nodeName), "error")
-            return
-        taskFn = getattr(self.tasksModule, task, None)
+            mgmt = self.data.get("managementServer")
+            if mgmt in lastTasks and lastTasks[mgmt]:
+                for name, node in nodes.items():
+                    if name != mgmt and name in lastTasks and node.tasks and not self.getTaskDependencies(node.tasks):
+                        scheduler.require(("task", name, 0), lastTasks[mgmt])
+            scheduler.run()
+        finally:
+            pool.close()
+
+    def connectNode(self, nodes, hostList):
+        """
+        Point the host list at the addresses that the nodes have now.
+        """
+        for name, node in nodes.items():
+            hostList[name] = getattr(node, "externalIp", None)
+
+    def scheduleTasks(self, scheduler, logger, node, pool, completed, pending, taskKeys):
+        """
+        Add the tasks of a node to a scheduler. Every task gets its own job,
+        even if the node runs a task with the same name more than once.
+        @param pool: The deployers to run the tasks with.
+        @param completed: The keys of the tasks that are known to be done.
+        @param pending: The tasks that might not be done.
+        @param taskKeys: Gets the key of the job of each task by name, for
+            instance mgmt:install_puppet_master, so that other tasks can wait
+            for it. A task that is run more than once is done after its last run.
+        @return: The key of the last task of the node.
+        """
+        progress = {
+            "meisterFile": "/home/{0}/.meister".format(node.user),
+            "status": None,
+            "changed": False,
+            "last": pending[-1] if pending else None,
+        }
+        previous = None
+        for index, task in enumerate(node.tasks):
+            key = ("task", node.name, index)
+            scheduler.add(key, tracer.wrap("task", self.taskJob(logger, node, pool, task, completed, progress), node=node.name, task=self.getTaskName(task)), [previous] if previous else [])
+            taskKeys["{0}:{1}".format(node.name, self.getTaskName(task))] = key
+            previous = key
+        return previous
+
+    def taskJob(self, logger, node, pool, task, completed, progress):
+        """
+        Create a job that runs a task on a node, unless it has been run already.
+        The status file on the node is only read if the local state doesn't
+        know that the task is done, and it is written once when the node is done.
+        A deployer is only taken from the pool if the job has to connect to the node.
+        @param completed: The keys of the completed tasks, shared by all jobs of the node.
+        @param progress: The task status of the node, shared by all jobs of the node.
+        """
+        def job():
+            # New nodes get their instance id and address while the jobs are running.
+            instance = getattr(node, "id", None)
+            key = self.state.taskKey(task)
+            if key in completed and not (progress["changed"] and task is progress["last"]):
+                return
+            with pool.use(getattr(node, "externalIp", None), username=node.user, keyFile=node.keyFile) as deployer:
+                try:
+                    if not key in completed and progress["status"] is None:
+                        progress["status"] = self.getTaskStatus(deployer, logger, progress["meisterFile"])
+                        completed.update(self.state.taskKey(item) for item in progress["status"]["tasks"])
+                        if instance:
+                            self.state.addCompletedTasks(node.name, instance, progress["status"]["tasks"])
+                    if not key in completed:
+                        self.runNodeTask(logger, node, deployer, task)
+                        progress["status"]["tasks"].append(task)
+                        progress["changed"] = True
+                        completed.add(key)
+                        if instance:
+                            self.state.addCompletedTasks(node.name, instance, [task])
+                except:
+                    if progress["changed"]:
+                        self.putTaskStatus(progress["status"], deployer, logger, progress["meisterFile"])
+                    raise
+                if progress["changed"] and task is progress["last"]:
+                    self.putTaskStatus(progress["status"], deployer, logger, progress["meisterFile"])
+                    progress["changed"] = False
+        return job
+
+    def runNodeTask(self, logger, node, deployer, task):
+        if isinstance(task, dict):
+            taskFnName = task["name"]
+            args = task.get("arguments", [])
+        else:
+            taskFnName = task
+            args = []
+        taskFn = getattr(self.getTasksModule(), taskFnName, None)
+        if not taskFn:
+            logger.log("Task {0} does not exist.".format(taskFnName), "error")
+            raise Exception("Task {0} does not exist".format(taskFnName))
+        logger.log("Running task {0} on {1}".format(taskFnName, node.name))
+        deployer.runTask(taskFn, args)
+
+    def getTaskName(self, task):
+        return task["name"] if isinstance(task, dict) else task
+
+    def getTaskDependencies(self, tasks):
+        return [task["after"] for task in tasks if isinstance(task, dict) and "after" in task]
+
+    def task(self, logger, selector, task):
+        """
+        Run a task on the selected nodes.
+        @param selector: The nodes to run the task on, see selectNodes.
+        @return: 0 if the task succeeded on all nodes.
+        """
+        taskFn = getattr(self.getTasksModule(), task, None)
         if not taskFn:
             logger.log("Task {0} does not exist.".format(task), "error")
-            return;
+            return 1
+        def runTask(deployer):
+            result = deployer.runTask(taskFn)
+            return ("" if result is None else str(result)), 0
+        return self.fanOut(logger, selector, runTask)
+
+    def execute(self, logger, selector, command):
+        """
+        Run a shell command on the selected nodes.
+        @param selector: The nodes to run the command on, see selectNodes.
+        @return: The highest exit status of the command.
+        """
+        return self.fanOut(logger, selector, lambda deployer: deployer.execute(command))
 
-        node = nodes[nodeName]
-        deployer = Deployer(node.externalIp, username=node.user, keyFile=node.keyFile)
-        deployer.runTask(taskFn)
+    def selectNodes(self, selector):
+        """
+        Get the names of the nodes that a selector matches.
+        @param selector: Comma separated node names, security groups or
+            glob patterns, for instance app-*,mgmt
+        @return: The names, sorted.
+        """
+        defaultGroup = self.data.get("driver", {}).get("defaultSecurityGroup")
+        names = set()
+        for pattern in selector.split(","):
+            for name, definition in self.definitions.items():
+                if fnmatch(name, pattern) or definition.get("securityGroup", defaultGroup) == pattern:
+                    names.add(name)
+        return sorted(names)
+
+    def fanOut(self, logger, selector, fn):
+        """
+        Run something on the selected nodes, a few nodes at a time.
+        The output of each node is shown as soon as the node is done,
+        prefixed with the name of the node. Output that is the same as
+        the output of a node that was already shown is only shown once.
+        @param fn: A function that takes the deployer of a node, and
+            returns the output and the exit status.
+        @return: The highest exit status. Nodes that can't be reached count as 255.
+        """
+        from deploy import Deployer
+        names = self.selectNodes(selector)
+        if not names:
+            logger.log("No nodes match {0}.".format(selector), "error")
+            return 1
+        workers = min(self.data.get("taskWorkers", 10), len(names))
+        # The deployers start their processes before any worker threads exist.
+        # Each of them serves one node at a time.
+        idle = Queue.Queue()
+        deployers = [Deployer(None, isolated=True) for i in range(workers)]
+        for deployer in deployers:
+            idle.put(deployer)
+        results = {}
+        shown = {}
+        lock = threading.Lock()
+        def run(name):
+            try:
+                output, status = self.runOnNode(logger, name, idle, fn)
+            except Exception as e:
+                output, status = "{0}: {1}".format(type(e).__name__, e), 255
+            with lock:
+                results[name] = (output.rstrip("\n"), status)
+                if results[name] in shown:
+                    logger.logMessage("[{0}] same as {1}".format(name, shown[results[name]]))
+                else:
+                    shown[results[name]] = name
+                    for line in results[name][0].splitlines():
+                        logger.logMessage("[{0}] {1}".format(name, line))
+                    if status:
+                        logger.logMessage("[{0}] exit status {1}".format(name, status))
+        scheduler = TaskScheduler(workers)
+        for name in names:
+            scheduler.add(name, partial(run, name))
+        try:
+            scheduler.run()
+        finally:
+            for deployer in deployers:
+                deployer.close()
+        if len(names) > 1:
+            groups = {}
+            for name in names:
+                groups.setdefault(results[name], []).append(name)
+            logger.logMessage("")
+            for (output, status), group in sorted(groups.items(), key=lambda item: item[1]):
+                logger.logMessage("{0}: exit status {1}".format(", ".join(group), status))
+        return max(status for output, status in results.values())
+
+    def runOnNode(self, logger, name, idle, fn):
+        """
+        Run something on a node with the next idle deployer.
+        @param idle: A queue of idle deployers.
+        @return: The output and the exit status.
+        """
+        host = self.getHost(logger, name)
+        if not host or not host["externalIp"]:
+            return "Node {0} is not running.".format(name), 255
+        deployer = idle.get()
+        try:
+            deployer.setUser(self.definitions[name]["user"], self.definitions[name]["keyFile"])
+            deployer.setHost(host["externalIp"])
+            try:
+                return fn(deployer)
+            finally:
+                deployer.disconnect()
+        finally:
+            idle.put(deployer)
 
     def ssh(self, logger, nodeName):
-        node = self.getNodes()[nodeName]
-        deployer = Deployer(node.externalIp, username=node.user, keyFile=node.keyFile)
-        deployer.ssh()
+        if not nodeName in self.definitions:
+            logger.log("Node {0} does not exist.".format(nodeName), "error")
+            return
+        deployer = self.getDeployer(logger, nodeName)
+        if deployer:
+            deployer.ssh()
+
+    def getDeployer(self, logger, nodeName):
+        """
+        Get a deployer for a single node, without building the other nodes.
+        @return: The deployer, or None if the node isn't running.
+        """
+        from deploy import Deployer
+        host = self.getHost(logger, nodeName)
+        if not host or not host["externalIp"]:
+            logger.log("Node {0} is not running.".format(nodeName), "error")
+            return None
+        definition = self.definitions[nodeName]
+        return Deployer(host["externalIp"], username=definition["user"], keyFile=definition["keyFile"])
+
+    def getHost(self, logger, nodeName):
+        """
+        Get the addresses of a node.
+        The inventory in the local state is used if it is fresh and the node
+        answers on the address it has there. Otherwise only that node is
+        looked up, by the instance id in the inventory if there is one, and
+        the inventory is updated.
+        @return: A dict with the instance id and the external and internal
+            IP of the node, or None if it isn't running.
+        """
+        from deploy import isReachable
+        host = self.state.getHost(nodeName, self.data.get("inventoryMaxAge", 3600))
+        if host and host["externalIp"] and isReachable(host["externalIp"]):
+            return host
+        logger.log("Looking up node {0}".format(nodeName))
+        host = self.getDriver().findHost(nodeName, host["id"] if host else None)
+        if host:
+            self.state.setHosts({nodeName: host})
+        return host
+
+    def updateInventory(self):
+        """
+        Store the addresses of all nodes in the inventory.
+        """
+        hosts = {}
+        for name, node in self.getNodes().items():
+            hosts[name] = {
+                "id": getattr(node, "id", None),
+                "externalIp": getattr(node, "externalIp", None),
+                "internalIp": getattr(node, "internalIp", None),
+            }
+        self.state.setHosts(hosts)
 
     def getTaskStatus(self, deployer, logger, meisterFile = "~/.meister"):
-        if isfile("/tmp/meister-status"):
-            os.remove("/tmp/meister-status")
-        if deployer.fileExists(meisterFile):
-            file = deployer.get(meisterFile, "/tmp/meister-status")[0]
-        else:
+        if not deployer.fileExists(meisterFile):
             return { "tasks": [] }
-        content = yaml.load(open(file).read())
-        return content
+        handle, file = mkstemp(prefix="meister-status")
+        os.close(handle)
+        try:
+            deployer.get(meisterFile, file)
+            return yaml.load(open(file).read(), Loader=YamlLoader)
+        finally:
+            os.remove(file)
 
     def putTaskStatus(self, status, deployer, logger, meisterFile = "~/.meister"):
-        file = open("/tmp/meister-status", 'w')
-        yaml.dump(status, file)
-        file.close()
-        deployer.put("/tmp/meister-status", meisterFile)
-        os.remove("/tmp/meister-status")
+        handle, file = mkstemp(prefix="meister-status")
+        os.close(handle)
+        try:
+            with open(file, 'w') as statusFile:
+                yaml.dump(status, statusFile)
+            deployer.put(file, meisterFile)
+        finally:
+            os.remove(file)
 
     def terminate(self, logger):
-        self.driver.terminate(logger)
-        if self.DNSDriver:
-            self.DNSDriver.terminate(self.getNodes(), logger)
+        with tracer.span("terminate"):
+            self.getDriver().terminate(logger)
+        DNSDriver = self.getDNSDriver()
+        if DNSDriver:
+            with tracer.span("dns"):
+                DNSDriver.terminate(self.getNodes(), logger)
+        self.state.clearHosts()
             
     def info(self, logger):
         logger.logMessage("Compute driver: {0}".format(self.data['driver']['name']))
-        if self.DNSDriver:
+        if self.getDNSDriver():
             logger.logMessage("DNS driver: {0}".format(self.data['DNS']['name']))
         logger.logMessage("\nNodes:\n======\n")
-        self.driver.info(logger)
+        self.getDriver().info(logger)
+        self.updateInventory()
 
     def parse(self):
-        data = yaml.load(open(self.configFile).read())
-        self.driver = self.drivers[data['driver']['name']](self, data)
-        self.DNSDriver = self.DNSDrivers[data['DNS']['name']](self, data)
-        self.nodes = {}
-        self.data = data
-        self.tasksModule = __import__(data["tasksModule"]) if "tasksModule" in data else None
+        """
+        Read the configuration file. This doesn't talk to any services,
+        the drivers and the nodes are created when they are needed.
+        The parsed configuration is compiled into a cache next to the file,
+        which is used for as long as the contents of the file are the same.
+        """
+        source = open(self.configFile).read()
+        digest = hashlib.sha1(source).hexdigest()
+        compiled = self.loadCompiled(digest)
+        if compiled is None:
+            compiled = self.compile(source)
+            self.saveCompiled(digest, compiled)
+        data = self.data = compiled["data"]
         self.defaultKeyFile = data["defaultKeyFile"] if "defaultKeyFile" in data else None
         self.defaultUser = data["defaultUser"] if "defaultUser" in data else None
+        self.definitions = compiled["definitions"]
 
-        for name, node in data["nodes"].items():
-            self.nodes[name] = self.driver.getNode(name, node)
-            self.nodes[name].tasks = node["tasks"] if "tasks" in node else []
+    def compile(self, source):
+        """
+        Parse the configuration and expand the node definitions.
+        The defaults of the configuration are applied to every node definition.
+        """
+        data = yaml.load(source, Loader=YamlLoader)
+        definitions = self.expandNodes(data["nodes"])
+        for name, definition in definitions.items():
+            definition = definitions[name] = dict(definition)
+            definition.setdefault("tasks", [])
             for prop, defaultProp in [("keyFile", "defaultKeyFile"), ("user", "defaultUser")]:
-                if (prop in node):
-                    setattr(self.nodes[name], prop, node[prop])
-                else:
-                    val = getattr(self, defaultProp, None)
-                    setattr(self.nodes[name], prop, val)
+                definition.setdefault(prop, data.get(defaultProp))
+        return {"data": data, "definitions": definitions}
+
+    def getCompiledFile(self):
+        return join(self.basedir, ".{0}.cache".format(basename(self.configFile)))
+
+    def loadCompiled(self, digest):
+        """
+        Load the compiled configuration.
+        @param digest: The hash of the configuration file.
+        @return: The compiled configuration, or None if there isn't one for this file.
+        """
+        try:
+            with open(self.getCompiledFile(), "rb") as cache:
+                version, cachedDigest, compiled = cPickle.load(cache)
+        except Exception:
+            # A missing, old or broken cache is simply compiled again.
+            return None
+        if version != self.COMPILED_VERSION or cachedDigest != digest:
+            return None
+        return compiled
+
+    def saveCompiled(self, digest, compiled):
+        """
+        Save the compiled configuration. The file is replaced atomically,
+        so that other meister processes never read half of it.
+        """
+        path = self.getCompiledFile()
+        try:
+            handle, temp = mkstemp(prefix=".meister-cache", dir=dirname(path) or ".")
+            with os.fdopen(handle, "wb") as cache:
+                cPickle.dump((self.COMPILED_VERSION, digest, compiled), cache, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temp, path)
+        except (IOError, OSError):
+            # The configuration still works without the cache, for instance in a read only directory.
+            pass
+
+    def buildNode(self, name, definition):
+        """
+        Create a node from its definition through the driver.
+        """
+        node = self.getDriver().getNode(name, definition)
+        node.tasks = definition["tasks"]
+        node.keyFile = definition["keyFile"]
+        node.user = definition["user"]
+        return node
+
+    def expandNodes(self, definitions):
+        """
+        Expand node definitions with a count property into several nodes.
+        A definition "app" with count 3 becomes the nodes app-1, app-2 and app-3.
+        The string {index} is replaced with the node number in all string properties.
+        """
+        nodes = {}
+        for name, definition in definitions.items():
+            if not "count" in definition:
+                nodes[name] = definition
+                continue
+            for index in range(1, int(definition["count"]) + 1):
+                node = {}
+                for prop, value in definition.items():
+                    if prop == "count":
+                        continue
+                    if isinstance(value, basestring):
+                        value = value.replace("{index}", str(index))
+                    node[prop] = value
+                nodes["{0}-{1}".format(name, index)] = node
+        return nodes
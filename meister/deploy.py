@@ -4,23 +4,100 @@ Created on Jan 11, 2013
 @author: fabsor
 '''
 from time import sleep
-from fabric.api import settings, abort, run, cd, sudo, put, env, prompt, get, open_shell
+from multiprocessing import Process, Pipe
+import socket
+import threading
+from contextlib import contextmanager
+from fabric.api import settings, abort, run, cd, sudo, put, env, prompt, get, open_shell, hide
 from fabric.contrib.files import exists
+from fabric.network import disconnect_all
+from tracing import tracer
+
+def isReachable(hostname, port = 22, timeout = 5):
+    """
+    Check if a host accepts connections.
+    """
+    try:
+        socket.create_connection((hostname, port), timeout).close()
+        return True
+    except (socket.error, socket.timeout):
+        return False
+
+def runCommand(command, useSudo = False):
+    """
+    A task that runs a shell command without printing anything.
+    A command that fails doesn't raise an exception.
+    @return: The output and the exit status of the command.
+    """
+    with settings(hide("running", "stdout", "stderr", "warnings"), warn_only=True, abort_exception=Exception):
+        result = sudo(command) if useSudo else run(command)
+    return str(result), result.return_code
 
 class Deployer:
     
-    def __init__(self, hostname, port = 22, username = None, keyFile = None, retries = 2, hostList = {}):
-        self.hostname = hostname
-        self.port = port
+    def __init__(self, hostname, port = 22, username = None, keyFile = None, retries = 2, hostList = {}, isolated = False, keepalive = 30):
+        """
+        @param isolated: Run all tasks in a process of its own, so that
+            several deployers can run tasks at the same time without
+            sharing fabric's global environment.
+        @param keepalive: Seconds between keepalive packets, which keeps
+            the SSH connection open while the deployer is idle.
+        """
         self.username = username
         self.keyFile = keyFile
-        self.hoststring = hostname
         self.hostList = hostList
         self.retries = 2
+        # The number of times the last task was retried.
+        self.retried = 0
+        self.keepalive = keepalive
+        self.setHost(hostname, port)
+        self.context = HostContext(self) if isolated else None
+
+    def setHost(self, hostname, port = 22):
+        """
+        Set the address of the host. This makes it possible to create
+        a deployer before the host has an address.
+        """
+        self.hostname = hostname
+        self.port = port
+        self.hoststring = hostname
         if port:
             self.hoststring = "{0}:{1}".format(self.hoststring, port)
-        if username:
-            self.hoststring = "{0}@{1}".format(username, self.hoststring)
+        if self.username:
+            self.hoststring = "{0}@{1}".format(self.username, self.hoststring)
+
+    def setUser(self, username, keyFile = None):
+        """
+        Set the user to connect as, so that the deployer can be used for another host.
+        """
+        self.username = username
+        self.keyFile = keyFile
+        self.setHost(self.hostname, self.port)
+
+    def getHost(self):
+        """
+        Get the connection settings that can change after the deployer was created.
+        """
+        return (self.hostname, self.port, self.username, self.keyFile, dict(self.hostList))
+
+    def disconnect(self):
+        """
+        Close the SSH connections, but keep the deployer.
+        """
+        if self.context:
+            self.runTask(disconnect_all)
+        else:
+            disconnect_all()
+
+    def close(self):
+        """
+        Close the SSH connection, and stop the process that runs the tasks if there is one.
+        """
+        if self.context:
+            self.context.close()
+            self.context = None
+        else:
+            disconnect_all()
 
     def ssh(self):
         self.runTask(open_shell)
@@ -36,18 +113,151 @@ class Deployer:
 
     def run(self, command):
         return self.runTask(run, { "command": command })
+
+    def execute(self, command, useSudo = False):
+        """
+        Run a shell command and collect its output.
+        @return: The output and the exit status of the command.
+        """
+        return self.runTask(runCommand, [command, useSudo])
         
     def sudo(self, command):
         return self.runTask(sudo, [command])
 
     def runTask(self, task, args = [], tries = 0):
-        with settings(host_string = self.hostname, port=self.port, user=self.username, key_filename=self.keyFile, host=self.hostname, meister = self.hostList):
+        with tracer.operation("ssh", getattr(task, "__name__", str(task)), host=self.hostname) as operation:
+            if self.context:
+                result = self.context.runTask(task, args, self.getHost(), operation)
+            else:
+                self.retried = 0
+                try:
+                    result = self.runLocalTask(task, args, tries)
+                finally:
+                    operation.retries = self.retried
+            # The output of commands is what comes back over the connection.
+            if isinstance(result, basestring):
+                operation.bytes = len(result)
+            return result
+
+    def runLocalTask(self, task, args = [], tries = 0):
+        with settings(host_string = self.hostname, port=self.port, user=self.username, key_filename=self.keyFile, host=self.hostname, meister = self.hostList, keepalive = self.keepalive):
             try:
                 return task(**args) if isinstance(args, dict) else task(*args)
             except Exception as e:
                 print e
                 if tries < self.retries:
+                    self.retried += 1
                     sleep(5)
-                    return self.runTask(task, args, tries + 1)
+                    return self.runLocalTask(task, args, tries + 1)
                 else:
                     raise e
+
+
+class DeployerPool:
+    """
+    A fixed number of deployers, which are shared by all hosts of a run.
+    A deployer is taken for a task and given back when the task is done,
+    so a run never has more processes and connections than the pool has
+    deployers. A deployer that was last used for the same host is taken
+    first, so that its SSH connection is reused.
+    Close the pool when done to close the connections.
+    """
+
+    def __init__(self, size, hostList = {}, isolated = True):
+        """
+        @param size: The number of deployers. The deployers start their
+            processes right away, so create the pool before any threads.
+        """
+        self.hostList = hostList
+        self.deployers = [Deployer(None, hostList = hostList, isolated = isolated) for i in range(size)]
+        self.idle = list(self.deployers)
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def use(self, hostname, port = 22, username = None, keyFile = None):
+        """
+        Use a deployer for a host, waiting until one is idle.
+        The deployer is disconnected from the host it was used for before.
+        """
+        with self.condition:
+            while not self.idle:
+                self.condition.wait()
+            deployer = self.idle[0]
+            for candidate in self.idle:
+                if (candidate.hostname, candidate.port, candidate.username) == (hostname, port, username):
+                    deployer = candidate
+                    break
+            self.idle.remove(deployer)
+        try:
+            if (deployer.hostname, deployer.port, deployer.username, deployer.keyFile) != (hostname, port, username, keyFile):
+                if deployer.hostname:
+                    deployer.disconnect()
+                deployer.setUser(username, keyFile)
+                deployer.setHost(hostname, port)
+            yield deployer
+        finally:
+            with self.condition:
+                self.idle.append(deployer)
+                self.condition.notify()
+
+    def close(self):
+        """
+        Close all connections.
+        """
+        with self.condition:
+            deployers = self.deployers
+            self.deployers = []
+            self.idle = []
+        for deployer in deployers:
+            deployer.close()
+
+
+class HostContext:
+    """
+    A process that runs the tasks of a single deployer.
+    Each process has its own copy of fabric's environment,
+    so that tasks for different hosts can run at the same time.
+    """
+
+    def __init__(self, deployer):
+        self.conn, child = Pipe()
+        self.lock = threading.Lock()
+        self.process = Process(target=self.serve, args=(deployer, child))
+        self.process.daemon = True
+        self.process.start()
+
+    def serve(self, deployer, conn):
+        while True:
+            message = conn.recv()
+            if message is None:
+                disconnect_all()
+                return
+            task, args, host = message
+            if host:
+                hostname, port, deployer.username, deployer.keyFile, deployer.hostList = host
+                deployer.setHost(hostname, port)
+            deployer.retried = 0
+            try:
+                conn.send((True, deployer.runLocalTask(task, args), deployer.retried))
+            except Exception as e:
+                conn.send((False, "{0}: {1}".format(type(e).__name__, e), deployer.retried))
+
+    def runTask(self, task, args = [], host = None, operation = None):
+        """
+        @param host: The hostname, port, user, key file and host list of the
+            deployer, which may have changed since the process was started.
+        @param operation: The traced operation, which gets the number of retries.
+        """
+        with self.lock:
+            self.conn.send((task, args, host))
+            success, result, retried = self.conn.recv()
+        if operation:
+            operation.retries = retried
+        if not success:
+            raise Exception(result)
+        return result
+
+    def close(self):
+        with self.lock:
+            self.conn.send(None)
+        self.process.join()
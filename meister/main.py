@@ -2,8 +2,8 @@
 # encoding: utf-8
 
 import sys
-import config
 import traceback
+import pipes
 
 from argparse import ArgumentParser
 from argparse import RawDescriptionHelpFormatter
@@ -22,6 +22,16 @@ class PrintLogger():
     def logMessage(self, message):
         print message
 
+def getCommand(words):
+    """
+    Get a shell command from the words after --, quoted so that the
+    remote shell gets the same arguments. A single word is the command
+    line itself, which can use pipes and redirects.
+    """
+    if len(words) == 1:
+        return words[0]
+    return " ".join(pipes.quote(word) for word in words)
+
 def main(argv=None): # IGNORE:C0111
     '''Command line options.'''
     try:
@@ -30,26 +40,37 @@ def main(argv=None): # IGNORE:C0111
         parser.add_argument('command', help="A command to execute", default="info", nargs="+")
         parser.add_argument('-f', '--file', action='store', default="meister.yml")
         parser.add_argument('--debug', help="Show debuging information", action='store_true')
+        parser.add_argument('--trace', help="Write a trace of all API calls and SSH operations to this file, for chrome://tracing", metavar="FILE")
 
         # Process arguments
         args = parser.parse_args()
         logger = PrintLogger()
         command = args.command[0]
         file = args.file
-        try:
-
-            configuration = config.YamlConfig(file)
+        # The configuration is only read once we know that the command exists.
+        commands = {
+            "plan": { "cmd": lambda configuration: configuration.plan(logger), "help": "Show the changes that provision would make." },
+            "provision": { "cmd": lambda configuration: configuration.provision(logger), "help": "Provision the configuration using the drivers provided." },
+            "terminate": { "cmd": lambda configuration: configuration.terminate(logger), "help": "Terminate instances specified by the configuration file." },
+            "info": { "cmd": lambda configuration: configuration.info(logger), "help": "Show information about the configuration and the current state." },
+            "task": { "cmd": lambda configuration: configuration.task(logger, args.command[1], args.command[2]), "help": "Execute a task on nodes: task <nodes> <task>. Nodes are names, security groups or patterns like app-*, separated by commas."},
+            "exec": { "cmd": lambda configuration: configuration.execute(logger, args.command[1], getCommand(args.command[2:])), "help": "Run a shell command on nodes: exec <nodes> -- <command>. The arguments of the command are quoted, pass the command as a single argument to use pipes and redirects."},
+            "ssh": { "cmd": lambda configuration: configuration.ssh(logger, args.command[1]), "help": "Open an SSH connection."}
 
-            commands = { 
-                "provision": { "cmd": lambda: configuration.provision(logger), "help": "Provision the configuration using the drivers provided." },
-                "terminate": { "cmd": lambda: configuration.terminate(logger), "help": "Terminate instances specified by the configuration file." },
-                "info": { "cmd": lambda: configuration.info(logger), "help": "Show information about the configuration and the current state." },
-                "task": { "cmd": lambda: configuration.task(logger, args.command[1], args.command[2]), "help": "Execute a task on a node."},
-                "ssh": { "cmd": lambda: configuration.ssh(logger, args.command[1]), "help": "Open an SSH connection."}
-
-                }
+            }
+        try:
             if command in commands:
-                commands[command]["cmd"]()
+                import config
+                from tracing import tracer
+                if args.trace:
+                    tracer.enable()
+                try:
+                    # Commands that run on nodes return the exit status.
+                    return commands[command]["cmd"](config.YamlConfig(file))
+                finally:
+                    if args.trace:
+                        tracer.write(args.trace)
+                        logger.logMessage("\n" + tracer.summary())
             else:
                 print "Available commands:\n"
                 for command, info in commands.items():
@@ -62,10 +83,16 @@ def main(argv=None): # IGNORE:C0111
                 print "\nDebug info:"
                 exc_type, exc_value, exc_tb = sys.exc_info()
                 traceback.print_exception(exc_type, exc_value, exc_tb)
+            return 1
 
     except KeyboardInterrupt:
         ### handle keyboard interrupt ###
         return 0
 
 if __name__ == "__main__":
-    main()
+    # Run from the meister package, so that the modules of the package
+    # and of its aws package are only imported once, under the same names.
+    from os.path import abspath, dirname
+    sys.path[0] = dirname(dirname(abspath(__file__)))
+    from meister.main import main
+    sys.exit(main())
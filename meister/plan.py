@@ -0,0 +1,73 @@
+'''
+Plans of the changes that provisioning makes.
+'''
+
+class Snapshot:
+    """
+    The live state of a stack, collected with a few bulk calls.
+    """
+    def __init__(self):
+        # Nodes in the stack, keyed by name.
+        self.nodes = {}
+        # Security groups in the configuration that exist, keyed by name.
+        self.groups = {}
+        # All elastic IP addresses that are allocated.
+        self.addresses = []
+        # The DNS zone with its records, if there is one.
+        self.zone = None
+
+class Change:
+    """
+    A change that provisioning would make.
+    """
+    CREATE = "+"
+    UPDATE = "~"
+    DELETE = "-"
+
+    def __init__(self, kind, action, name, detail = "", pending = False):
+        """
+        @param kind: The kind of resource, for instance node or record.
+        @param action: CREATE, UPDATE or DELETE.
+        @param name: The name of the resource.
+        @param detail: A description of the change.
+        @param pending: True if the change depends on nodes that doesn't exist yet.
+        """
+        self.kind = kind
+        self.action = action
+        self.name = name
+        self.detail = detail
+        self.pending = pending
+
+    def __str__(self):
+        info = "{0} {1} {2}".format(self.action, self.kind, self.name)
+        if self.detail:
+            info += ": " + self.detail
+        if self.pending:
+            info += " (after launch)"
+        return info
+
+class Plan:
+    """
+    The changes that are needed to make the live state match the configuration.
+    """
+    def __init__(self):
+        self.changes = []
+
+    def add(self, kind, action, name, detail = "", pending = False):
+        change = Change(kind, action, name, detail, pending)
+        self.changes.append(change)
+        return change
+
+    def getChanges(self, kind = None):
+        return [change for change in self.changes if kind is None or change.kind == kind]
+
+    def has(self, kind):
+        return len(self.getChanges(kind)) > 0
+
+    def __len__(self):
+        return len(self.changes)
+
+    def __str__(self):
+        if not self.changes:
+            return "No changes."
+        return "\n".join(str(change) for change in self.changes)
@@ -0,0 +1,171 @@
+'''
+Running jobs with dependencies on a pool of threads.
+'''
+import threading
+import Queue
+
+class SchedulerException(Exception):
+    """
+    Raised when jobs can't be scheduled or when jobs failed.
+    """
+    def __init__(self, message, errors = {}):
+        Exception.__init__(self, message)
+        self.errors = errors
+
+class TaskScheduler:
+    """
+    Runs jobs on a bounded pool of worker threads.
+    A job is started as soon as all the jobs it requires are done,
+    so independent jobs run at the same time.
+    """
+
+    def __init__(self, workers = 10):
+        self.workers = workers
+        self.jobs = {}
+        self.order = []
+        self.external = set()
+        self.done = None
+
+    def add(self, key, fn, requires = []):
+        """
+        Add a job.
+        @param key: A unique key for the job.
+        @param fn: The function to call.
+        @param requires: The keys of the jobs that must be done first.
+        """
+        if key in self.jobs:
+            raise SchedulerException("Job {0} has already been added".format(key))
+        self.jobs[key] = (fn, list(requires))
+        self.order.append(key)
+
+    def addExternal(self, key, requires = [], start = None):
+        """
+        Add a job that is done outside of the scheduler, for instance by
+        another job that waits for many things at once. The job is started
+        like other jobs, and is done when finish is called.
+        @param start: A function that is called on a worker when the job is
+            started. It should hand the job over and return right away.
+        """
+        self.add(key, start, requires)
+        self.external.add(key)
+
+    def finish(self, key, result = None, error = None):
+        """
+        Mark an external job as done. This can be called from any thread.
+        @param error: An exception, if the job failed.
+        """
+        self.done.put((key, result, error))
+
+    def has(self, key):
+        return key in self.jobs
+
+    def require(self, key, required):
+        """
+        Make an added job wait for another job.
+        """
+        self.jobs[key][1].append(required)
+
+    def validate(self):
+        """
+        Make sure that all dependencies exist and that there are no cycles.
+        """
+        for key in self.order:
+            if key in self.external and self.jobs[key][0] is None and self.jobs[key][1]:
+                raise SchedulerException("External job {0} without a start function can't require other jobs".format(key))
+            for required in self.jobs[key][1]:
+                if not required in self.jobs:
+                    raise SchedulerException("Job {0} requires {1}, which doesn't exist".format(key, required))
+        visited = {}
+        def visit(key, path):
+            if visited.get(key) == "done":
+                return
+            if visited.get(key) == "visiting":
+                raise SchedulerException("Circular dependency: {0}".format(" -> ".join(str(item) for item in path + [key])))
+            visited[key] = "visiting"
+            for required in self.jobs[key][1]:
+                visit(required, path + [key])
+            visited[key] = "done"
+        for key in self.order:
+            visit(key, [])
+
+    def run(self):
+        """
+        Run all jobs. Jobs that require a failed job are skipped.
+        @return: A dict with the result of each job.
+        @raise SchedulerException: If any job failed.
+        """
+        self.validate()
+        waiting = {}
+        dependents = {}
+        for key in self.order:
+            waiting[key] = set(self.jobs[key][1])
+            for required in waiting[key]:
+                dependents.setdefault(required, []).append(key)
+
+        ready = Queue.Queue()
+        done = self.done = Queue.Queue()
+        def work():
+            while True:
+                key = ready.get()
+                if key is None:
+                    return
+                try:
+                    result = self.jobs[key][0]()
+                    # External jobs are done when they are finished.
+                    if not key in self.external:
+                        done.put((key, result, None))
+                except Exception as e:
+                    done.put((key, None, e))
+
+        threads = []
+        for i in range(min(self.workers, len(self.order))):
+            thread = threading.Thread(target=work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        results = {}
+        errors = {}
+        skipped = set()
+        running = 0
+        def start(key):
+            # External jobs without a start function are started by whoever finishes them.
+            if self.jobs[key][0] is not None:
+                ready.put(key)
+        for key in self.order:
+            if not waiting[key]:
+                start(key)
+                running += 1
+        def skip(key):
+            for dependent in dependents.get(key, []):
+                if not dependent in skipped:
+                    skipped.add(dependent)
+                    skip(dependent)
+        try:
+            while running:
+                try:
+                    # Waiting with a timeout keeps the main thread interruptible.
+                    key, result, error = done.get(True, 1)
+                except Queue.Empty:
+                    continue
+                running -= 1
+                if error:
+                    errors[key] = error
+                    skip(key)
+                    continue
+                results[key] = result
+                for dependent in dependents.get(key, []):
+                    waiting[dependent].discard(key)
+                    if not waiting[dependent] and not dependent in skipped:
+                        start(dependent)
+                        running += 1
+        finally:
+            for thread in threads:
+                ready.put(None)
+        # All workers are idle now, so they stop right away.
+        for thread in threads:
+            thread.join()
+        if errors:
+            message = "\n".join("{0}: {1}".format(key, error) for key, error in errors.items())
+            raise SchedulerException("Jobs failed:\n" + message, errors)
+        return results
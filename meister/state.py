@@ -0,0 +1,207 @@
+'''
+The local state of a configuration.
+'''
+import json
+import sqlite3
+import threading
+import time
+
+class StateStore:
+    """
+    Local state about a configuration, stored in an SQLite database
+    next to the meister.yml file. The database can be shared by several
+    threads and by several meister processes.
+    """
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS tasks (
+            node TEXT NOT NULL,
+            instance TEXT NOT NULL,
+            task TEXT NOT NULL,
+            completed REAL NOT NULL,
+            PRIMARY KEY (node, instance, task)
+        )""",
+        """CREATE TABLE IF NOT EXISTS zones (
+            name TEXT PRIMARY KEY,
+            id TEXT NOT NULL,
+            expires REAL NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS inventory (
+            node TEXT PRIMARY KEY,
+            instance TEXT,
+            externalIp TEXT,
+            internalIp TEXT,
+            updated REAL NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS journal (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            name TEXT NOT NULL,
+            data TEXT NOT NULL,
+            started REAL NOT NULL,
+            completed REAL
+        )""",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = None
+
+    def getDb(self):
+        """
+        Get the database connection, creating the database if needed.
+        """
+        with self.lock:
+            if not self.db:
+                self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+                for statement in self.SCHEMA:
+                    self.db.execute(statement)
+                self.db.commit()
+            return self.db
+
+    def execute(self, query, params = (), many = False):
+        """
+        Execute a statement and commit it.
+        @param many: Execute the statement once for each set of params.
+        """
+        with self.lock:
+            db = self.getDb()
+            try:
+                cursor = db.executemany(query, params) if many else db.execute(query, params)
+                db.commit()
+                return cursor
+            except:
+                db.rollback()
+                raise
+
+    def query(self, query, params = ()):
+        """
+        Fetch all rows for a query.
+        """
+        with self.lock:
+            return self.getDb().execute(query, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            if self.db:
+                self.db.close()
+                self.db = None
+
+    def taskKey(self, task):
+        return json.dumps(task, sort_keys=True)
+
+    def getCompletedTasks(self, node, instance):
+        """
+        Get the tasks that have been completed on a node.
+        @param instance: The instance id of the node. Tasks that were run on
+            an earlier instance with the same name are not included.
+        """
+        rows = self.query("SELECT task FROM tasks WHERE node = ? AND instance = ?", (node, instance))
+        return [json.loads(row[0]) for row in rows]
+
+    def addCompletedTasks(self, node, instance, tasks):
+        """
+        Record that tasks have been completed on a node.
+        """
+        now = time.time()
+        self.execute("INSERT OR REPLACE INTO tasks (node, instance, task, completed) VALUES (?, ?, ?, ?)",
+                     [(node, instance, self.taskKey(task), now) for task in tasks], True)
+
+    def getZoneId(self, name):
+        """
+        Get the id of a hosted zone from the zone directory.
+        @return: The id, or None if it isn't known or has expired.
+        """
+        rows = self.query("SELECT id FROM zones WHERE name = ? AND expires > ?", (name, time.time()))
+        return rows[0][0] if rows else None
+
+    def setZoneId(self, name, id, lifetime = 86400):
+        """
+        Store the id of a hosted zone in the zone directory.
+        @param lifetime: The number of seconds to keep the id.
+        """
+        self.execute("INSERT OR REPLACE INTO zones (name, id, expires) VALUES (?, ?, ?)", (name, id, time.time() + lifetime))
+
+    def removeZoneId(self, name):
+        self.execute("DELETE FROM zones WHERE name = ?", (name,))
+
+    def getHost(self, node, maxAge = 3600):
+        """
+        Get the addresses of a node from the inventory.
+        @param maxAge: Leave out the addresses of entries that are older than
+            this many seconds. The instance id is kept, since it can still be
+            used to look the node up.
+        @return: A dict with the instance id and the external and internal
+            IP of the node, or None if it isn't known.
+        """
+        rows = self.query("SELECT instance, externalIp, internalIp, updated FROM inventory WHERE node = ?", (node,))
+        if not rows:
+            return None
+        instance, externalIp, internalIp, updated = rows[0]
+        if updated <= time.time() - maxAge:
+            externalIp = internalIp = None
+        return {"id": instance, "externalIp": externalIp, "internalIp": internalIp}
+
+    def setHosts(self, hosts):
+        """
+        Store the addresses of nodes in the inventory.
+        @param hosts: A dict keyed by node name, with dicts like the ones getHost returns.
+        """
+        now = time.time()
+        self.execute("INSERT OR REPLACE INTO inventory (node, instance, externalIp, internalIp, updated) VALUES (?, ?, ?, ?, ?)",
+                     [(name, host["id"], host["externalIp"], host["internalIp"], now) for name, host in hosts.items()], True)
+
+    def clearHosts(self):
+        self.execute("DELETE FROM inventory")
+
+    def beginOperation(self, kind, name, data = {}):
+        """
+        Write an operation to the provisioning journal before it is started.
+        @param kind: The kind of operation, for instance launch or eip.
+        @param name: The name of the resource.
+        @param data: Anything that is needed to resume the operation.
+        @return: The id of the journal entry.
+        """
+        cursor = self.execute("INSERT INTO journal (kind, name, data, started) VALUES (?, ?, ?, ?)",
+                              (kind, name, json.dumps(data), time.time()))
+        return cursor.lastrowid
+
+    def completeOperation(self, id, data = None):
+        """
+        Mark an operation in the journal as completed.
+        @param data: The result of the operation, it replaces the data of the entry.
+        """
+        if data is None:
+            self.execute("UPDATE journal SET completed = ? WHERE id = ?", (time.time(), id))
+        else:
+            self.execute("UPDATE journal SET completed = ?, data = ? WHERE id = ?", (time.time(), json.dumps(data), id))
+
+    def removeOperation(self, id):
+        """
+        Forget an operation that is known to have had no effect.
+        """
+        self.execute("DELETE FROM journal WHERE id = ?", (id,))
+
+    def getOperations(self, kind = None, completed = None):
+        """
+        Get operations from the journal, oldest first.
+        @param kind: Only get operations of this kind.
+        @param completed: True to only get completed operations, False to
+            only get operations that never completed.
+        @return: A list of dicts with the id, kind, name, data and completed time.
+        """
+        query = "SELECT id, kind, name, data, completed FROM journal WHERE 1 = 1"
+        params = []
+        if kind is not None:
+            query += " AND kind = ?"
+            params.append(kind)
+        if completed is not None:
+            query += " AND completed IS NOT NULL" if completed else " AND completed IS NULL"
+        rows = self.query(query + " ORDER BY id", params)
+        return [{"id": row[0], "kind": row[1], "name": row[2], "data": json.loads(row[3]), "completed": row[4]} for row in rows]
+
+    def clearJournal(self):
+        """
+        Forget all operations, after a provisioning run has finished.
+        """
+        self.execute("DELETE FROM journal")
@@ -0,0 +1,70 @@
+'''
+Tests for the elastic IP address pool.
+'''
+import unittest
+import os
+from tempfile import mkstemp
+from meister.aws.addresspool import AddressPool
+from meister.state import StateStore
+
+class ListLogger():
+    def __init__(self):
+        self.logs = []
+
+    def log(self, message, type = 'notice'):
+        self.logs.append(message)
+
+class FakeConnection:
+    """
+    Associations show up in the second describe call after they were made.
+    """
+    def __init__(self, addresses):
+        self.addresses = addresses
+        self.associating = {}
+        self.calls = []
+
+    def describeAddresses(self, ips = None):
+        self.calls.append(("describe", ips))
+        addresses = dict((ip, instance) for ip, instance in self.addresses.items() if ips is None or ip in ips)
+        self.addresses.update(self.associating)
+        self.associating = {}
+        return addresses
+
+    def allocateElasticIP(self):
+        ip = "10.0.1.{0}".format(len(self.addresses))
+        self.calls.append(("allocate", ip))
+        self.addresses[ip] = None
+        return ip
+
+    def associateAddress(self, id, ip):
+        self.calls.append(("associate", id, ip))
+        self.associating[ip] = id
+
+class AddressPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = mkstemp()
+        os.close(handle)
+        self.state = StateStore(self.path)
+
+    def testAssign(self):
+        con = FakeConnection({"10.0.0.1": "i-1", "10.0.0.2": None})
+        pool = AddressPool(con, ListLogger(), self.state, reserve = 1)
+        assigned = pool.assign({"mgmt": "i-1", "app-1": "i-2", "app-2": "i-3"}, 0)
+        self.assertEqual(assigned["mgmt"], "10.0.0.1")
+        self.assertEqual(sorted(assigned.values())[1:], sorted(["10.0.0.2", "10.0.1.2"]))
+        # The shortfall and the reserve are allocated up front.
+        self.assertEqual([call[0] for call in con.calls], ["describe", "allocate", "allocate", "associate", "associate", "describe", "describe"])
+        # All associations are confirmed with one filtered describe call per round.
+        self.assertEqual(sorted(con.calls[-1][1]), sorted([assigned["app-1"], assigned["app-2"]]))
+        self.assertEqual(len([ip for ip, instance in con.addresses.items() if not instance]), 1)
+
+    def testJournaledAddress(self):
+        self.state.completeOperation(self.state.beginOperation("eip", "app-1"), {"ip": "10.0.0.3"})
+        con = FakeConnection({"10.0.0.2": None, "10.0.0.3": None})
+        assigned = AddressPool(con, ListLogger(), self.state).assign({"app-1": "i-2"}, 0)
+        self.assertEqual(assigned, {"app-1": "10.0.0.3"})
+
+    def tearDown(self):
+        self.state.close()
+        os.remove(self.path)
@@ -0,0 +1,41 @@
+'''
+Tests for splitting Route 53 changes into batches.
+'''
+import unittest
+from meister.aws.route53 import ChangeBatch, Record
+
+class ChangeBatchTest(unittest.TestCase):
+
+    def record(self, name, values = ["10.0.0.1"], type = "A"):
+        return Record(name, type, 120, values)
+
+    def testBatches(self):
+        batch = ChangeBatch()
+        batch.MAX_CHANGES = 3
+        batch.add(("CREATE", self.record("a.example.com.")))
+        batch.add(("DELETE", self.record("b.example.com.")), ("CREATE", self.record("b.example.com.", ["10.0.0.2"])))
+        batch.add(("DELETE", self.record("c.example.com.")))
+        batch.add(("DELETE", self.record("d.example.com.")), ("CREATE", self.record("d.example.com.", ["10.0.0.2"])))
+        batches = batch.getBatches()
+        self.assertEqual([[(action, record.name) for action, record in changes] for changes in batches], [
+            [("DELETE", "c.example.com."), ("DELETE", "b.example.com."), ("CREATE", "b.example.com.")],
+            [("DELETE", "d.example.com."), ("CREATE", "d.example.com."), ("CREATE", "a.example.com.")],
+        ])
+
+    def testLimits(self):
+        batch = ChangeBatch()
+        for i in range(250):
+            batch.add(("CREATE", self.record("{0}.example.com.".format(i))))
+        self.assertEqual([len(changes) for changes in batch.getBatches()], [100, 100, 50])
+        batch = ChangeBatch()
+        batch.add(("CREATE", self.record("a.example.com.", ["x" * 20000])))
+        batch.add(("CREATE", self.record("b.example.com.", ["x" * 20000])))
+        self.assertEqual(len(batch.getBatches()), 2)
+        batch.add(("CREATE", self.record("c.example.com.", ["x" * 40000])))
+        self.assertRaises(Exception, batch.getBatches)
+
+    def testXML(self):
+        batch = ChangeBatch()
+        xml = batch.toXML([("CREATE", self.record("a&b.example.com."))])
+        self.assertTrue("<Name>a&amp;b.example.com.</Name>" in xml)
+        self.assertTrue("<Value>10.0.0.1</Value>" in xml)
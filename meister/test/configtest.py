@@ -3,7 +3,30 @@ Tests for the config class.
 @author: fabsor
 '''
 import unittest
+import shutil
+import types
+from contextlib import contextmanager
+from os.path import isfile, join
+from tempfile import mkdtemp
 from meister.config import YamlConfig
+from meister.scheduler import TaskScheduler
+
+class ListLogger():
+    def __init__(self):
+        self.logs = []
+
+    def log(self, message, type = 'notice'):
+        self.logs.append((type, message))
+
+class Item:
+    def __init__(self, **props):
+        for name, value in props.items():
+            setattr(self, name, value)
+
+class FakePool:
+    @contextmanager
+    def use(self, hostname, port = 22, username = None, keyFile = None):
+        yield None
 
 class ConfigTest(unittest.TestCase):
     
@@ -32,6 +55,11 @@ class ConfigTest(unittest.TestCase):
         # Application 2 should have it's own group
         application2 = nodes["application2"]
         self.assertEqual(application2.securityGroup, 'group2')
+
+        # Nodes with a count are expanded into several nodes.
+        self.assertTrue("app" not in nodes)
+        self.assertEqual(nodes["app-1"].externalDNS, 'app1.example.com.')
+        self.assertEqual(nodes["app-2"].externalDNS, 'app2.example.com.')
         
         # Browse security groups.
         groups = config.getSecurityGroups()
@@ -42,4 +70,75 @@ class ConfigTest(unittest.TestCase):
         self.assertEqual(group1['description'], "Group1 description")
         self.assertEqual(group1['rules'][0]["ip"], "10.10.1.1/32")
         self.assertEqual(group1['rules'][1]["ip"], "192.168.1.0/32")
-        
\ No newline at end of file
+        
+    def writeConfig(self, nodes):
+        self.dir = mkdtemp()
+        path = join(self.dir, "meister.yml")
+        with open(path, "w") as config:
+            config.write("defaultUser: ubuntu\ndriver:\n    name: aws\nnodes:\n")
+            for name in nodes:
+                config.write("    {0}:\n        size: t1.micro\n        count: 2\n".format(name))
+        return path
+
+    def testLazyParse(self):
+        config = YamlConfig(self.writeConfig(["mgmt", "app"]))
+        # Reading the configuration doesn't create drivers or nodes.
+        self.assertEqual(config.driver, None)
+        self.assertEqual(config.nodes, {})
+        self.assertEqual(sorted(config.definitions.keys()), ["app-1", "app-2", "mgmt-1", "mgmt-2"])
+        self.assertEqual(config.definitions["app-1"]["user"], "ubuntu")
+
+    def testSelectNodes(self):
+        config = YamlConfig(self.writeConfig(["mgmt", "app"]))
+        config.definitions["mgmt-1"]["securityGroup"] = "admin"
+        self.assertEqual(config.selectNodes("app-*"), ["app-1", "app-2"])
+        self.assertEqual(config.selectNodes("mgmt-2"), ["mgmt-2"])
+        self.assertEqual(config.selectNodes("admin,app-2"), ["app-2", "mgmt-1"])
+        self.assertEqual(config.selectNodes("web-*"), [])
+
+    def testCompiledConfig(self):
+        path = self.writeConfig(["app"])
+        YamlConfig(path)
+        self.assertTrue(isfile(join(self.dir, ".meister.yml.cache")))
+        # The compiled configuration is used while the file is the same.
+        compile = YamlConfig.compile
+        try:
+            def fail(self, source):
+                raise Exception("The configuration should not be compiled again")
+            YamlConfig.compile = fail
+            self.assertTrue("app-2" in YamlConfig(path).definitions)
+        finally:
+            YamlConfig.compile = compile
+        with open(path, "a") as config:
+            config.write("    db:\n        size: t1.micro\n")
+        self.assertTrue("db" in YamlConfig(path).definitions)
+
+    def testMissingTask(self):
+        config = YamlConfig(self.writeConfig(["app"]))
+        config.tasksModule = types.ModuleType("tasks")
+        logger = ListLogger()
+        node = Item(name="app-1", id="i-1", user="ubuntu", keyFile=None)
+        completed = set()
+        progress = {"meisterFile": "/home/ubuntu/.meister", "status": {"tasks": []}, "changed": False, "last": "missing"}
+        job = config.taskJob(logger, node, FakePool(), "missing", completed, progress)
+        # A task that doesn't exist fails, and is not recorded as done.
+        self.assertRaises(Exception, job)
+        self.assertEqual(("error", "Task missing does not exist."), logger.logs[-1])
+        self.assertEqual(set(), completed)
+        self.assertEqual([], config.state.getCompletedTasks("app-1", "i-1"))
+
+    def testDuplicateTasks(self):
+        config = YamlConfig(self.writeConfig(["app"]))
+        tasks = [{"name": "deploy", "arguments": ["a"]}, "restart", {"name": "deploy", "arguments": ["b"]}]
+        node = Item(name="app-1", user="ubuntu", tasks=tasks)
+        scheduler = TaskScheduler()
+        taskKeys = {}
+        last = config.scheduleTasks(scheduler, ListLogger(), node, None, set(), tasks, taskKeys)
+        # A task that is run twice gets a job for each run.
+        self.assertEqual([("task", "app-1", 0), ("task", "app-1", 1), ("task", "app-1", 2)], scheduler.order)
+        self.assertEqual(("task", "app-1", 2), last)
+        self.assertEqual(("task", "app-1", 2), taskKeys["app-1:deploy"])
+
+    def tearDown(self):
+        if getattr(self, "dir", None):
+            shutil.rmtree(self.dir)
@@ -0,0 +1,79 @@
+'''
+Tests for the Route 53 connection pool.
+'''
+import unittest
+import httplib
+from meister.aws.route53 import HTTPSConnectionPool
+
+class FakeResponse:
+    status = 200
+    will_close = False
+
+    def read(self):
+        return "body"
+
+    def isclosed(self):
+        return True
+
+class FakeConnection:
+    connections = []
+
+    def __init__(self, host, timeout = None):
+        self.requests = 0
+        self.closed = False
+        self.stale = False
+        # Whether the server closes the connection before or after the request is sent.
+        self.closedAfterSend = False
+        FakeConnection.connections.append(self)
+
+    def request(self, method, path, body = None, headers = {}):
+        if self.stale and not self.closedAfterSend:
+            raise httplib.BadStatusLine("")
+        self.requests += 1
+
+    def getresponse(self):
+        if self.stale:
+            raise httplib.BadStatusLine("")
+        return FakeResponse()
+
+    def close(self):
+        self.closed = True
+
+class HTTPSConnectionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        FakeConnection.connections = []
+        self.pool = HTTPSConnectionPool("example.com")
+        self.pool.connectionClass = FakeConnection
+
+    def testReuse(self):
+        for i in range(3):
+            response, body = self.pool.request("GET", "/")
+            self.assertEqual(body, "body")
+        self.assertEqual(len(FakeConnection.connections), 1)
+        self.assertEqual(FakeConnection.connections[0].requests, 3)
+
+    def testStaleConnection(self):
+        self.pool.request("GET", "/")
+        FakeConnection.connections[0].stale = True
+        response, body = self.pool.request("GET", "/")
+        self.assertEqual(body, "body")
+        self.assertTrue(FakeConnection.connections[0].closed)
+        self.assertEqual(len(FakeConnection.connections), 2)
+
+    def testStaleConnectionAfterSend(self):
+        self.pool.request("GET", "/")
+        FakeConnection.connections[0].stale = True
+        FakeConnection.connections[0].closedAfterSend = True
+        # A GET is sent again, but a POST may have been carried out already.
+        response, body = self.pool.request("GET", "/")
+        self.assertEqual(len(FakeConnection.connections), 2)
+        FakeConnection.connections[1].stale = True
+        FakeConnection.connections[1].closedAfterSend = True
+        self.assertRaises(httplib.BadStatusLine, self.pool.request, "POST", "/", "<change/>")
+        self.assertEqual(len(FakeConnection.connections), 2)
+
+    def testClose(self):
+        self.pool.request("GET", "/")
+        self.pool.close()
+        self.assertTrue(FakeConnection.connections[0].closed)
@@ -42,7 +42,7 @@ class AWSConnectionTest(unittest.TestCase):
     def testSecurityGroup(self):
         group = self.con.createSecurityGroup("mygroup", "mydescription")
         group.addRule("8080", "8081", "10.1.1.1/32")
-        self.assertEqual(group.listRules(), [{'fromPort': "8080", 'toPort': "8081", 'ip': "10.1.1.1/32", 'protocol': 'tcp'}])
+        self.assertEqual(group.listRules(), [ec2.Rule(8080, 8081, "10.1.1.1/32", "tcp")])
         self.assertTrue("mygroup" in self.con.getSecurityGroups())
         self.con.deleteSecurityGroup("mygroup")
         self.assertTrue("mygroup" not in self.con.getSecurityGroups())
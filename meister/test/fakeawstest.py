@@ -0,0 +1,101 @@
+'''
+Tests for the local fake of EC2 and Route 53.
+'''
+import unittest
+import urllib2
+from meister.aws import route53, limiter
+from meister.aws.fake import FakeAWS, FakeAWSServer
+from meister import benchmark
+
+class FakeAWSTest(unittest.TestCase):
+
+    def setUp(self):
+        self.aws = FakeAWS()
+        self.server = FakeAWSServer(self.aws).start()
+        self.con = route53.Route53Connection("id", "key", self.server.getEndpoint())
+
+    def tearDown(self):
+        self.con.close()
+        self.server.stop()
+        limiter.limiters.clear()
+
+    def testZone(self):
+        zone = route53.Zone("example.com.", "Test zone")
+        for i in range(150):
+            zone.addRecord(route53.Zone.RECORDTYPE_A, "node{0}.example.com.".format(i), "10.0.0.{0}".format(i % 256))
+        zone = self.con.saveZone(zone, wait=True)
+        self.assertEquals(zone.id, self.con.findZone("example.com").id)
+        self.assertEquals(1, self.aws.calls["CreateHostedZone"])
+        # The records are listed in two pages.
+        self.aws.calls.clear()
+        records = self.con.getRecords(zone)
+        self.assertEquals(("10.0.0.42",), records.get("node42.example.com.", "A").values)
+        self.assertEquals(2, self.aws.calls["ListResourceRecordSets"])
+
+        zone.deleteRecord("node42.example.com.")
+        self.con.saveZone(zone)
+        self.assertFalse(("node42.example.com.", "A") in self.con.getRecords(zone))
+
+    def testZones(self):
+        zones = [route53.Zone(name) for name in ("example.com.", "example.org.")]
+        for zone in zones:
+            zone.addRecord(route53.Zone.RECORDTYPE_A, "www." + zone.name, "10.0.0.1")
+        saved = self.con.saveZones(zones, wait=True)
+        self.assertEquals(["example.com.", "example.org."], [zone.name for zone in saved])
+        self.assertEquals(2, self.aws.calls["ChangeResourceRecordSets"])
+        for zone in saved:
+            self.assertTrue(("www." + zone.name, "A") in self.con.getRecords(zone))
+
+    def testErrors(self):
+        self.assertRaises(route53.Route53Exception, self.con.getZone, "/hostedzone/ZMISSING")
+        try:
+            urllib2.urlopen(self.server.getEndpoint() + "/?Action=TerminateInstances&InstanceId.1=i-missing")
+            self.fail("Terminating a missing instance should fail")
+        except urllib2.HTTPError as e:
+            self.assertEquals(400, e.code)
+            self.assertTrue("InvalidInstanceID.NotFound" in e.read())
+
+    def testThrottling(self):
+        self.aws.maxRate = 5
+        limiter.limiters["route53"] = limiter.RateLimiter(20, 20, minRate=4, delay=0.1)
+        # Route 53 throttles the listing, and the limiter backs off until it gets through.
+        zone = self.con.saveZone(route53.Zone("example.com.", "Test zone"))
+        for i in range(3):
+            self.con.getZone(zone.id)
+        self.assertTrue(self.aws.calls["Throttled"] > 0)
+
+    def testBenchmark(self):
+        # Run the commands end to end against a fake without delays.
+        results = dict((command, calls) for command, elapsed, calls in benchmark.run(3, ["provision", "info", "terminate"], latency=0, bootDelay=0, changeDelay=0))
+        self.assertEquals(1, results["provision"]["RunInstances"])
+        self.assertEquals(1, results["provision"]["AssociateAddress"])
+        # The records of the nodes are saved together.
+        self.assertEquals(1, results["provision"]["ChangeResourceRecordSets"])
+        self.assertEquals(1, results["provision"]["GetChange"])
+        self.assertEquals({"DescribeInstances": 1}, results["info"])
+        self.assertEquals(1, results["terminate"]["TerminateInstances"])
+
+    def testConvergedProvision(self):
+        # Provisioning again changes nothing, and doesn't wait for DNS batches.
+        command, elapsed, calls = benchmark.run(3, ["provision", "provision"], latency=0, bootDelay=0, changeDelay=0)[1]
+        self.assertFalse("ChangeResourceRecordSets" in calls)
+        self.assertFalse("RunInstances" in calls)
+        self.assertTrue(elapsed < 1)
+
+    def testInstances(self):
+        clock = [1000]
+        self.aws.clock = lambda: clock[0]
+        self.aws.bootDelay = 10
+        params = {"Action": "RunInstances", "ImageId": "ami-1", "MinCount": "2", "MaxCount": "2", "ClientToken": "token"}
+        self.aws.ec2(params)
+        # Launching again with the same token doesn't launch anything.
+        self.aws.ec2(params)
+        self.assertEquals(2, len(self.aws.instances))
+        running = {"Action": "DescribeInstances", "Filter.1.Name": "instance-state-name", "Filter.1.Value.1": "running"}
+        self.assertFalse("<instanceId>" in self.aws.ec2(running))
+        clock[0] += 10
+        self.assertEquals(2, self.aws.ec2(running).count("<instanceId>"))
+        self.assertEquals(4, self.aws.calls["RunInstances"] + self.aws.calls["DescribeInstances"])
+
+if __name__ == "__main__":
+    unittest.main()
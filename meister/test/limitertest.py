@@ -0,0 +1,66 @@
+'''
+Tests for the rate limiter.
+'''
+import unittest
+from meister.aws.limiter import RateLimiter
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+class Throttled(Exception):
+    pass
+
+class LimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(2, 2, maxRate=4, clock=self.clock, sleep=self.clock.sleep)
+
+    def testBurst(self):
+        # The burst goes out at once, the rest at the rate.
+        self.assertEquals([0, 0, 0.5, 0.5], [self.limiter.acquire() for i in range(4)])
+
+    def testThrottled(self):
+        responses = [Throttled(), Throttled(), "ok"]
+        def request():
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        self.assertEquals("ok", self.limiter.call(request, lambda e: isinstance(e, Throttled)))
+        self.assertEquals([], responses)
+        # Halved twice, and then grown a little by the success.
+        self.assertTrue(0.5 < self.limiter.rate < 1)
+
+    def testOtherErrors(self):
+        def request():
+            raise ValueError("Invalid")
+        self.assertRaises(ValueError, self.limiter.call, request, lambda e: isinstance(e, Throttled))
+        self.assertEquals([], self.clock.sleeps)
+
+    def testGiveUp(self):
+        self.limiter.retries = 3
+        calls = []
+        def request():
+            calls.append(1)
+            raise Throttled()
+        self.assertRaises(Throttled, self.limiter.call, request, lambda e: isinstance(e, Throttled))
+        self.assertEquals(4, len(calls))
+        self.assertEquals(0.5, self.limiter.rate)
+
+    def testIncrease(self):
+        for i in range(100):
+            self.limiter.call(lambda: None, lambda e: False)
+        self.assertEquals(4, self.limiter.rate)
+
+if __name__ == "__main__":
+    unittest.main()
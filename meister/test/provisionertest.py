@@ -0,0 +1,127 @@
+'''
+Tests for the provisioner, against a fake EC2 connection.
+'''
+import unittest
+import os
+import socket
+from tempfile import mkstemp
+from meister.aws.provisioner import Provisioner
+from meister.state import StateStore
+
+class ListLogger():
+    def __init__(self):
+        self.logs = []
+
+    def log(self, message, type = 'notice'):
+        self.logs.append(message)
+
+class Item:
+    def __init__(self, **props):
+        for name, value in props.items():
+            setattr(self, name, value)
+
+class FakeConnection:
+    """
+    Nodes die one status check at a time.
+    """
+    def __init__(self, nodes, groups):
+        self.nodes = nodes
+        self.groups = groups
+        self.calls = []
+        self.dying = []
+
+    def getNodes(self, reset = False):
+        return self.nodes
+
+    def getSecurityGroups(self, reset = False, names = None):
+        return dict((name, group) for name, group in self.groups.items() if names is None or name in names)
+
+    def terminateNodes(self, ids):
+        self.calls.append(("terminate", sorted(ids)))
+        self.dying = sorted(ids)
+
+    def getActiveNodeIds(self, ids):
+        self.calls.append(("check", sorted(ids)))
+        if self.dying:
+            self.dying.pop(0)
+        return set(id for id in ids if id in self.dying)
+
+    def deleteSecurityGroup(self, name):
+        self.calls.append(("delete", name))
+
+    def findUntaggedNodes(self, names):
+        return dict((name, node) for name, node in self.untagged.items() if name in names)
+
+    def createNodes(self, image, size, names, diskSize, securityGroup, zone, keyName, clientToken = None):
+        self.calls.append(("launch", names))
+        raise self.launchError
+
+    def adoptNodes(self, nodes):
+        self.calls.append(("adopt", sorted(node.id for node in nodes)))
+
+class ProvisionerTest(unittest.TestCase):
+
+    def testDeleteNodes(self):
+        nodes = {
+            "mgmt": Item(securityGroup="mgmt"),
+            "app-1": Item(securityGroup="app"),
+            "app-2": Item(securityGroup="app"),
+        }
+        existing = {
+            "mgmt": Item(id="i-1"),
+            "app-1": Item(id="i-2"),
+            "app-2": Item(id="i-3"),
+        }
+        groups = {"mgmt": {}, "app": {}, "empty": {}}
+        con = FakeConnection(existing, dict((name, Item(name=name)) for name in groups.keys()))
+        Provisioner(con, ListLogger()).deleteNodes(nodes, groups, 0)
+        # All nodes are terminated with one call, empty groups are deleted right away.
+        self.assertEqual(con.calls[0], ("delete", "empty"))
+        self.assertEqual(con.calls[1], ("terminate", ["i-1", "i-2", "i-3"]))
+        # Each group is deleted as soon as its last node is gone.
+        self.assertEqual(con.calls[2:], [
+            ("check", ["i-1", "i-2", "i-3"]),
+            ("delete", "mgmt"),
+            ("check", ["i-2", "i-3"]),
+            ("check", ["i-3"]),
+            ("delete", "app"),
+        ])
+
+    def testAdoptNodes(self):
+        con = FakeConnection({"mgmt": Item(id="i-1")}, {})
+        con.stack = "example"
+        con.untagged = {
+            "app-1": Item(id="i-2", extra={"keyname": "example"}),
+            "app-2": Item(id="i-3", extra={"keyname": "example"}),
+        }
+        # Nodes that were launched before stack tagging are added instead of launched again.
+        adopted = Provisioner(con, ListLogger()).adoptNodes({"app-1": "example", "app-2": "example"})
+        self.assertEqual(["i-2", "i-3"], sorted(node.id for node in adopted))
+        self.assertEqual([("adopt", ["i-2", "i-3"])], con.calls)
+
+    def testUntaggedNodeWithOtherKeyPair(self):
+        con = FakeConnection({}, {})
+        con.stack = "example"
+        con.untagged = {"app-1": Item(id="i-2", extra={"keyname": "other"})}
+        # A node with the same name could belong to something else, so nothing is done.
+        self.assertRaises(Exception, Provisioner(con, ListLogger()).adoptNodes, {"app-1": "example"})
+        self.assertEqual([], con.calls)
+
+    def testRejectedLaunch(self):
+        handle, path = mkstemp()
+        os.close(handle)
+        try:
+            journal = StateStore(path)
+            con = FakeConnection({}, {})
+            provisioner = Provisioner(con, ListLogger(), journal)
+            spec = ("ami-bad", "t1.micro", "8", "app", "eu-west-1a", "example")
+            # A launch that EC2 turned down is not resumed by the next run.
+            con.launchError = Exception("InvalidAMIID.NotFound: The AMI ID 'ami-bad' does not exist")
+            self.assertRaises(Exception, provisioner.launchNodes, {}, ["app-1"], spec)
+            self.assertEqual([], journal.getOperations("launch"))
+            # A launch that may have reached EC2 is.
+            con.launchError = socket.timeout("timed out")
+            self.assertRaises(socket.timeout, provisioner.launchNodes, {}, ["app-1"], spec)
+            self.assertEqual(["app-1"], [operation["name"] for operation in journal.getOperations("launch", False)])
+        finally:
+            os.remove(path)
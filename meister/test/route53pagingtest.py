@@ -0,0 +1,103 @@
+'''
+Tests for paginated listing of zones and records.
+'''
+import unittest
+from StringIO import StringIO
+from urlparse import urlparse, parse_qs
+from meister.aws import route53
+
+NAMESPACE = "https://route53.amazonaws.com/doc/2012-02-29/"
+
+class FakeResponse:
+    will_close = False
+
+    def __init__(self, body, status = 200):
+        self.fp = StringIO(body)
+        self.status = status
+
+    def read(self, amt = None):
+        return self.fp.read() if amt is None else self.fp.read(amt)
+
+    def isclosed(self):
+        return self.fp.tell() == len(self.fp.getvalue())
+
+    def getheader(self, name, default = None):
+        return "Mon, 04 Feb 2013 10:00:00 GMT" if name == "Date" else default
+
+class FakeRoute53:
+    """
+    Serves zones and records, a few at a time.
+    """
+    def __init__(self, zones, records, pageSize):
+        self.zones = zones
+        self.records = records
+        self.pageSize = pageSize
+        self.requests = []
+
+    def __call__(self, host, timeout = None):
+        return FakeConnection(self)
+
+    def respond(self, method, path):
+        self.requests.append(path)
+        url = urlparse(path)
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        if url.path.endswith("/rrset"):
+            names = [name for name in self.records if name >= query.get("name", "")]
+            page, rest = names[:self.pageSize], names[self.pageSize:]
+            body = "".join("<ResourceRecordSet><Name>{0}</Name><Type>A</Type><TTL>120</TTL><ResourceRecords><ResourceRecord><Value>10.0.0.1</Value></ResourceRecord></ResourceRecords></ResourceRecordSet>".format(name) for name in page)
+            body = "<ResourceRecordSets>{0}</ResourceRecordSets>".format(body)
+            if rest:
+                body += "<IsTruncated>true</IsTruncated><NextRecordName>{0}</NextRecordName><NextRecordType>A</NextRecordType>".format(rest[0])
+            return FakeResponse('<ListResourceRecordSetsResponse xmlns="{0}">{1}</ListResourceRecordSetsResponse>'.format(NAMESPACE, body))
+        if url.path.endswith("/hostedzonesbyname"):
+            zones = [name for name in self.zones if name >= query["dnsname"]][:int(query["maxitems"])]
+            body = "".join("<HostedZone><Id>/hostedzone/{0}</Id><Name>{0}</Name><CallerReference>ref</CallerReference></HostedZone>".format(name) for name in zones)
+            return FakeResponse('<ListHostedZonesByNameResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/"><HostedZones>{0}</HostedZones></ListHostedZonesByNameResponse>'.format(body))
+        if url.path.endswith("/hostedzone"):
+            zones = [name for name in self.zones if name >= query.get("marker", "")]
+            page, rest = zones[:self.pageSize], zones[self.pageSize:]
+            body = "".join("<HostedZone><Id>/hostedzone/{0}</Id><Name>{0}</Name><CallerReference>ref</CallerReference></HostedZone>".format(name) for name in page)
+            body = "<HostedZones>{0}</HostedZones>".format(body)
+            if rest:
+                body += "<IsTruncated>true</IsTruncated><NextMarker>{0}</NextMarker>".format(rest[0])
+            return FakeResponse('<ListHostedZonesResponse xmlns="{0}">{1}</ListHostedZonesResponse>'.format(NAMESPACE, body))
+        return FakeResponse("")
+
+class FakeConnection:
+    def __init__(self, server):
+        self.server = server
+
+    def request(self, method, path, body = None, headers = {}):
+        self.response = self.server.respond(method, path)
+
+    def getresponse(self):
+        return self.response
+
+    def close(self):
+        pass
+
+class Route53PagingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeRoute53(["a.com.", "b.com.", "c.com."], ["{0:02d}.a.com.".format(i) for i in range(5)], 2)
+        route53.HTTPSConnectionPool.connectionClass = self.server
+        self.con = route53.Route53Connection("id", "key")
+
+    def testIterZones(self):
+        zones = [zone.name for zone in self.con.iterZones(2)]
+        self.assertEqual(zones, ["a.com.", "b.com.", "c.com."])
+        self.assertEqual(len(self.con.getZones()), 3)
+
+    def testFindZone(self):
+        self.assertEqual(self.con.findZone("b.com").id, "/hostedzone/b.com.")
+        self.assertEqual(self.con.findZone("bb.com."), None)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def testIterRecords(self):
+        zone = route53.Zone("a.com.", id="/hostedzone/a.com.")
+        records = [record.name for record in self.con.iterRecords(zone, 2)]
+        self.assertEqual(records, ["00.a.com.", "01.a.com.", "02.a.com.", "03.a.com.", "04.a.com."])
+        self.assertEqual(len([path for path in self.server.requests if "rrset" in path]), 3)
+
+    def tearDown(self):
+        route53.HTTPSConnectionPool.connectionClass = route53.httplib.HTTPSConnection
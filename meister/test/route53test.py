@@ -34,8 +34,10 @@ class Route53Test(unittest.TestCase):
         zone.addRecord(zone.RECORDTYPE_A, "test.onedomain.com.", "10.1.1.1")
         zone.addRecord(zone.RECORDTYPE_CNAME, "test2.onedomain.com.", "test.onedomain.com")
         self.con.saveZone(zone)
-        for record in zone.records.values():
-            self.assertTrue(record["saved"])
+        self.assertEqual(len(zone.getChanges().getBatches()), 0)
+        zone = self.con.getZone(zone.id)
+        self.assertEqual(zone.getRecord("test.onedomain.com.").values, ("10.1.1.1",))
+        self.assertEqual(zone.getRecord("test2.onedomain.com.", zone.RECORDTYPE_CNAME).values, ("test.onedomain.com",))
     
     def testDeleteRecord(self):
         zone = self.con.saveZone(route53.Zone("onedomain.com.", "Example domain"))
@@ -43,7 +45,7 @@ class Route53Test(unittest.TestCase):
         zone.addRecord(zone.RECORDTYPE_A, "test.onedomain.com.", "10.1.1.1")
         zone.deleteRecord("test.onedomain.com.")
         zone = self.con.getZone(zone.id)
-        self.assertTrue("test.onedomain.com." not in zone.records.keys())
+        self.assertTrue(zone.getRecord("test.onedomain.com.") is None)
         
                 
     def tearDown(self):
@@ -0,0 +1,109 @@
+'''
+Tests for the task scheduler.
+'''
+import unittest
+import threading
+import time
+from functools import partial
+from meister.scheduler import TaskScheduler, SchedulerException
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log = []
+        self.lock = threading.Lock()
+
+    def job(self, key, duration = 0, fail = False):
+        def run():
+            time.sleep(duration)
+            with self.lock:
+                self.log.append(key)
+            if fail:
+                raise Exception("{0} failed".format(key))
+            return key
+        return run
+
+    def testDependencies(self):
+        scheduler = TaskScheduler(4)
+        scheduler.add("mgmt:install_puppet", self.job("mgmt:install_puppet", 0.1))
+        scheduler.add("mgmt:install_puppet_master", self.job("mgmt:install_puppet_master"), ["mgmt:install_puppet"])
+        scheduler.add("app:install_puppet", self.job("app:install_puppet"))
+        scheduler.add("app:register_node", self.job("app:register_node"), ["app:install_puppet", "mgmt:install_puppet_master"])
+        results = scheduler.run()
+        self.assertEqual(len(results), 4)
+        # Independent jobs run at the same time.
+        self.assertEqual(self.log[0], "app:install_puppet")
+        self.assertEqual(self.log[-1], "app:register_node")
+        self.assertTrue(self.log.index("mgmt:install_puppet") < self.log.index("mgmt:install_puppet_master"))
+
+    def testParallel(self):
+        scheduler = TaskScheduler(10)
+        for i in range(10):
+            scheduler.add(i, self.job(i, 0.2))
+        start = time.time()
+        scheduler.run()
+        self.assertTrue(time.time() - start < 1)
+
+    def testFailure(self):
+        scheduler = TaskScheduler(2)
+        scheduler.add("a", self.job("a", fail = True))
+        scheduler.add("b", self.job("b"), ["a"])
+        scheduler.add("c", self.job("c"))
+        try:
+            scheduler.run()
+            self.fail("The scheduler should fail.")
+        except SchedulerException as e:
+            self.assertEqual(e.errors.keys(), ["a"])
+        # Jobs that depend on failed jobs are skipped.
+        self.assertEqual(sorted(self.log), ["a", "c"])
+
+    def testInvalid(self):
+        scheduler = TaskScheduler()
+        scheduler.add("a", self.job("a"), ["b"])
+        self.assertRaises(SchedulerException, scheduler.run)
+        scheduler.add("b", self.job("b"), ["a"])
+        self.assertRaises(SchedulerException, scheduler.run)
+
+    def testExternal(self):
+        scheduler = TaskScheduler(4)
+        scheduler.addExternal("mgmt:ready")
+        scheduler.addExternal("app:ready")
+        def watch():
+            # The nodes become ready one at a time.
+            for key in ["app:ready", "mgmt:ready"]:
+                time.sleep(0.1)
+                scheduler.finish(key, key)
+        scheduler.add("watch", watch)
+        scheduler.add("app:dns", self.job("app:dns"), ["app:ready"])
+        scheduler.add("mgmt:dns", self.job("mgmt:dns"), ["mgmt:ready"])
+        results = scheduler.run()
+        self.assertEqual(results["app:ready"], "app:ready")
+        # Each node moves on as soon as it is ready itself.
+        self.assertEqual(self.log, ["app:dns", "mgmt:dns"])
+
+    def testExternalStart(self):
+        scheduler = TaskScheduler(2)
+        started = []
+        def flush():
+            # Both nodes are handed over, and finished together by another thread.
+            for key in started:
+                scheduler.finish(key, "saved")
+        def start(key):
+            started.append(key)
+            if len(started) == 2:
+                threading.Timer(0.1, flush).start()
+        for name in ["app", "mgmt"]:
+            scheduler.add(name + ":ready", self.job(name + ":ready"))
+            scheduler.addExternal(name + ":dns", [name + ":ready"], partial(start, name + ":dns"))
+            scheduler.add(name + ":tasks", self.job(name + ":tasks"), [name + ":dns"])
+        results = scheduler.run()
+        self.assertEqual(results["app:dns"], "saved")
+        self.assertEqual(sorted(self.log), ["app:ready", "app:tasks", "mgmt:ready", "mgmt:tasks"])
+
+    def testExternalFailure(self):
+        scheduler = TaskScheduler(2)
+        scheduler.addExternal("app:ready")
+        scheduler.add("watch", lambda: scheduler.finish("app:ready", error = Exception("app could not start")))
+        scheduler.add("app:dns", self.job("app:dns"), ["app:ready"])
+        self.assertRaises(SchedulerException, scheduler.run)
+        self.assertEqual(self.log, [])
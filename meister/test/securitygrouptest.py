@@ -0,0 +1,55 @@
+'''
+Tests for security group rules.
+'''
+import unittest
+from meister.aws.ec2 import EC2SecurityGroup, Rule
+
+class FakeConnection:
+    """
+    Records the requests that are sent instead of sending them.
+    """
+    path = "/"
+
+    def __init__(self):
+        self.conn = self
+        self.connection = self
+        self.requests = []
+
+    def request(self, path, params):
+        self.requests.append(params)
+
+class SecurityGroupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.con = FakeConnection()
+        self.group = EC2SecurityGroup(self.con, "web", "Web servers")
+        self.group.addRule("22", "22", "10.0.0.1/32", "TCP", False)
+        self.group.addRule("80", "80", "0.0.0.0/0", "tcp", False)
+
+    def testNormalizedRules(self):
+        self.assertEqual(Rule("22", "22", "10.0.0.1/32", "TCP"), Rule(22, 22, "10.0.0.1/32"))
+        self.assertEqual(len(set([Rule("22", "22", "10.0.0.1/32"), Rule(22, 22, "10.0.0.1/32")])), 1)
+        self.assertNotEqual(Rule(22, 22, "10.0.0.1/32"), Rule(22, 22, "10.0.0.2/32"))
+
+    def testAuthorize(self):
+        added = self.group.authorize([Rule(22, 22, "10.0.0.1/32"), Rule(443, 443, "0.0.0.0/0"), Rule(8080, 8081, "10.0.0.2/32")])
+        self.assertEqual(added, set([Rule(443, 443, "0.0.0.0/0"), Rule(8080, 8081, "10.0.0.2/32")]))
+        # All missing rules are sent in one call.
+        self.assertEqual(len(self.con.requests), 1)
+        params = self.con.requests[0]
+        self.assertEqual(params["Action"], "AuthorizeSecurityGroupIngress")
+        self.assertEqual(params["IpPermissions.1.FromPort"], "443")
+        self.assertEqual(params["IpPermissions.2.IpRanges.1.CidrIp"], "10.0.0.2/32")
+        self.assertFalse("IpPermissions.3.IpProtocol" in params)
+        # Nothing is sent when the group already has the rules.
+        self.assertEqual(self.group.authorize([Rule(443, 443, "0.0.0.0/0")]), set())
+        self.assertEqual(len(self.con.requests), 1)
+        self.assertEqual(len(self.group.listRules()), 4)
+
+    def testRevoke(self):
+        removed = self.group.revoke(self.group.rules - set([Rule(80, 80, "0.0.0.0/0")]))
+        self.assertEqual(removed, set([Rule(22, 22, "10.0.0.1/32")]))
+        self.assertEqual(self.con.requests[0]["Action"], "RevokeSecurityGroupIngress")
+        self.assertEqual(self.group.listRules(), [Rule(80, 80, "0.0.0.0/0")])
+        self.assertEqual(self.group.revoke([Rule(22, 22, "10.0.0.1/32")]), set())
+        self.assertEqual(len(self.con.requests), 1)
@@ -0,0 +1,115 @@
+'''
+Tests for signing Route 53 requests.
+'''
+import unittest
+from email.utils import formatdate
+from meister.aws import route53, limiter
+
+class FakeResponse:
+    will_close = False
+
+    def __init__(self, status, date, body = ""):
+        self.status = status
+        self.date = date
+        self.body = body
+
+    def read(self, amt = None):
+        return self.body
+
+    def isclosed(self):
+        return True
+
+    def getheader(self, name, default = None):
+        return self.date if name == "Date" else default
+
+class FakeRoute53:
+    """
+    Rejects requests that are signed more than five minutes off.
+    """
+    def __init__(self, now):
+        self.now = now
+        self.dates = []
+        self.reject = False
+        # The error of rejected requests that are signed in time.
+        self.error = None
+
+    def __call__(self, host, timeout = None):
+        return self
+
+    def request(self, method, path, body = None, headers = {}):
+        self.dates.append(headers["Date"])
+        if self.error:
+            self.response = FakeResponse(400, formatdate(self.now, usegmt=True), '<ErrorResponse><Error><Code>{0}</Code><Message>Rejected</Message></Error></ErrorResponse>'.format(self.error))
+        elif self.reject or abs(route53.mktime_tz(route53.parsedate_tz(headers["Date"])) - self.now) > 300:
+            self.response = FakeResponse(403, formatdate(self.now, usegmt=True), '<ErrorResponse><Error><Code>InvalidSignature</Code><Message>Signature expired</Message></Error></ErrorResponse>')
+        else:
+            self.response = FakeResponse(200, formatdate(self.now, usegmt=True), "ok")
+
+    def getresponse(self):
+        return self.response
+
+    def close(self):
+        pass
+
+class CountingLimiter(limiter.RateLimiter):
+    def __init__(self):
+        limiter.RateLimiter.__init__(self, 100, 100)
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+        return limiter.RateLimiter.acquire(self)
+
+class RequestSignerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1360000000
+
+    def clock(self):
+        return self.now
+
+    def testSignature(self):
+        signer = route53.RequestSigner("id", "key", self.clock)
+        headers = signer.getHeaders()
+        self.assertEqual(headers["Date"], "Mon, 04 Feb 2013 17:46:40 GMT")
+        self.assertTrue(headers["X-Amzn-Authorization"].startswith("AWS3-HTTPS AWSAccessKeyId=id,Algorithm=HmacSHA1,Signature="))
+        # Every request is signed with the current time.
+        self.now += 3600
+        self.assertEqual(signer.getHeaders()["Date"], "Mon, 04 Feb 2013 18:46:40 GMT")
+
+    def testClockSkew(self):
+        server = FakeRoute53(self.now + 3600)
+        route53.HTTPSConnectionPool.connectionClass = server
+        con = route53.Route53Connection("id", "key")
+        con.signer.clock = self.clock
+        limiter.limiters["route53"] = CountingLimiter()
+        # Nothing is sent until the first request.
+        self.assertEqual(server.dates, [])
+        self.assertEqual(con.request("GET", "hostedzone"), "ok")
+        self.assertEqual(len(server.dates), 2)
+        # The request that is sent again waits for the rate limiter too.
+        self.assertEqual(limiter.limiters["route53"].acquired, 2)
+        # Later requests use the corrected clock right away.
+        self.assertEqual(con.request("GET", "hostedzone"), "ok")
+        self.assertEqual(len(server.dates), 3)
+        # Other errors are not retried.
+        server.reject = True
+        self.assertRaises(route53.Route53Exception, con.request, "GET", "hostedzone")
+        self.assertEqual(len(server.dates), 4)
+
+    def testOtherErrors(self):
+        server = FakeRoute53(self.now + 3600)
+        server.error = "InvalidChangeBatch"
+        route53.HTTPSConnectionPool.connectionClass = server
+        con = route53.Route53Connection("id", "key")
+        con.signer.clock = self.clock
+        limiter.limiters["route53"] = CountingLimiter()
+        # Requests that fail for other reasons are not sent again, even if the clock is off.
+        self.assertRaises(route53.Route53Exception, con.request, "POST", "hostedzone")
+        self.assertEqual(len(server.dates), 1)
+        self.assertEqual(limiter.limiters["route53"].acquired, 1)
+        self.assertEqual(con.signer.skew, 0)
+
+    def tearDown(self):
+        route53.HTTPSConnectionPool.connectionClass = route53.httplib.HTTPSConnection
+        limiter.limiters.clear()
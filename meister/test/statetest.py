@@ -0,0 +1,65 @@
+'''
+Tests for the local state store.
+'''
+import unittest
+import os
+from tempfile import mkstemp
+from meister.state import StateStore
+
+class StateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.path = mkstemp()
+        os.close(handle)
+        self.state = StateStore(self.path)
+
+    def testCompletedTasks(self):
+        self.assertEqual(self.state.getCompletedTasks("mgmt", "i-1"), [])
+        self.state.addCompletedTasks("mgmt", "i-1", ["install_puppet", {"name": "register_node", "arguments": ["mgmt"]}])
+        self.state.addCompletedTasks("mgmt", "i-1", ["install_puppet"])
+        tasks = self.state.getCompletedTasks("mgmt", "i-1")
+        self.assertEqual(len(tasks), 2)
+        self.assertTrue("install_puppet" in tasks)
+        self.assertTrue({"name": "register_node", "arguments": ["mgmt"]} in tasks)
+        # A new instance with the same name starts from scratch.
+        self.assertEqual(self.state.getCompletedTasks("mgmt", "i-2"), [])
+        # The state is shared with other processes.
+        self.assertEqual(len(StateStore(self.path).getCompletedTasks("mgmt", "i-1")), 2)
+
+    def testZoneDirectory(self):
+        self.assertEqual(self.state.getZoneId("example.com."), None)
+        self.state.setZoneId("example.com.", "/hostedzone/Z1")
+        self.assertEqual(self.state.getZoneId("example.com."), "/hostedzone/Z1")
+        # Expired ids are ignored.
+        self.state.setZoneId("example.com.", "/hostedzone/Z1", -1)
+        self.assertEqual(self.state.getZoneId("example.com."), None)
+
+    def testInventory(self):
+        self.assertEqual(self.state.getHost("mgmt"), None)
+        self.state.setHosts({"mgmt": {"id": "i-1", "externalIp": "1.2.3.4", "internalIp": "10.0.0.1"}})
+        self.assertEqual(self.state.getHost("mgmt"), {"id": "i-1", "externalIp": "1.2.3.4", "internalIp": "10.0.0.1"})
+        # The addresses of stale entries are left out, but the instance id is kept.
+        self.assertEqual(self.state.getHost("mgmt", -1), {"id": "i-1", "externalIp": None, "internalIp": None})
+        self.state.clearHosts()
+        self.assertEqual(self.state.getHost("mgmt"), None)
+
+    def testJournal(self):
+        self.assertEqual(self.state.getOperations(), [])
+        launch = self.state.beginOperation("launch", "app-1,app-2", {"token": "abc", "names": ["app-1", "app-2"]})
+        eip = self.state.beginOperation("eip", "mgmt")
+        self.state.completeOperation(eip, {"ip": "1.2.3.4"})
+        pending = self.state.getOperations("launch", False)
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(pending[0]["id"], launch)
+        self.assertEqual(pending[0]["data"]["token"], "abc")
+        self.assertEqual(self.state.getOperations("launch", True), [])
+        # Another process sees the journal of an interrupted run.
+        completed = StateStore(self.path).getOperations("eip", True)
+        self.assertEqual(completed[0]["name"], "mgmt")
+        self.assertEqual(completed[0]["data"], {"ip": "1.2.3.4"})
+        self.state.clearJournal()
+        self.assertEqual(self.state.getOperations(), [])
+
+    def tearDown(self):
+        self.state.close()
+        os.remove(self.path)
@@ -0,0 +1,79 @@
+'''
+Tests for the tracing of calls and phases.
+'''
+import json
+import os
+import unittest
+from functools import partial
+from tempfile import mkstemp
+from meister.tracing import Tracer
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+class TracingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.tracer = Tracer(self.clock)
+
+    def testDisabled(self):
+        with self.tracer.operation("ec2", "DescribeInstances") as operation:
+            operation.bytes = 10
+        self.assertEquals([], self.tracer.getOperations())
+
+    def testOperations(self):
+        self.tracer.enable()
+        with self.tracer.span("launch"):
+            with self.tracer.operation("ec2", "RunInstances") as operation:
+                self.clock.now += 2
+                operation.bytes = 100
+                operation.retries = 1
+        def fail():
+            self.clock.now += 0.5
+            raise Exception("Connection refused")
+        self.assertRaises(Exception, self.tracer.wrap("task", fail, node="mgmt"))
+        calls = self.tracer.getOperations("ec2")
+        self.assertEquals(1, len(calls))
+        self.assertEquals(2, calls[0].duration)
+        phases = self.tracer.getOperations(Tracer.PHASE)
+        self.assertEquals(["launch", "task"], [phase.name for phase in phases])
+        self.assertEquals("Exception: Connection refused", phases[1].error)
+
+        events = [event for event in self.tracer.toChromeTrace()["traceEvents"] if event["ph"] == "X"]
+        self.assertEquals({"bytes": 100, "retries": 1}, events[0]["args"])
+        self.assertEquals(0, events[0]["ts"])
+        self.assertEquals(2000000, events[0]["dur"])
+        self.assertEquals({"node": "mgmt", "error": "Exception: Connection refused"}, events[2]["args"])
+
+        summary = self.tracer.summary()
+        self.assertTrue("RunInstances" in summary)
+        self.assertTrue("Slowest operations:" in summary)
+
+    def testWrapPartial(self):
+        self.tracer.enable()
+        job = self.tracer.wrap("eip", partial(lambda a, b: a + b, 1), node="mgmt")
+        self.assertEquals(3, job(2))
+        self.assertEquals(["eip"], [phase.name for phase in self.tracer.getOperations(Tracer.PHASE)])
+
+    def testWrite(self):
+        self.tracer.enable()
+        with self.tracer.operation("ssh", "run", host="10.0.0.1"):
+            pass
+        handle, path = mkstemp()
+        os.close(handle)
+        try:
+            self.tracer.write(path)
+            with open(path) as traceFile:
+                trace = json.load(traceFile)
+        finally:
+            os.remove(path)
+        self.assertEquals("run", trace["traceEvents"][0]["name"])
+        self.assertEquals("10.0.0.1", trace["traceEvents"][0]["args"]["host"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+'''
+Tests for the waiter.
+'''
+import unittest
+from meister.aws.waiter import Waiter, WaiterTimeout
+
+class WaiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        self.now = 0
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def clock(self):
+        return self.now
+
+    def testWait(self):
+        calls = []
+        readyAfter = {"a": 1, "b": 3, "c": 2}
+        def check(pending):
+            calls.append(sorted(pending))
+            return [key for key in pending if readyAfter[key] <= len(calls)]
+        ready = []
+        waiter = Waiter(check, delay=1, maxDelay=3, jitter=0, sleep=self.sleep, clock=self.clock)
+        rounds = waiter.wait(["a", "b", "c"], ready.append)
+        self.assertEqual(rounds, 3)
+        self.assertEqual(ready, ["a", "c", "b"])
+        # All pending keys are checked in a single call per round.
+        self.assertEqual(calls, [["a", "b", "c"], ["b", "c"], ["b"]])
+        self.assertEqual(self.sleeps, [1, 2])
+
+    def testBackoffLimit(self):
+        waiter = Waiter(lambda pending: [], delay=1, maxDelay=4, timeout=20, jitter=0, sleep=self.sleep, clock=self.clock)
+        self.assertRaises(WaiterTimeout, waiter.wait, ["a"])
+        self.assertEqual(self.sleeps, [1, 2, 4, 4, 4, 4, 4])
@@ -0,0 +1,56 @@
+'''
+Tests for zones and the record diff.
+'''
+import unittest
+from meister.aws.route53 import Zone, Record, RecordStore
+
+class ZoneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.zone = Zone("example.com.", id = "/hostedzone/Z1")
+        self.zone.setRemoteRecords(RecordStore([
+            Record("example.com.", "SOA", 900, ["ns.example.com. hostmaster.example.com. 1 7200 900 1209600 86400"]),
+            Record("example.com.", "NS", 172800, ["ns.example.com."]),
+            Record("a.example.com.", "A", 120, ["10.0.0.1"]),
+            Record("a.example.com.", "TXT", 120, ['"text"']),
+            Record("b.example.com.", "A", 120, ["10.0.0.2"]),
+            Record("c.example.com.", "A", 120, ["10.0.0.3", "10.0.0.4"]),
+        ]))
+
+    def getChanges(self):
+        return sorted((action, record.name, record.type) for changes in self.zone.getChanges().getBatches() for action, record in changes)
+
+    def testRecordStore(self):
+        # Records with the same name but different types don't overwrite each other.
+        self.assertEqual(self.zone.getRecord("a.example.com.").values, ("10.0.0.1",))
+        self.assertEqual(self.zone.getRecord("a.example.com.", "TXT").values, ('"text"',))
+        self.assertEqual(len(self.zone.records.getByName("a.example.com.")), 2)
+
+    def testNoChanges(self):
+        self.zone.addRecord("A", "c.example.com.", ["10.0.0.4", "10.0.0.3"])
+        self.assertEqual(self.getChanges(), [])
+
+    def testDiff(self):
+        self.zone.addRecord("A", "a.example.com.", "10.0.0.5")
+        self.zone.deleteRecord("b.example.com.")
+        self.zone.addRecord("A", "d.example.com.", "10.0.0.6")
+        self.zone.records.remove("example.com.", "SOA")
+        self.assertEqual(self.getChanges(), [
+            ("CREATE", "a.example.com.", "A"),
+            ("CREATE", "d.example.com.", "A"),
+            ("DELETE", "a.example.com.", "A"),
+            ("DELETE", "b.example.com.", "A"),
+        ])
+
+    def testCopy(self):
+        copy = self.zone.copy()
+        copy.addRecord("A", "d.example.com.", "10.0.0.5")
+        # The changes of the copy are not made to the zone.
+        self.assertEqual([("CREATE", "d.example.com.", "A")], sorted((action, record.name, record.type) for changes in copy.getChanges().getBatches() for action, record in changes))
+        self.assertEqual([], self.getChanges())
+        self.assertEqual("/hostedzone/Z1", copy.id)
+
+    def testNewZone(self):
+        zone = Zone("example.com.")
+        zone.addRecord("A", "a.example.com.", "10.0.0.1")
+        self.assertEqual(len(zone.getChanges().getBatches()), 1)
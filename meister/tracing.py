@@ -0,0 +1,153 @@
+'''
+Tracing of API calls, SSH operations and the phases of a run.
+'''
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+class Operation:
+    """
+    A traced call or phase. The code that is traced fills in the number
+    of bytes and retries as it learns them.
+    """
+    def __init__(self, category, name, args):
+        self.category = category
+        self.name = name
+        self.args = args
+        self.bytes = 0
+        self.retries = 0
+        self.error = None
+        self.start = None
+        self.duration = None
+        self.thread = threading.current_thread()
+
+class Tracer:
+    """
+    Records API calls, SSH operations and the phases of provisioning,
+    so that it can be seen where the time of a run is spent.
+    Nothing is recorded until the tracer is enabled.
+    """
+    # The category of the phases of a run.
+    PHASE = "phase"
+
+    def __init__(self, clock = time.time):
+        self.clock = clock
+        self.enabled = False
+        self.started = None
+        self.operations = []
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        self.started = self.clock()
+
+    @contextmanager
+    def operation(self, category, name, **args):
+        """
+        Trace a call.
+        @param category: The kind of call, for instance ec2, route53 or ssh.
+        @param name: The action, for instance DescribeInstances.
+        @param args: Details to show with the call, like the host.
+        @return: The Operation, to fill in bytes and retries on.
+        """
+        operation = Operation(category, name, args)
+        operation.start = self.clock()
+        try:
+            yield operation
+        except Exception as e:
+            operation.error = "{0}: {1}".format(type(e).__name__, e)
+            raise
+        finally:
+            operation.duration = self.clock() - operation.start
+            if self.enabled:
+                with self.lock:
+                    self.operations.append(operation)
+
+    def span(self, name, **args):
+        """
+        Trace a phase of a run, such as launching the nodes.
+        """
+        return self.operation(self.PHASE, name, **args)
+
+    def wrap(self, name, fn, **args):
+        """
+        Wrap a function, for instance a job, so that it is traced as a phase.
+        """
+        # Jobs are often partials, which only have the attributes of the function they wrap.
+        @wraps(getattr(fn, "func", fn))
+        def traced(*fnArgs, **fnKwargs):
+            with self.span(name, **args):
+                return fn(*fnArgs, **fnKwargs)
+        return traced
+
+    def getOperations(self, category = None):
+        with self.lock:
+            return [operation for operation in self.operations if category is None or operation.category == category]
+
+    def toChromeTrace(self):
+        """
+        Get the operations as a trace that chrome://tracing and Perfetto can show.
+        Every thread gets its own row, with the phases it ran and the calls
+        it made inside them.
+        """
+        pid = os.getpid()
+        events = []
+        threads = {}
+        for operation in self.getOperations():
+            tid = operation.thread.ident
+            threads[tid] = operation.thread.name
+            args = dict(operation.args)
+            if operation.category != self.PHASE:
+                args["bytes"] = operation.bytes
+                args["retries"] = operation.retries
+            if operation.error:
+                args["error"] = operation.error
+            events.append({
+                "name": operation.name,
+                "cat": operation.category,
+                "ph": "X",
+                "ts": int((operation.start - self.started) * 1000000),
+                "dur": int(operation.duration * 1000000),
+                "pid": pid,
+                "tid": tid,
+                "args": args,
+            })
+        for tid, name in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, path):
+        """
+        Write the trace to a JSON file.
+        """
+        with open(path, "w") as traceFile:
+            json.dump(self.toChromeTrace(), traceFile)
+
+    def summary(self, slowest = 10):
+        """
+        Summarize the trace in a table of the calls of each kind, and the slowest operations.
+        """
+        totals = {}
+        for operation in self.getOperations():
+            key = (operation.category, operation.name)
+            count, seconds, size, retries, errors = totals.get(key, (0, 0, 0, 0, 0))
+            totals[key] = (count + 1, seconds + operation.duration, size + operation.bytes, retries + operation.retries, errors + (1 if operation.error else 0))
+        lines = ["{0:<8} {1:<32} {2:>6} {3:>9} {4:>9} {5:>10} {6:>7} {7:>6}".format(
+            "type", "operation", "count", "total s", "mean s", "bytes", "retries", "errors")]
+        for (category, name), (count, seconds, size, retries, errors) in sorted(totals.items(), key=lambda item: -item[1][1]):
+            lines.append("{0:<8} {1:<32} {2:>6} {3:>9.2f} {4:>9.3f} {5:>10} {6:>7} {7:>6}".format(
+                category, name, count, seconds, seconds / count, size, retries, errors))
+        calls = [operation for operation in self.getOperations() if operation.category != self.PHASE]
+        if calls:
+            lines.append("")
+            lines.append("Slowest operations:")
+            for operation in sorted(calls, key=lambda operation: -operation.duration)[:slowest]:
+                details = ", ".join("{0}={1}".format(key, value) for key, value in sorted(operation.args.items()))
+                lines.append("{0:>9.3f} {1} {2} {3}".format(operation.duration, operation.category, operation.name, details).rstrip())
+        return "\n".join(lines)
+
+# The tracer of the process. The command line enables it with --trace.
+tracer = Tracer()